@@ -33,6 +33,8 @@ import os.path as path
 import os
 import warnings
 
+import ABXpy.misc.triplets as triplets_io
+from ABXpy.h5tools.h5io import read_indexed
 from ABXpy.misc.type_fitting import fit_integer_type
 
 
@@ -50,6 +52,16 @@ def npdecode(keys, max_ind):
     return res
 
 
+def npencode(indices, n_indices, ind_type):
+    """Vectorized implementation of the encoding of the labels, the
+    inverse of npdecode
+    """
+    new_index = indices[:, 0].astype(ind_type)
+    for i in range(1, len(n_indices)):
+        new_index = indices[:, i] + n_indices[i] * new_index
+    return new_index
+
+
 def unique_rows(arr):
     """Numpy unique applied to the row only"""
     return (np.unique(np.ascontiguousarray(arr)
@@ -58,14 +70,18 @@ def unique_rows(arr):
             .view(arr.dtype).reshape(-1, arr.shape[1]))
 
 
-def collapse(scorefile, taskfile, fid):
+def collapse(scorefile, taskfile, fid, task=None):
     """Collapses the results for each triplets sharing the same on, across
     and by labels.
 
+    task is the name of the task when taskfile is a TaskSet file (see
+    ABXpy.taskset).
+
     """
     # We make the assumption that everything fits in memory...
     scorefid = h5py.File(scorefile, 'r+')
-    taskfid = h5py.File(taskfile, 'r')
+    taskh5 = h5py.File(taskfile, 'r')
+    taskfid = triplets_io.task_group(taskh5, task)
     bys = taskfid['bys'][...]
     for by_idx, by in enumerate(bys):
         # print 'collapsing {0}/{1}'.format(by_idx + 1, len(bys))
@@ -73,29 +89,34 @@ def collapse(scorefile, taskfile, fid):
 
         tfrk = taskfid['regressors'][by]
 
-        tmp = tfrk[u'indexed_data']
-        indices = np.array(tmp)
+        # the regressors of the on/across blocks are expanded to one
+        # row per triplet (or per candidate in a factorized task file)
+        indices = read_indexed(tfrk)
         if indices.size == 0:
             continue
-        tmp = scorefid['scores'][trip_attrs[0]:trip_attrs[1]]
-        scores_arr = np.array(tmp)
-        tmp = np.ascontiguousarray(indices).view(
-            np.dtype((np.void, indices.dtype.itemsize * indices.shape[1])))
         n_indices = np.max(indices, 0) + 1
         assert np.prod(n_indices) < 18446744073709551615, "type not big enough"
         ind_type = fit_integer_type(np.prod(n_indices),
                                     is_signed=False)
-        # encoding the indices of a triplet to a unique index
-        new_index = indices[:, 0].astype(ind_type)
-        for i in range(1, len(n_indices)):
-            new_index = indices[:, i] + n_indices[i] * new_index
-
-        permut = np.argsort(new_index)
 
-        # collapsing the score
-        sorted_scores = scores_arr[permut]
-        sorted_index = new_index[permut]
-        mean, unique_index, counts = unique(sorted_index, sorted_scores)
+        if triplets_io.is_factorized(taskfid):
+            # the regressors are stored for the A, B and X candidates
+            # of the blocks, those of the triplets are computed by chunks
+            mean, unique_index, counts = collapse_chunks(
+                triplets_io.read_regressors(taskfid, by, by_idx),
+                scorefid['scores'], trip_attrs[0], n_indices, ind_type)
+        else:
+            tmp = scorefid['scores'][trip_attrs[0]:trip_attrs[1]]
+            scores_arr = np.array(tmp)
+            # encoding the indices of a triplet to a unique index
+            new_index = npencode(indices, n_indices, ind_type)
+
+            permut = np.argsort(new_index)
+
+            # collapsing the score
+            sorted_scores = scores_arr[permut]
+            sorted_index = new_index[permut]
+            mean, unique_index, counts = unique(sorted_index, sorted_scores)
 
         # retrieving the triplet indices from the unique index.
         tmp = npdecode(unique_index, n_indices)
@@ -117,7 +138,7 @@ def collapse(scorefile, taskfile, fid):
             # results.append(aux + [context, score, n])
             # wf_tmp.write('\t'.join(map(str, results[-1])) + '\n')
     scorefid.close()
-    taskfid.close()
+    taskh5.close()
     del taskfid
     # wf_tmp.close()
     # return results
@@ -139,7 +160,34 @@ def unique(index, scores):
     return means, unique_index, counts
 
 
-def analyze(task_file, score_file, result_file):
+def collapse_chunks(chunks, scores, start, n_indices, ind_type):
+    """Same as unique for indices given by chunks
+
+    chunks yields the indices of consecutive triplets, whose scores
+    are scores[start:...].
+
+    """
+    keys, sums, counts = [], [], []
+    for indices in chunks:
+        stop = start + indices.shape[0]
+        unique_index, inverse = np.unique(
+            npencode(indices, n_indices, ind_type), return_inverse=True)
+        keys.append(unique_index)
+        sums.append(np.bincount(
+            inverse, weights=np.reshape(scores[start:stop], -1)))
+        counts.append(np.bincount(inverse))
+        start = stop
+
+    unique_index, inverse = np.unique(
+        np.concatenate(keys), return_inverse=True)
+    sums = np.bincount(inverse, weights=np.concatenate(sums))
+    counts = np.bincount(
+        inverse, weights=np.concatenate(counts)).astype(np.int64)
+    means = (sums / counts + 1) / 2
+    return means, unique_index, counts
+
+
+def analyze(task_file, score_file, result_file, task=None):
     """Analyse the results of a task
 
     Parameters
@@ -150,11 +198,14 @@ def analyze(task_file, score_file, result_file):
         the file containing the score of a task
     result_file: string, csv file
         the file that will contain the analysis results
+    task : string, optional
+        the name of the task when task_file is a TaskSet file (see
+        ABXpy.taskset)
 
     """
     with open(result_file, 'w+') as fid:
         taskfid = h5py.File(task_file, 'r')
-        aux = taskfid['regressors']
+        aux = triplets_io.task_group(taskfid, task)['regressors']
         tfrk = aux[list(aux)[0]]
         regs = tfrk['indexed_datasets']
         string = u''
@@ -163,7 +214,7 @@ def analyze(task_file, score_file, result_file):
         string += 'by\tscore\tn\n'
         fid.write(string)
         taskfid.close()
-        collapse(score_file, task_file, fid)
+        collapse(score_file, task_file, fid, task=task)
 
 
 def parse_args():
@@ -182,6 +233,9 @@ and output the results in tab separated csv format.''')
                         help='task file in hdf5 format')
     parser.add_argument('output', metavar='OUTPUT',
                         help='output file in csv format')
+    parser.add_argument('--task', default=None,
+                        help='name of the task to analyze when TASK is a '
+                        'TaskSet file')
     return vars(parser.parse_args())
 
 
@@ -204,7 +258,7 @@ def main():
             'Overwriting results file ' + args['output'], UserWarning)
         os.remove(result_file)
 
-    analyze(task_file, score_file, result_file)
+    analyze(task_file, score_file, result_file, task=args['task'])
 
 
 if __name__ == '__main__':
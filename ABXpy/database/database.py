@@ -97,3 +97,41 @@ def load_aux_dbs(basename, db, cols, mainfile):
         except IOError:
             pass
     return db, forest
+
+
+# function that lists the files a database is loaded from
+def files(filename):
+    """Returns the item file and the auxiliary files of a database
+
+    Only the headers of the files are read, see load for the naming of
+    the auxiliary files.
+
+    """
+    ext = '.item'
+    if not(filename[len(filename) - len(ext):] == ext):
+        filename = filename + ext
+    (basename, _) = os.path.splitext(filename)
+
+    # the attributes columns start at the second column prefixed with #
+    columns = read_header(filename)
+    sharps = [i for i, c in enumerate(columns) if c[0] == '#']
+    if len(sharps) < 2:
+        return [filename]
+    columns = [c.lstrip('#') for c in columns[sharps[1]:]]
+    return [filename] + aux_files(basename, columns, filename)
+
+
+# recursive auxiliary function for listing the auxiliary files
+def aux_files(basename, cols, mainfile):
+    found = []
+    for col in cols:
+        auxfile = basename + '.' + col
+        if not(auxfile == mainfile) and os.path.isfile(auxfile):
+            found.append(auxfile)
+            found += aux_files(basename, read_header(auxfile)[1:], mainfile)
+    return found
+
+
+def read_header(filename):
+    with open(filename) as fin:
+        return fin.readline().split()
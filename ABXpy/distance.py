@@ -70,14 +70,23 @@ def edit_distance(x, y):
         d = np.inf
     return d
 
-def run(features, task, output, normalized,
-        distance=None, njobs=1, group='features'):
-    njobs = int(njobs)
+def get_distance(distance=None, symmetric=False):
+    """Return the distance function named by distance
+
+    Returns the function and whether the distance is symmetric. The
+    default and Levenshtein distances are symmetric, the
+    Kullback-Leibler divergence is not. A custom distance
+    (distancemodule.distancefunction) is considered symmetric only if
+    symmetric is True.
+
+    """
     if distance:
         if distance=="levenshtein":
             distancefun = edit_distance
+            symmetric = True
         elif distance=="dtw_kl":
             distancefun = dtw_kl_distance
+            symmetric = False
         else:
             distancepair = distance.split('.')
             distancemodule = distancepair[0]
@@ -87,10 +96,20 @@ def run(features, task, output, normalized,
             distancefun = getattr(__import__(mod), distancefunction)
     else:
         distancefun = default_distance
+        symmetric = True
+    return distancefun, symmetric
+
 
+def run(features, task, output, normalized,
+        distance=None, njobs=1, group='features', previous=None,
+        cache=None, cache_size=1000, symmetric=False):
+    njobs = int(njobs)
+    distancefun, symmetric = get_distance(distance, symmetric)
     distances.compute_distances(
         features, group, task, output,
-        distancefun, normalized=normalized, n_cpu=njobs)
+        distancefun, normalized=normalized, n_cpu=njobs,
+        symmetric=symmetric, previous=previous, cache=cache,
+        cache_size=cache_size)
 
 
 def main():
@@ -126,12 +145,38 @@ def main():
         '-j', '--njobs', type=int, default=1,
         help='number of cpus to use')
 
+    parser.add_argument(
+        '--symmetric', action='store_true',
+        help='the custom distance given by --distance is symmetric, '
+        'it can then be used with the symmetric pairs of a task '
+        '(abx-task --symmetric-pairs) and the distances are cached '
+        'regardless of the order of the items. The built-in distances '
+        'ignore this option')
+
     parser.add_argument(
         '-n', '--normalization', type=int, default=None,
         help='if dtw distance selected, compute with normalization or with '
         'sum. If put to 1 : computes with normalization, if put to 0 : '
         'computes with sum. Common choice is to use normalization (-n 1)')
 
+    parser.add_argument(
+        '-u', '--update', nargs=2, metavar=('TASK', 'DISTANCE'),
+        default=None,
+        help='task and distance files computed before the task file was '
+        'updated, the distances of the unchanged \'by\' blocks are copied '
+        'from them')
+
+    parser.add_argument(
+        '--cache', metavar='DIRECTORY', default=None,
+        help='directory of a persistent cache of the distances, the '
+        'distances already computed on the same features with the same '
+        'distance and normalization are read from it')
+
+    parser.add_argument(
+        '--cache-size', type=float, default=1000,
+        help='maximal size of the cache in Mo, the least recently used '
+        'distances are removed above it, default is %(default)s')
+
     args = parser.parse_args()
 
     if os.path.exists(args.output):
@@ -143,7 +188,9 @@ def main():
         sys.exit("ERROR : DTW normalization parameter not specified !")
 
     run(args.features, args.task, args.output, normalized=args.normalization,
-        distance=args.distance, njobs=args.njobs, group=args.group)
+        distance=args.distance, njobs=args.njobs, group=args.group,
+        previous=args.update, cache=args.cache, cache_size=args.cache_size,
+        symmetric=args.symmetric)
 
 
 if __name__ == '__main__':
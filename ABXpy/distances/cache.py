@@ -0,0 +1,333 @@
+"""Persistent cache of the distances between items
+
+The distances computed by compute_distances can be stored in a cache
+directory, and read back by the next computations instead of being
+computed again, for instance when the same features are evaluated on a
+slightly different task.
+
+The distances are identified by a hash of the content of the feature
+files, of the distance function (its module and name), of the
+normalization and of the symmetry of the distance (see distance_key),
+and by the hashes of the file, onset and offset of the two items of
+each pair (see pair_keys). The keys of the pairs are sharded by range:
+the pairs of a shard are stored in a single chunk, a numpy file with
+the sorted keys of the pairs and their distances, in which they are
+looked up by binary search. The distances stored by a process are
+merged into the chunks of their shards when it flushes the cache, so
+that the number of chunks does not grow with the number of
+computations. When the cache exceeds its maximal size, the least
+recently used chunks are removed.
+
+Several processes can use the same cache: the chunks are replaced
+atomically, but the distances flushed concurrently to the same shard
+by two processes may be kept for only one of them, the other ones
+being computed again when needed.
+
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+
+# version of the cache chunks, the chunks of another version are not
+# read
+CACHE_VERSION = 3
+
+# the key of a pair is made of the 64 bits hashes of its two items
+# (see pair_keys), sorted by first then second hash. Two pairs thus
+# share a key only if two of their items have the same hash, which is
+# not detected: with n distinct items in the cache, this happens with
+# a probability of about n ** 2 / 2 ** 65
+KEY_DTYPE = np.dtype([('first', '<u8'), ('second', '<u8')])
+
+# the shard of a key is given by the SHARD_BITS most significant bits
+# of its first hash
+SHARD_BITS = 8
+
+# number of stored distances above which they are flushed to the
+# chunks
+FLUSH_SIZE = 1000000
+
+
+def distance_key(feature_files, feature_groups, distance, normalized,
+                 symmetric=False):
+    """Identify the distances between the items of feature files
+
+    It is a hash of the content of the feature files, of the groups
+    read in them, of the module and name of the distance function, of
+    the normalization and of symmetric. Two distance functions with the
+    same module and name are considered the same. The distances cached
+    as symmetric (see pair_keys) are thus never read as asymmetric
+    ones, and the converse.
+
+    """
+    h = hashlib.sha1(repr((
+        CACHE_VERSION, list(feature_groups),
+        getattr(distance, '__module__', None),
+        getattr(distance, '__qualname__', repr(distance)),
+        normalized, bool(symmetric))).encode('utf8'))
+    for filename in feature_files:
+        with open(filename, 'rb') as fin:
+            for chunk in iter(lambda: fin.read(2 ** 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def pair_keys(items, A, B, symmetric=False):
+    """Keys of pairs of items in the cache
+
+    items contains the file, onset and offset of the items, A and B
+    are the positions in items of the two items of each pair. The key
+    of a pair is the hashes of its two items, as an array of KEY_DTYPE.
+    It depends on the order of the items, unless symmetric is True:
+    the pairs (a, b) and (b, a) then have the same key.
+
+    """
+    hashes = pd.util.hash_pandas_object(
+        items[['file', 'onset', 'offset']], index=False).values
+    first, second = hashes[A], hashes[B]
+    if symmetric:
+        first, second = np.minimum(first, second), np.maximum(first, second)
+    keys = np.empty(len(first), dtype=KEY_DTYPE)
+    keys['first'] = first
+    keys['second'] = second
+    return keys
+
+
+class DistanceCache(object):
+    """On-disk cache of the distances between pairs of items
+
+    Parameters
+    ----------
+    directory : str
+        the cache directory, shared by all the distances
+    key : str
+        the identifier of the distances, see distance_key
+    max_size : float, optional
+        the maximal size of the cache directory in Mo
+    symmetric : bool, optional
+        whether the distance is symmetric, see pair_keys
+
+    The stored distances are written to the chunks by flush, which
+    must be called once the distances are computed.
+
+    """
+    def __init__(self, directory, key, max_size=1000, symmetric=False):
+        self.directory = directory
+        self.chunks = os.path.join(directory, key)
+        self.max_size = max_size
+        self.symmetric = symmetric
+        if not os.path.exists(self.chunks):
+            os.makedirs(self.chunks)
+        # the chunks read by this process by shard, with the identity
+        # of their file when read
+        self._loaded = {}
+        # the sorted keys and values stored but not flushed
+        self._pending = (np.empty(0, dtype=KEY_DTYPE), np.empty(0))
+        # the last use and size of the chunks of the cache directory,
+        # and their total size, scanned once then maintained on the
+        # changes made by this process
+        self._chunk_sizes = None
+        self._total_size = 0
+
+    def keys(self, items, A, B):
+        """Keys of pairs of items in this cache, see pair_keys"""
+        return pair_keys(items, A, B, self.symmetric)
+
+    def _path(self, shard):
+        return os.path.join(self.chunks, '{:02x}.npz'.format(shard))
+
+    def _chunk(self, shard):
+        """The sorted keys and values of the chunk of a shard
+
+        The chunk is read again only if its file was replaced. Returns
+        None if there is no chunk.
+
+        """
+        path = self._path(shard)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._loaded.pop(shard, None)
+            return None
+        identity = (stat.st_ino, stat.st_size)
+        loaded = self._loaded.get(shard)
+        if loaded is None or loaded[0] != identity:
+            try:
+                with np.load(path) as data:
+                    if data['version'] != CACHE_VERSION:
+                        return None
+                    loaded = (identity, data['keys'], data['values'])
+            except (IOError, OSError, ValueError, KeyError):
+                # removed by another process or not a chunk
+                self._loaded.pop(shard, None)
+                return None
+            self._loaded[shard] = loaded
+        return loaded[1], loaded[2]
+
+    def _shards(self, keys):
+        """Bounds of the shards in sorted keys"""
+        shards = keys['first'] >> np.uint64(64 - SHARD_BITS)
+        return np.searchsorted(shards, np.arange(2 ** SHARD_BITS + 1))
+
+    def lookup(self, keys):
+        """Return the cached distances of pairs
+
+        keys are the keys of the pairs (see pair_keys). Returns their
+        distances (nan if not cached) and a boolean array telling if
+        each pair was found in the cache.
+
+        """
+        keys = np.asarray(keys, dtype=KEY_DTYPE)
+        order = np.lexsort((keys['second'], keys['first']))
+        sorted_keys = keys[order]
+        values = np.full(len(keys), np.nan)
+        found = np.zeros(len(keys), dtype=bool)
+
+        bounds = self._shards(sorted_keys)
+        for shard in np.flatnonzero(np.diff(bounds)):
+            chunk = self._chunk(shard)
+            if chunk is None:
+                continue
+            where = order[bounds[shard]:bounds[shard + 1]]
+            if self._search(keys[where], chunk, where, values, found):
+                # the chunk is now the most recently used
+                self._touch(self._path(shard))
+        self._search(keys, self._pending, np.arange(len(keys)),
+                     values, found)
+        return values, found
+
+    @staticmethod
+    def _search(keys, chunk, where, values, found):
+        """Copy the values of the keys found in a sorted chunk"""
+        chunk_keys, chunk_values = chunk
+        if len(chunk_keys) == 0:
+            return False
+        positions = np.minimum(
+            np.searchsorted(chunk_keys, keys), len(chunk_keys) - 1)
+        hits = chunk_keys[positions] == keys
+        values[where[hits]] = chunk_values[positions[hits]]
+        found[where[hits]] = True
+        return hits.any()
+
+    def store(self, keys, values):
+        """Add the distances of pairs to the cache
+
+        They are kept in memory, and written to the chunks when more
+        than FLUSH_SIZE distances are stored, see flush.
+
+        """
+        if len(keys) == 0:
+            return
+        self._pending = _merge(
+            self._pending, (np.asarray(keys, dtype=KEY_DTYPE),
+                            np.asarray(values, dtype=np.float64)))
+        if len(self._pending[0]) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write the stored distances to the chunks of their shards
+
+        The least recently used chunks are then removed if the cache
+        exceeds its maximal size.
+
+        """
+        keys, values = self._pending
+        if len(keys) == 0:
+            return
+        self._pending = (keys[:0], values[:0])
+
+        bounds = self._shards(keys)
+        for shard in np.flatnonzero(np.diff(bounds)):
+            new = (keys[bounds[shard]:bounds[shard + 1]],
+                   values[bounds[shard]:bounds[shard + 1]])
+            chunk = self._chunk(shard)
+            if chunk is not None:
+                new = _merge(chunk, new)
+            self._write(shard, *new)
+        self.evict()
+
+    def _write(self, shard, keys, values):
+        path = self._path(shard)
+        # written under a temporary name then renamed, so that the
+        # other processes never read an incomplete chunk
+        fd, tmp_file = tempfile.mkstemp(dir=self.chunks, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                np.savez(fout, version=CACHE_VERSION, keys=keys,
+                         values=values)
+            os.replace(tmp_file, path)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+        stat = os.stat(path)
+        self._loaded[shard] = ((stat.st_ino, stat.st_size), keys, values)
+        if self._chunk_sizes is not None:
+            _, previous = self._chunk_sizes.get(path, (None, 0))
+            self._chunk_sizes[path] = (stat.st_mtime, stat.st_size)
+            self._total_size += stat.st_size - previous
+
+    def _touch(self, path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            return
+        if self._chunk_sizes is not None and path in self._chunk_sizes:
+            self._chunk_sizes[path] = (time.time(), self._chunk_sizes[path][1])
+
+    def _scan(self):
+        """List the chunks of the cache directory, all distances included"""
+        self._chunk_sizes = {}
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.npz'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    self._chunk_sizes[path] = (stat.st_mtime, stat.st_size)
+        self._total_size = sum(
+            size for _, size in self._chunk_sizes.values())
+
+    def evict(self):
+        """Remove the least recently used chunks above the maximal size
+
+        The cache directory is scanned on the first call only, the
+        chunks written and removed by the other processes since then
+        are ignored.
+
+        """
+        if self._chunk_sizes is None:
+            self._scan()
+        if self._total_size <= self.max_size * 2 ** 20:
+            return
+        chunks = sorted((used, size, path) for path, (used, size)
+                        in self._chunk_sizes.items())
+        for _, size, path in chunks:
+            if self._total_size <= self.max_size * 2 ** 20:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            del self._chunk_sizes[path]
+            self._total_size -= size
+
+
+def _merge(first, second):
+    """Merge two sets of sorted keys and their values
+
+    The values of second are kept for the keys in both sets.
+
+    """
+    keys = np.concatenate([second[0], first[0]])
+    values = np.concatenate([second[1], first[1]])
+    keys, index = np.unique(keys, return_index=True)
+    return keys, values[index]
@@ -6,6 +6,12 @@ import os
 import sys
 import warnings
 import h5features
+from h5features.index import read_index
+from h5features.items import read_items
+from h5features.version import read_version
+
+import ABXpy.misc.triplets as triplets_io
+from ABXpy.distances.cache import DistanceCache, distance_key
 
 # FIXME Enforce single process usage when using python compiled with OMP
 # enabled
@@ -30,7 +36,8 @@ import h5features
 # the job creation and adopt smarter loading schemes
 
 
-def create_distance_jobs(pair_file, distance_file, n_cpu, buffer_max_size=100):
+def create_distance_jobs(pair_file, distance_file, n_cpu, buffer_max_size=100,
+                         symmetric=False, previous=None):
     """Divide the work load into smaller blocks to be passed to the cpus
 
     Parameters
@@ -44,6 +51,13 @@ def create_distance_jobs(pair_file, distance_file, n_cpu, buffer_max_size=100):
         number of cpus tu use
     block_ceil_size: int
         maximum size in RAM of a block in Mb
+    symmetric: bool
+        True if the distance is symmetric, the pairs of the task can be
+        symmetric only in that case. Default to False
+    previous: tuple, optional
+        task file and distance file computed with the same distance
+        before the task file was updated (see Task.generate_triplets),
+        the distances of the unchanged 'by' blocks are copied from it
 
     """
     # FIXME check (given an optional checking function)
@@ -59,11 +73,23 @@ def create_distance_jobs(pair_file, distance_file, n_cpu, buffer_max_size=100):
             attrs = fh['unique_pairs'].attrs[by_dset]
             by_n_pairs.append(attrs[2] - attrs[1])
             total_n_pairs = fh['unique_pairs/data'].shape[0]
+        # pairs (i, j) and (j, i) are computed only once
+        symmetric_pairs = bool(
+            fh['unique_pairs/data'].attrs.get('symmetric', False))
+    if symmetric_pairs and not symmetric:
+        raise ValueError(
+            'The task file {} has symmetric pairs, it cannot be used with '
+            'an asymmetric distance'.format(pair_file))
     # initializing output datasets
     with h5py.File(distance_file, 'a') as fh:
         fh.attrs.create('done', False)
+        fh.attrs.create('symmetric_pairs', symmetric_pairs)
         g = fh.create_group('distances')
         g.create_dataset('data', shape=(total_n_pairs, 1), dtype=np.float)
+    if previous is not None:
+        copied = copy_distances(pair_file, distance_file, *previous)
+        by_n_pairs = [0 if by_dset in copied else n_pairs
+                      for by_dset, n_pairs in zip(by_dsets, by_n_pairs)]
     """
     #### Load balancing ####
     Heuristic: each process should have approximately
@@ -129,6 +155,33 @@ def create_distance_jobs(pair_file, distance_file, n_cpu, buffer_max_size=100):
     return jobs
 
 
+def copy_distances(pair_file, distance_file,
+                   previous_pair_file, previous_distance_file):
+    """Copy the distances of the 'by' blocks unchanged since a task file
+
+    Returns the 'by' blocks whose distances were copied from
+    previous_distance_file, that is the ones having the same items in
+    pair_file and previous_pair_file, generated by the same task.
+
+    """
+    with h5py.File(pair_file, 'r') as fh, \
+            h5py.File(previous_pair_file, 'r') as fprev:
+        task_hash, hashes = triplets_io.read_hashes(fh)
+        previous_hash, previous_hashes = triplets_io.read_hashes(fprev)
+        if task_hash is None or task_hash != previous_hash:
+            return set()
+        copied = {by: (fh['unique_pairs'].attrs[by],
+                       fprev['unique_pairs'].attrs[by])
+                  for by, h in hashes.items()
+                  if previous_hashes.get(by) == h}
+    with h5py.File(previous_distance_file, 'r') as fprev, \
+            h5py.File(distance_file, 'a') as fh:
+        for attrs, previous_attrs in copied.values():
+            fh['distances/data'][attrs[1]:attrs[2]] = (
+                fprev['distances/data'][previous_attrs[1]:previous_attrs[2]])
+    return set(copied)
+
+
 # If there are very large by blocks, two additional
 # things could help optimization:
 #     1. doing co-clustering inside of the large by blocks
@@ -149,7 +202,8 @@ def create_distance_jobs(pair_file, distance_file, n_cpu, buffer_max_size=100):
 
 def run_distance_job(job_description, distance_file, distance,
                      feature_files, feature_groups, splitted_features,
-                     job_id, normalize, distance_file_lock=None):
+                     job_id, normalize, distance_file_lock=None,
+                     cache=None):
     if distance_file_lock is None:
         synchronize = False
     else:
@@ -216,63 +270,98 @@ def run_distance_job(job_description, distance_file, distance,
         A = np.mod(pair_list, base)
         B = pair_list // base
         pairs = np.column_stack([A, B])
-        n_pairs = pairs.shape[0]
+        # only the distances missing from the cache are computed
+        dis = np.empty(shape=(pairs.shape[0], 1))
+        if cache is not None:
+            keys = cache.keys(by_db, A, B)
+            dis[:, 0], found = cache.lookup(keys)
+            missing = np.nonzero(~found)[0]
+        else:
+            missing = np.arange(pairs.shape[0])
         # get dataframe with one entry by item involved in this block
         # indexed by its 'by'-specific index
-        by_inds = np.unique(np.concatenate([A, B]))
+        by_inds = np.unique(np.concatenate([A[missing], B[missing]]))
         items = by_db.iloc[by_inds]
         # get a dictionary whose keys are the 'by' indices
         features = get_features(items)
-        dis = np.empty(shape=(n_pairs, 1))
-        # FIXME: second dim is 1 because of the way it is stored to disk,
-        # but ultimately it shouldn't be necessary anymore
-        # (if using axis arg in np2h5, h52np and h5io...)
-        for i in range(n_pairs):
-            dataA = features[pairs[i, 0]]
-            dataB = features[pairs[i, 1]]
-            if dataA.shape[0] == 0:
-                warnings.warn('No features found for file {}, {} - {}'
-                              .format(items['file'][pairs[i, 0]],
-                                      items['onset'][pairs[i, 0]],
-                                      items['offset'][pairs[i, 0]]),
-                              UserWarning)
-            if dataB.shape[0] == 0:
-                warnings.warn('No features found for file {}, {} - {}'
-                              .format(items['file'][pairs[i, 1]],
-                                      items['onset'][pairs[i, 1]],
-                                      items['offset'][pairs[i, 1]]),
-                              UserWarning)
-            try:
-                if normalize is not None:
-                    if normalize == 1:
-                        normalize = True
-                    elif normalize == 0:
-                        normalize = False
-                    else:
-                        print('normalized parameter neither 1 nor 0,'
-                              'using normalization')
-                        normalize = True
-                    dis[i, 0] = distance(dataA, dataB, normalized=normalize)
-                else:
-                    dis[i, 0] = distance(dataA, dataB)
-            except:
-                sys.stderr.write(
-                    'Error when calculating the distance between item {}, {} - {} '
-                    'and item {}, {} - {}\n'
-                    .format(items['file'][pairs[i, 0]],
-                            items['onset'][pairs[i, 0]],
-                            items['offset'][pairs[i, 0]],
-                            items['file'][pairs[i, 1]],
-                            items['onset'][pairs[i, 1]],
-                            items['offset'][pairs[i, 1]]),
-                )
-                raise
+        dis[missing] = pair_distances(
+            pairs[missing], features, items, distance, normalize)
+        if cache is not None:
+            cache.store(keys[missing], dis[missing, 0])
         if synchronize:
             distance_file_lock.acquire()
         with h5py.File(distance_file, 'a') as fh:
             fh['distances/data'][attrs[1]+start:attrs[1]+stop, :] = dis
         if synchronize:
             distance_file_lock.release()
+    if cache is not None:
+        cache.flush()
+
+
+def pair_distances(pairs, features, items, distance, normalize):
+    """Compute the distances between pairs of items of a 'by' block
+
+    Parameters
+    ----------
+    pairs : array of shape (n, 2)
+        the 'by'-specific indices of the items of each pair
+    features : dict
+        the features of the items, indexed by their 'by'-specific index
+    items : pandas.DataFrame
+        the file, onset and offset of the items, used in error messages
+    distance : callable
+        the distance function
+    normalize : int or None
+        the normalization parameter passed to the distance, if not None
+
+    Returns an array of shape (n, 1) containing the distances.
+
+    """
+    dis = np.empty(shape=(pairs.shape[0], 1))
+    # FIXME: second dim is 1 because of the way it is stored to disk,
+    # but ultimately it shouldn't be necessary anymore
+    # (if using axis arg in np2h5, h52np and h5io...)
+    for i in range(pairs.shape[0]):
+        dataA = features[pairs[i, 0]]
+        dataB = features[pairs[i, 1]]
+        if dataA.shape[0] == 0:
+            warnings.warn('No features found for file {}, {} - {}'
+                          .format(items['file'][pairs[i, 0]],
+                                  items['onset'][pairs[i, 0]],
+                                  items['offset'][pairs[i, 0]]),
+                          UserWarning)
+        if dataB.shape[0] == 0:
+            warnings.warn('No features found for file {}, {} - {}'
+                          .format(items['file'][pairs[i, 1]],
+                                  items['onset'][pairs[i, 1]],
+                                  items['offset'][pairs[i, 1]]),
+                          UserWarning)
+        try:
+            if normalize is not None:
+                if normalize == 1:
+                    normalize = True
+                elif normalize == 0:
+                    normalize = False
+                else:
+                    print('normalized parameter neither 1 nor 0,'
+                          'using normalization')
+                    normalize = True
+                dis[i, 0] = distance(dataA, dataB, normalized=normalize)
+            else:
+                dis[i, 0] = distance(dataA, dataB)
+        except:
+            sys.stderr.write(
+                'Error when calculating the distance between item {}, {} - {} '
+                'and item {}, {} - {}\n'
+                .format(items['file'][pairs[i, 0]],
+                        items['onset'][pairs[i, 0]],
+                        items['offset'][pairs[i, 0]],
+                        items['file'][pairs[i, 1]],
+                        items['onset'][pairs[i, 1]],
+                        items['offset'][pairs[i, 1]]),
+            )
+            raise
+    return dis
 
 
 # mem in megabytes
@@ -281,7 +370,23 @@ def run_distance_job(job_description, distance_file, distance,
 # get rid of the group in feature file (never used ?)
 def compute_distances(feature_file, feature_group, pair_file, distance_file,
                       distance, normalized, n_cpu=None, mem=1000,
-                      feature_file_as_list=False):
+                      feature_file_as_list=False, symmetric=False,
+                      previous=None, cache=None, cache_size=1000):
+    """Compute the distances between the unique pairs of a task file
+
+    symmetric must be True only if the distance is symmetric (see
+    ABXpy.distance.get_distance): a task file with symmetric pairs
+    (see Task.generate_triplets) is accepted only in that case, the
+    distance of (i, j) being used for (j, i). Default to False.
+
+    When cache is a directory, the distances are read from and added to
+    a persistent cache of at most cache_size Mo in this directory (see
+    ABXpy.distances.cache), so that the distances already computed on
+    the same features, with the same distance and normalization, are
+    not computed again. The keys of the pairs do not depend on the
+    order of their items when the distance is symmetric.
+
+    """
     #with h5py.File(distance_file) as fh:
     #    fh.attrs.create('distance', pickle.dumps(distance))
 
@@ -305,7 +410,14 @@ def compute_distances(feature_file, feature_group, pair_file, distance_file,
     # if splitted_features:
     #    split_feature_file(feature_file, feature_group, pair_file)
 
-    jobs = create_distance_jobs(pair_file, distance_file, n_cpu)
+    jobs = create_distance_jobs(pair_file, distance_file, n_cpu,
+                                symmetric=symmetric, previous=previous)
+
+    if cache is not None:
+        cache = DistanceCache(
+            cache, distance_key(feature_files, feature_groups, distance,
+                                normalized, symmetric),
+            max_size=cache_size, symmetric=symmetric)
 
     # results = []
     if n_cpu > 1:
@@ -314,7 +426,8 @@ def compute_distances(feature_file, feature_group, pair_file, distance_file,
         try:
             pool = multiprocessing.Pool(n_cpu)
             args = [(job, distance_file, distance, feature_files, feature_groups,
-                     splitted_features, i, normalized, distance_file_lock)
+                     splitted_features, i, normalized, distance_file_lock,
+                     cache)
                     for i, job in enumerate(jobs)]
             pool.map(worker, args)
         finally:
@@ -323,7 +436,8 @@ def compute_distances(feature_file, feature_group, pair_file, distance_file,
     else:
         run_distance_job(
             jobs[0], distance_file, distance,
-            feature_files, feature_groups, splitted_features, 1, normalized)
+            feature_files, feature_groups, splitted_features, 1, normalized,
+            cache=cache)
         with h5py.File(distance_file, 'a') as fh:
             fh.attrs.modify('done', True)
 
@@ -333,6 +447,50 @@ def worker(args):
     return run_distance_job(*args)
 
 
+def frame_counts(feature_file, feature_group, items):
+    """Number of frames of items in a h5features file
+
+    Only the index and the times of the h5features file are read, not
+    the features. The frames of an item are those of its file with a
+    time between its onset and offset, as in Features_Accessor.
+
+    Parameters
+    ----------
+    feature_file : str
+        the h5features file
+    feature_group : str
+        the group to read in the h5features file
+    items : pandas.DataFrame
+        the items, with file, onset and offset columns
+
+    Returns an array with the number of frames of each item.
+
+    """
+    with h5py.File(feature_file, 'r') as fh:
+        group = fh[feature_group]
+        version = read_version(group)
+        files = read_items(group, version)
+        files = files if isinstance(files, list) else files.data
+        index = read_index(group, version)
+        times = (group['labels'] if version >= '1.1'
+                 else group['times'])[...]
+
+    # the times of each file, index giving the position of its last frame
+    ends = index + 1
+    starts = np.concatenate(([0], ends[:-1]))
+    bounds = {(f.decode('utf8') if isinstance(f, bytes) else f): (b, e)
+              for f, b, e in zip(files, starts, ends)}
+
+    counts = np.zeros(len(items), dtype=np.int64)
+    for i, (f, on, off) in enumerate(zip(
+            items['file'], items['onset'], items['offset'])):
+        start, end = bounds[str(f)]
+        t = times[start:end]
+        counts[i] = (np.searchsorted(t, off, side='right') -
+                     np.searchsorted(t, on, side='left'))
+    return counts
+
+
 class Features_Accessor(object):
 
     def __init__(self, times, features):
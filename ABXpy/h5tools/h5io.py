@@ -20,14 +20,21 @@ class H5IO(object):
     # H5IO('file.h5', {'talker1': 'talker', 'talker2': 'talker', 'language':
     # 'language', 'age1': None, 'age2': None}, {'talker': ['t1', 't2', 't3'],
     # 'language': ['French', 'English']}, {'talkers': ['talker1', 'talker2']})
+    # example call with run length encoded datasets, for which write expects
+    # one row per run and the length of the runs:
+    # H5IO('file.h5', ['talker', 'language'], {'talker': ['t1', 't2'],
+    # 'language': ['French', 'English']}, run_length=['language'])
 
-    def __init__(self, filename, datasets=None, indexes=None, fused=None, group='/'):
+    def __init__(self, filename, datasets=None, indexes=None, fused=None,
+                 group='/', run_length=None):
 
         # format and check inputs
         if indexes is None:
             indexes = {}
         if fused is None:
             fused = {}
+        if run_length is None:
+            run_length = []
         if datasets is not None:
             if isinstance(datasets, collections.abc.Mapping):
                 indexed_datasets = [
@@ -51,6 +58,15 @@ class H5IO(object):
                 if not(dset in indexed_datasets):
                     raise ValueError(
                         'Only datasets for which an index was provided can be fused.')
+            # check that all run length encoded datasets are indexed and
+            # not fused
+            for dset in run_length:
+                if not(dset in indexed_datasets) or dset in all_fused_dsets:
+                    raise ValueError(
+                        'Only indexed datasets which are not fused can be '
+                        'run length encoded.')
+            run_length = [dset for dset in indexed_datasets
+                          if dset in run_length]
 
         # create HDF5 file if it doesn't exist
         try:  # first check if file exists
@@ -97,6 +113,10 @@ class H5IO(object):
                     if non_fused:
                         g.create_dataset(
                             'non_fused_datasets', data=get_array(non_fused), dtype=str_dtype)
+                if run_length:
+                    g.create_dataset(
+                        'run_length_datasets', data=get_array(run_length),
+                        dtype=str_dtype)
                 # fused datasets
                 if fused:
                     g.create_dataset(
@@ -144,6 +164,11 @@ class H5IO(object):
                 self.non_fused_datasets = list(g['non_fused_datasets'][...])
             else:
                 self.non_fused_datasets = []
+            if 'run_length_datasets' in g:
+                self.run_length_datasets = list(
+                    g['run_length_datasets'][...])
+            else:
+                self.run_length_datasets = []
             if 'fused_datasets' in g:
                 self.fused_datasets = list(g['fused_datasets'][...])
                 self.fused_members = {}
@@ -181,12 +206,19 @@ class H5IO(object):
         finally:
             del self.np2h5
 
-    def write(self, data, append=True, iterate=False, indexed=False):
+    # run_lengths gives the number of rows of each run of the run length
+    # encoded datasets, which contain one row per run in data
+    def write(self, data, append=True, iterate=False, indexed=False,
+              run_lengths=None):
         if not(hasattr(self, 'np2h5')):
             raise RuntimeError(
                 "Writing to h5io objects must be done inside a context manager ('with' statemt)")
         if not(self.is_empty) and not(append):
             raise IOError('File %s is already filled' % self.filename)
+        if self.run_length_datasets and (run_lengths is None or iterate):
+            raise ValueError(
+                'The length of the runs of the run length encoded datasets '
+                'must be specified.')
         # if necessary, instantiate datasets
         if self.is_empty:
             if iterate:
@@ -214,7 +246,7 @@ class H5IO(object):
             for d in data:
                 self.__write__(d, indexed)
         else:
-            self.__write__(data, indexed)
+            self.__write__(data, indexed, run_lengths)
 
     def __parse_input_data__(self, data):
         if not(isinstance(data, collections.abc.Mapping)):
@@ -255,19 +287,31 @@ class H5IO(object):
             self.out[dset] = self.np2h5.add_dataset(group, dataset, n_columns=dims[dset], item_type=dtypes[
                                                     dset], fixed_size=False)  # FIXME at some point should become super.add_dataset(...)
         # init not fused indexed datasets, in this implementation they are all
-        # encoded in the same matrix
+        # encoded in the same matrix, except for the run length encoded ones
+        # which are encoded in a matrix with one row per run
         if self.non_fused_datasets:
             indexed_dims = [dims[dset] for dset in self.non_fused_datasets]
             indexed_levels = [len(self.indexes[dset])
                               for dset in self.non_fused_datasets]
             dim = sum(indexed_dims)
+            run_length_dim = sum(dims[dset]
+                                 for dset in self.run_length_datasets)
             # smallest unsigned integer dtype compatible with all
             # indexed_datasets
             d_type = type_fitting.fit_integer_type(
                 max(indexed_levels), is_signed=False)
             # FIXME at some point should become super.add_dataset(...)
-            self.out['indexed'] = self.np2h5.add_dataset(
-                self.group, 'indexed_data', n_columns=dim, item_type=d_type, fixed_size=False)
+            if dim > run_length_dim:
+                self.out['indexed'] = self.np2h5.add_dataset(
+                    self.group, 'indexed_data', n_columns=dim - run_length_dim,
+                    item_type=d_type, fixed_size=False)
+            if self.run_length_datasets:
+                self.out['run_length'] = self.np2h5.add_dataset(
+                    self.group, 'run_length_data', n_columns=run_length_dim,
+                    item_type=d_type, fixed_size=False)
+                self.out['run_lengths'] = self.np2h5.add_dataset(
+                    self.group, 'run_lengths', n_columns=1,
+                    item_type=np.int64, fixed_size=False)
             with h5py.File(self.filename, 'a') as f:
                 # necessary to access the part of the data corresponding to a
                 # particular dataset
@@ -296,7 +340,7 @@ class H5IO(object):
                 f[self.group]['fused'][fused_dset].create_dataset(
                     'key_weights', data=self.key_weights[fused_dset], dtype=d_type)
 
-    def __write__(self, data, indexed=False):
+    def __write__(self, data, indexed=False, run_lengths=None):
         data = self.__parse_input_data__(data)
         if not(indexed):
             data = self.__compute_indexes__(data)
@@ -308,9 +352,21 @@ class H5IO(object):
         # write indexed data
         if self.non_fused_datasets:
             # FIXME check that values are in correct range of index ?
-            indexed_values = [data[dset] for dset in self.non_fused_datasets]
+            indexed_values = [data[dset] for dset in self.non_fused_datasets
+                              if not(dset in self.run_length_datasets)]
             # need type conversion sometimes here?
-            self.out['indexed'].write(np.concatenate(indexed_values, axis=1))
+            if indexed_values:
+                self.out['indexed'].write(
+                    np.concatenate(indexed_values, axis=1))
+        # write run length encoded data, the empty runs are dropped
+        if self.run_length_datasets:
+            run_lengths = np.reshape(np.asarray(run_lengths, np.int64), -1)
+            kept = run_lengths > 0
+            run_values = [data[dset][kept]
+                          for dset in self.non_fused_datasets
+                          if dset in self.run_length_datasets]
+            self.out['run_length'].write(np.concatenate(run_values, axis=1))
+            self.out['run_lengths'].write(run_lengths[kept, None])
         # write fused data
         for fused_dset in self.fused_datasets:
             keys = self.__compute_keys__(fused_dset, np.concatenate(
@@ -342,6 +398,35 @@ class H5IO(object):
         pass
 
 
+def read_indexed(group, start=0, stop=None):
+    """Read the rows start to stop of the indexed data of a group
+
+    The columns are the ones of the non fused indexed datasets, in the
+    order of 'non_fused_datasets' (see 'indexed_cumudims'), the run
+    length encoded datasets being expanded to one value per row.
+
+    """
+    if not('run_length_datasets' in group):
+        return group['indexed_data'][start:stop]
+
+    ends = np.cumsum(group['run_lengths'][:, 0])
+    n_rows = ends[-1] if len(ends) else 0
+    stop = n_rows if stop is None else min(stop, n_rows)
+    runs = np.searchsorted(ends, np.arange(start, stop), side='right')
+
+    run_length = set(group['run_length_datasets'][...])
+    dims = np.diff(np.concatenate(
+        ([0], group['indexed_cumudims'][...].astype(np.int64))))
+    is_run = np.repeat([dset in run_length
+                        for dset in group['non_fused_datasets'][...]], dims)
+    run_data = group['run_length_data'][...]
+    rows = np.empty((len(runs), len(is_run)), dtype=run_data.dtype)
+    rows[:, is_run] = run_data[runs]
+    if not(np.all(is_run)):
+        rows[:, ~is_run] = group['indexed_data'][start:stop]
+    return rows
+
+
 # auxiliary function for determining dtype, strings (unicode or not) are
 # always encoded with a variable length dtype, thus it should be more
 # efficient in general to index string outputs, it's actually mandatory
@@ -0,0 +1,352 @@
+"""Compact storage of the 'by' blocks of a task
+
+The items of all the 'by' blocks of a task are stored in tables shared
+by all the blocks, sorted by block, instead of one table or dict of
+arrays by block. Each block is described by a Block, giving its
+position and the bounds of its items in the shared tables, and the
+mappings of this module (BlockFrames, BlockArrays, BlockStats...) give
+the items, codes and statistics of a block from these tables when it
+is accessed, as the dicts they replace in Task.
+
+A block can also be given explicitly (for instance a 'by' block whose
+items are filtered by a generic filter), it is then returned as it is.
+
+"""
+
+from collections.abc import Mapping, MutableMapping
+
+import numpy as np
+import pandas as pd
+
+
+class Block(object):
+    """Position of a 'by' block in shared tables
+
+    Parameters
+    ----------
+    position : int
+        the position of the block in the blocks of the tables
+    start, stop : int
+        the bounds of the items of the block in the tables
+
+    """
+    __slots__ = ('position', 'start', 'stop')
+
+    def __init__(self, position, start, stop):
+        self.position = position
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __repr__(self):
+        return 'Block({}, {}, {})'.format(
+            self.position, self.start, self.stop)
+
+
+class BlockMapping(MutableMapping):
+    """Mapping of the 'by' blocks to values built from shared tables
+
+    The value of a block added with add is built by build when
+    accessed. If cached is True, the last built value is kept, so that
+    the successive accesses to a block return the same object. The
+    values set explicitly are returned as they are.
+
+    """
+    cached = False
+
+    def __init__(self):
+        self._entries = {}
+        self._last = None
+
+    def add(self, key, block):
+        """Add a block stored in the shared tables"""
+        self._entries[key] = block
+
+    def block(self, key):
+        """The Block of key, None if its value is explicit"""
+        entry = self._entries[key]
+        return entry if isinstance(entry, Block) else None
+
+    def build(self, block):
+        """The value of a Block"""
+        raise NotImplementedError
+
+    def __getitem__(self, key):
+        entry = self._entries[key]
+        if not isinstance(entry, Block):
+            return entry
+        if self._last is not None and self._last[0] is entry:
+            return self._last[1]
+        value = self.build(entry)
+        if self.cached:
+            self._last = (entry, value)
+        return value
+
+    def __setitem__(self, key, value):
+        self._entries[key] = value
+
+    def __delitem__(self, key):
+        del self._entries[key]
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class BlockFrames(BlockMapping):
+    """The frames of the items of the 'by' blocks
+
+    Parameters
+    ----------
+    table : pandas.DataFrame
+        the items of all the blocks, sorted by block
+
+    The frame of a block is a copy of its rows of the table, indexed
+    from 0.
+
+    """
+    cached = True
+
+    def __init__(self, table):
+        BlockMapping.__init__(self)
+        self.table = table
+
+    def build(self, block):
+        frame = self.table.iloc[block.start:block.stop].copy()
+        frame.index = pd.RangeIndex(len(block))
+        return frame
+
+    def concat(self, columns):
+        """Concatenate some columns of the frames of all the blocks
+
+        The rows are indexed by their index in their frame ('#item'),
+        the position of their block being in the '#block' column.
+
+        """
+        blocks = list(self._entries.values())
+        if not all(isinstance(block, Block) for block in blocks):
+            return pd.concat(
+                [frame[columns] for frame in self.values()],
+                keys=range(len(self)),
+                names=['#block', '#item']).reset_index(level='#block')
+
+        starts = np.array([block.start for block in blocks], dtype=np.int64)
+        lengths = np.array([len(block) for block in blocks], dtype=np.int64)
+        index = np.arange(np.sum(lengths)) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths)
+        frame = self.table[columns].take(np.repeat(starts, lengths) + index)
+        frame.index = pd.Index(index, name='#item')
+        frame.insert(0, '#block', np.repeat(np.arange(len(blocks)), lengths))
+        return frame
+
+
+class BlockArrays(BlockMapping):
+    """Dicts of arrays of the 'by' blocks
+
+    Parameters
+    ----------
+    arrays : dict
+        the arrays of all the blocks by name, as (data, bounds) with
+        data[bounds[i]:bounds[i + 1]] the array of the block at
+        position i
+
+    The value of a block is a dict of views on the arrays.
+
+    """
+    def __init__(self, arrays):
+        BlockMapping.__init__(self)
+        self.arrays = arrays
+
+    def build(self, block):
+        i = block.position
+        return {name: data[bounds[i]:bounds[i + 1]]
+                for name, (data, bounds) in self.arrays.items()}
+
+
+class BlockAcrossIndex(BlockArrays):
+    """Inverted indexes of the across columns of the 'by' blocks
+
+    The arrays are the codes of the items in the across columns
+    ('codes', one column by across column) and for each across column
+    i the items sorted by code ('members<i>') and the offsets of each
+    code ('offsets<i>'). The value of a block is a dict of its 'codes'
+    and of the (members, offsets) of each across column ('members').
+
+    """
+    def build(self, block):
+        arrays = BlockArrays.build(self, block)
+        return {
+            'codes': arrays['codes'],
+            'members': [
+                (arrays['members{}'.format(i)], arrays['offsets{}'.format(i)])
+                for i in range(arrays['codes'].shape[1])]}
+
+
+class BlockStats(BlockMapping):
+    """Statistics of the 'by' blocks computed for all the blocks at once
+
+    Parameters
+    ----------
+    keys : list
+        the 'by' blocks, in the order of the statistics
+    scalars : dict
+        a scalar statistic of each block, by name
+    levels : dict
+        the number of items of the on, across and on/across levels of
+        all the blocks, as Series indexed by the position of the block
+        ('#block') and the level, sorted by block
+    block_sizes : array
+        the number of triplets of each on/across level, in the order
+        of levels['on_across_levels']
+
+    The statistics of a block are a BlockStatsEntry, built from these
+    arrays when accessed.
+
+    """
+    cached = True
+
+    def __init__(self, keys, scalars, levels, block_sizes):
+        BlockMapping.__init__(self)
+        self.scalars = scalars
+        self.levels = levels
+        self.block_sizes = block_sizes
+        self.bounds = {
+            name: np.searchsorted(
+                series.index.get_level_values('#block'),
+                np.arange(len(keys) + 1))
+            for name, series in levels.items()}
+        # the statistics set on the entries, by block position
+        self.extra = {}
+        for i, key in enumerate(keys):
+            self.add(key, Block(i, 0, 0))
+
+    def build(self, block):
+        return BlockStatsEntry(self, block.position)
+
+    def value(self, position, name):
+        """A statistic of the block at position"""
+        if name in self.scalars:
+            return int(self.scalars[name][position])
+        if name == 'block_sizes':
+            bounds = self.bounds['on_across_levels']
+            return dict(zip(
+                self.value(position, 'on_across_levels').index,
+                self.block_sizes[bounds[position]:bounds[position + 1]]))
+        if name.startswith('nb_') and name[3:] in self.levels:
+            bounds = self.bounds[name[3:]]
+            return int(bounds[position + 1] - bounds[position])
+        if name in self.levels:
+            bounds = self.bounds[name]
+            return self.levels[name].iloc[
+                bounds[position]:bounds[position + 1]].droplevel('#block')
+        raise KeyError(name)
+
+
+class BlockStatsEntry(MutableMapping):
+    """The statistics of a 'by' block stored in a BlockStats
+
+    The statistics are built when first accessed. The statistics set
+    on the entry are stored in the BlockStats.
+
+    """
+    __slots__ = ('stats', 'position', 'values')
+
+    NAMES = ['nb_items', 'on_levels', 'nb_on_levels', 'across_levels',
+             'nb_across_levels', 'on_across_levels', 'nb_on_across_levels',
+             'block_sizes', 'nb_triplets', 'nb_across_pairs', 'nb_on_pairs']
+
+    def __init__(self, stats, position):
+        self.stats = stats
+        self.position = position
+        self.values = {}
+
+    def _extra(self):
+        return self.stats.extra.get(self.position, {})
+
+    def __getitem__(self, name):
+        extra = self._extra()
+        if name in extra:
+            return extra[name]
+        if name not in self.values:
+            self.values[name] = self.stats.value(self.position, name)
+        return self.values[name]
+
+    def __setitem__(self, name, value):
+        self.stats.extra.setdefault(self.position, {})[name] = value
+
+    def __delitem__(self, name):
+        del self.stats.extra[self.position][name]
+
+    def __contains__(self, name):
+        return name in self.NAMES or name in self._extra()
+
+    def __iter__(self):
+        extra = self._extra()
+        return iter(self.NAMES + [name for name in extra
+                                  if name not in self.NAMES])
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class BlockGroups(Mapping):
+    """GroupBy objects of the items of the 'by' blocks on columns
+
+    The GroupBy object of a 'by' block is created when accessed, only
+    the last one is kept.
+
+    Parameters
+    ----------
+    by_dbs : dict
+        the items of each 'by' block
+    columns : list
+        the columns on which the items are grouped
+
+    """
+    def __init__(self, by_dbs, columns):
+        self.by_dbs = by_dbs
+        self.columns = columns
+        self._last = None
+
+    def __getitem__(self, by):
+        if self._last is None or self._last[0] != by:
+            self._last = (by, self.by_dbs[by].groupby(self.columns))
+        return self._last[1]
+
+    def __iter__(self):
+        return iter(self.by_dbs)
+
+    def __len__(self):
+        return len(self.by_dbs)
+
+
+class AttributeTable(object):
+    """The values of the columns of a frame by row
+
+    row(i) is dict(frame.iloc[i]) and loc(label) is
+    dict(frame.loc[label]), without building a Series for each row.
+
+    """
+    __slots__ = ('columns', 'values', 'index')
+
+    def __init__(self, frame):
+        self.columns = list(frame.columns)
+        self.values = [frame[column].values for column in self.columns]
+        self.index = frame.index
+
+    def row(self, position):
+        return {column: values[position]
+                for column, values in zip(self.columns, self.values)}
+
+    def loc(self, label):
+        return self.row(self.index.get_loc(label))
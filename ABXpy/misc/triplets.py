@@ -0,0 +1,218 @@
+"""Read the triplets of a task file
+
+The triplets of a 'by' block are either stored explicitly in the
+'triplets/data' dataset of the task file, or factorized as the A, B
+and X candidates of each on/across block when the task was generated
+with factorized=True (see `Files format <FilesFormat.html>`_). The
+functions of this module give the triplets of a 'by' block, and their
+regressors, by chunks and in the same order for both layouts.
+
+"""
+
+import numpy as np
+
+from ABXpy.h5tools.h5io import read_indexed
+
+
+# default number of triplets in a chunk
+CHUNK_SIZE = 1000000
+
+# name of the 'by' block of the pairs of a TaskSet file, see
+# ABXpy.taskset
+SHARED_PAIRS = 'all'
+
+
+def task_group(taskfid, task=None):
+    """Return the group of a task in an opened task file
+
+    A task file contains a single task, at its root. A TaskSet file
+    (see ABXpy.taskset) contains several tasks, each one in the
+    'tasks/<task>' group.
+
+    """
+    if task is None:
+        return taskfid
+    if 'tasks' not in taskfid or task not in taskfid['tasks']:
+        raise ValueError('No task {} in the task file {}'.format(
+            task, taskfid.filename))
+    return taskfid['tasks'][task]
+
+
+def read_items(group, n_by):
+    """Position of the items of a 'by' block in the items of a TaskSet
+
+    group is the group of a task of a TaskSet file. The i-th item of
+    the n_by-th 'by' block of the task is the item items[i] of the
+    shared pairs of the TaskSet.
+
+    """
+    start, stop = group['items/by_index'][n_by]
+    return group['items/data'][start:stop]
+
+
+def is_factorized(taskfid):
+    """Return True if the triplets of an opened task file are factorized"""
+    return bool(taskfid['triplets'].attrs.get('factorized', False))
+
+
+def n_triplets(taskfid):
+    """Return the total number of triplets of an opened task file"""
+    by_index = taskfid['triplets/by_index'][...]
+    return int(by_index[-1, 1]) if by_index.shape[0] else 0
+
+
+def is_symmetric(taskfid):
+    """Return True if the pairs of an opened task file are symmetric
+
+    In that case the pairs (i, j) and (j, i) share the same key (see
+    pair_keys) and are computed only once.
+
+    """
+    return bool(taskfid['unique_pairs/data'].attrs.get('symmetric', False))
+
+
+def pair_keys(A, X, base, symmetric=False):
+    """Encode the pairs (A, X) of items of a 'by' block
+
+    The key of a pair is A + base * X, or min(A, X) + base * max(A, X)
+    when symmetric is True. A and X must be of an unsigned integer type
+    able to store base ** 2 - 1.
+
+    """
+    if symmetric:
+        A, X = np.minimum(A, X), np.maximum(A, X)
+    return A + A.dtype.type(base) * X
+
+
+def read_hashes(taskfid):
+    """Return the hashes used to update an opened task file
+
+    Returns the hash of the task and a dict mapping each 'by' block to
+    the hash of its items, or (None, {}) if the task file does not
+    store them.
+
+    """
+    if 'by_hashes' not in taskfid:
+        return None, {}
+    hashes = dict(zip(taskfid['bys'][...], taskfid['by_hashes'][...]))
+    return taskfid.attrs['task_hash'], hashes
+
+
+def block_indices(indices, n_A, n_B, n_X):
+    """Positions in A, B and X of the triplets of a factorized block
+
+    The triplets of a block are enumerated with A varying the slowest
+    and X the fastest. n_A, n_B and n_X can be arrays with the size of
+    the block of each triplet.
+
+    """
+    iX = np.mod(indices, n_X)
+    iB = np.mod(np.floor_divide(indices, n_X), n_B)
+    iA = np.floor_divide(indices, n_B * n_X)
+    return iA, iB, iX
+
+
+def read_triplets(taskfid, n_by, chunk_size=CHUNK_SIZE):
+    """Yields the triplets of the n_by-th 'by' block by chunks"""
+    if not is_factorized(taskfid):
+        start, stop = taskfid['triplets/by_index'][n_by]
+        for i in range(start, stop, chunk_size):
+            yield taskfid['triplets/data'][i:min(i + chunk_size, stop)]
+    else:
+        items, blocks = read_blocks(taskfid, n_by)
+        for pA, pB, pX in _positions(blocks, chunk_size):
+            yield np.column_stack((items[pA], items[pB], items[pX]))
+
+
+def read_regressors(taskfid, by, n_by, chunk_size=CHUNK_SIZE):
+    """Yields the indexed regressors of the triplets of a 'by' block
+
+    The chunks are aligned with the ones of read_triplets.
+
+    """
+    group = taskfid['regressors'][by]
+    if not is_factorized(taskfid):
+        start, stop = taskfid['triplets/by_index'][n_by]
+        for i in range(0, stop - start, chunk_size):
+            yield read_indexed(group, i, min(i + chunk_size, stop - start))
+    else:
+        # in a factorized task file, the regressors are stored for each
+        # A, B and X candidates and the role of a regressor tells if it
+        # must be read on the A, B or X item of the triplet
+        data = read_indexed(group)
+        roles = taskfid['regressors'][by]['roles'][...]
+        _, blocks = read_blocks(taskfid, n_by)
+        for positions in _positions(blocks, chunk_size):
+            regressors = data[positions[0]]
+            for role in (1, 2):
+                regressors[:, roles == role] = (
+                    data[positions[role]][:, roles == role])
+            yield regressors
+
+
+def read_blocks(taskfid, n_by):
+    """Load the candidates and the blocks of a factorized 'by' block
+
+    Returns the A, B and X candidates of the on/across blocks, one
+    after the other, and for each on/across block the position of its
+    first candidate and its numbers of A, B and X candidates.
+
+    """
+    start, stop = taskfid['triplets/by_block_index'][n_by]
+    blocks = taskfid['triplets/blocks'][start:stop].astype(np.int64)
+    first = blocks[0, 0]
+    last = blocks[-1, 0] + np.sum(blocks[-1, 1:])
+    blocks[:, 0] -= first
+    return taskfid['triplets/items'][first:last, 0], blocks
+
+
+def read_triplets_at(taskfid, n_by, positions):
+    """Return the triplets of the n_by-th 'by' block at some positions
+
+    positions are positions in the triplets of the 'by' block, in the
+    order of read_triplets. Only the triplets at these positions are
+    read from 'triplets/data', the candidates of a factorized 'by'
+    block being read entirely.
+
+    """
+    unique, inverse = np.unique(
+        np.asarray(positions, dtype=np.int64), return_inverse=True)
+    if len(unique) == 0:
+        return np.empty((0, 3), dtype=np.int64)
+    if not is_factorized(taskfid):
+        start, _ = taskfid['triplets/by_index'][n_by]
+        # h5py reads increasing positions only
+        triplets = taskfid['triplets/data'][list(start + unique)]
+    else:
+        items, blocks = read_blocks(taskfid, n_by)
+        pA, pB, pX = _candidates(blocks, _offsets(blocks), unique)
+        triplets = np.column_stack((items[pA], items[pB], items[pX]))
+    return triplets[inverse]
+
+
+def _offsets(blocks):
+    """Position of the first triplet of each on/across block"""
+    sizes = blocks[:, 1] * blocks[:, 2] * blocks[:, 3]
+    return np.concatenate(([0], np.cumsum(sizes)))
+
+
+def _candidates(blocks, offsets, indices):
+    """Positions of the A, B and X candidates of some triplets"""
+    block = np.searchsorted(offsets, indices, side='right') - 1
+    first, n_A, n_B, n_X = (blocks[block, i] for i in range(4))
+    iA, iB, iX = block_indices(indices - offsets[block], n_A, n_B, n_X)
+    return first + iA, first + n_A + iB, first + n_A + n_B + iX
+
+
+def _positions(blocks, chunk_size):
+    """Yields the positions of the A, B and X candidates of the triplets
+
+    blocks contains, for each on/across block, the position of its
+    first candidate and its numbers of A, B and X candidates.
+
+    """
+    offsets = _offsets(blocks)
+    for start in range(0, offsets[-1], chunk_size):
+        indices = np.arange(
+            start, min(start + chunk_size, offsets[-1]), dtype=np.int64)
+        yield _candidates(blocks, offsets, indices)
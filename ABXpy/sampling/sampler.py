@@ -4,6 +4,11 @@ Incremental meaning that you don't have to draw the whole sample at
 once, instead at any given time you can get a piece of the sample of a
 size you specify. This is useful for very large sample sizes.
 
+All the sampling functions draw their random numbers from a
+numpy.random.Generator given by their rng argument, so that the
+samples only depend on the state of this generator (see
+get_generator).
+
 """
 
 import numpy as np
@@ -32,8 +37,9 @@ class IncrementalSampler(object):
     # sampling K sample in a a population of size N
     # both K and N can be very large
     def __init__(self, N, K, step=None, relative_indexing=True,
-                 dtype=np.int64):
+                 dtype=np.int64, rng=None):
         assert K <= N
+        self.rng = get_generator(rng)
         self.N = N  # remaining items to sample from
         self.K = K  # remaining items to be sampled
         self.initial_N = N
@@ -83,17 +89,22 @@ class IncrementalSampler(object):
             n = self.N
 
         # expected number of sampled items
-        expected_k = n * self.K / np.float(self.N)
+        expected_k = n * self.K / np.float64(self.N)
         if expected_k > 10 ** 5:
-            sample = []
-            chunk_size = int(np.floor(10 ** 5 * self.N / np.float(self.K)))
-            i = 0
-            while n > 0:
-                amount = min(chunk_size, n)
-                sample.append(self.simple_sample(amount) + i * chunk_size)
-                n = n - amount
-                i += 1
-            sample = np.concatenate(sample)
+            # the sizes of the samples of all the chunks are drawn at once
+            chunk_size = int(np.floor(10 ** 5 * self.N / np.float64(self.K)))
+            chunks = [chunk_size] * (n // chunk_size)
+            if n % chunk_size:
+                chunks.append(n % chunk_size)
+            ks = hypergeometric_split(
+                self.K, chunks + [self.N - n], rng=self.rng)[:-1]
+            sample = np.concatenate(
+                [sample_without_replacement(
+                    k, amount, self.type, rng=self.rng) +
+                 i * chunk_size
+                 for i, (k, amount) in enumerate(zip(ks, chunks))])
+            self.N = self.N - n
+            self.K = self.K - np.sum(ks)
         else:
             sample = self.simple_sample(n)
 
@@ -115,13 +126,110 @@ class IncrementalSampler(object):
             the indices to be kept relative to the current position
             in the sample
         """
-        k = hypergeometric_sample(self.N, self.K, n)  # get the sample size
-        sample = sample_without_replacement(k, n, self.type)
+        # get the sample size
+        k = hypergeometric_sample(self.N, self.K, n, rng=self.rng)
+        sample = sample_without_replacement(k, n, self.type, rng=self.rng)
         self.N = self.N - n
         self.K = self.K - k
         return sample
 
 
+def get_generator(rng=None):
+    """Returns the random generator to use for sampling
+
+    rng is either a numpy.random.Generator, returned as is, or None in
+    which case a new generator seeded from the global numpy random
+    state is returned (so that np.random.seed still makes the samples
+    reproducible).
+
+    """
+    if rng is None:
+        rng = np.random.default_rng(np.random.randint(2 ** 63 - 1))
+    return rng
+
+
+# populations up to this size are handled by Generator.hypergeometric,
+# whose precision is only documented for populations below 10 ** 9,
+# larger ones by HRUA_hypergeometric_sample
+MAX_NUMPY_HYPERGEOMETRIC = 10 ** 9
+
+
+def hypergeometric_sample(N, K, n, rng=None):
+    """This function return the number of elements to sample from the next n
+    items.
+    """
+    if n >= N:
+        return K
+    if n <= 0 or K <= 0:
+        return 0
+    rng = get_generator(rng)
+    if N < MAX_NUMPY_HYPERGEOMETRIC:
+        return int(rng.hypergeometric(K, N - K, n))
+    return HRUA_hypergeometric_sample(N, K, n, rng=rng)
+
+
+def hypergeometric_samples(N, K, n, rng=None):
+    """Vectorized hypergeometric_sample
+
+    N, K and n are arrays (or scalars) of the same shape, returns the
+    number of elements to sample from the next n[i] items when K[i]
+    items are sampled among N[i], for each i, in a few numpy calls.
+
+    """
+    N, K, n = np.broadcast_arrays(
+        np.asarray(N, dtype=np.int64), np.asarray(K, dtype=np.int64),
+        np.asarray(n, dtype=np.int64))
+    rng = get_generator(rng)
+    k = np.zeros(N.shape, dtype=np.int64)
+    # the edge cases are deterministic
+    k[n >= N] = K[n >= N]
+    draw = (n > 0) & (n < N) & (K > 0)
+    small = draw & (N < MAX_NUMPY_HYPERGEOMETRIC)
+    if np.any(small):
+        k[small] = rng.hypergeometric(
+            K[small], N[small] - K[small], n[small])
+    for i in np.flatnonzero(draw & ~small):
+        k.flat[i] = HRUA_hypergeometric_sample(
+            N.flat[i], K.flat[i], n.flat[i], rng=rng)
+    return k
+
+
+def hypergeometric_split(K, sizes, rng=None):
+    """Split a sample among consecutive chunks of a population
+
+    The population is made of consecutive chunks of the given sizes
+    and K of its items are sampled uniformly without replacement.
+    Returns the number of sampled items in each chunk (a multivariate
+    hypergeometric draw), as would be obtained by successive calls to
+    hypergeometric_sample. The chunks are recursively split in halves,
+    the draws of each level being done in a single vectorized call.
+
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    ends = np.concatenate(([0], np.cumsum(sizes)))
+    if len(sizes) == 0:
+        return sizes
+    rng = get_generator(rng)
+    # segments [start, stop) of chunks with the number of sampled items
+    # falling in them
+    start = np.array([0])
+    stop = np.array([len(sizes)])
+    counts = np.array([K], dtype=np.int64)
+    while np.any(stop - start > 1):
+        split = stop - start > 1
+        middle = (start + stop) // 2
+        left = hypergeometric_samples(
+            ends[stop[split]] - ends[start[split]], counts[split],
+            ends[middle[split]] - ends[start[split]], rng=rng)
+        start = np.concatenate((start[~split], start[split], middle[split]))
+        stop = np.concatenate((stop[~split], middle[split], stop[split]))
+        counts = np.concatenate(
+            (counts[~split], left, counts[split] - left))
+    k = np.empty(len(sizes), dtype=np.int64)
+    k[start] = counts
+    return k
+
+
 # function np.random.hypergeometric is buggy so I did my own
 # implementation...  (error, at least, line 784 in computation of
 # variance: sample used instead of m, but this can't be all of it ?)
@@ -133,10 +241,12 @@ class IncrementalSampler(object):
 # samples in particular but also generally)
 # seems at worse to require comparable execution time when compared to the
 # actual rejection sampling, so probably not going to be so bad all in all
-def hypergeometric_sample(N, K, n):
-    """This function return the number of elements to sample from the next n
-    items.
-    """
+#
+# FIXME the bug above was fixed in numpy long ago, this implementation
+# is now only used for populations larger than MAX_NUMPY_HYPERGEOMETRIC
+def HRUA_hypergeometric_sample(N, K, n, rng=None):
+    """Pure python hypergeometric_sample, for very large populations"""
+    rng = get_generator(rng)
     # handling edge cases
     if N == 0 or N == 1:
         k = K
@@ -166,8 +276,8 @@ def hypergeometric_sample(N, K, n):
             min(n_eff, K_eff) + 1, np.floor(a + 16 * np.sqrt(variance + 0.5)))
 
         while True:
-            U = np.random.rand()
-            V = np.random.rand()
+            U = rng.random()
+            V = rng.random()
             k = np.int64(np.floor(a + b * (V - 0.5) / U))
             if k < 0 or k >= upper_bound:
                 continue
@@ -193,61 +303,95 @@ def hypergeometric_sample(N, K, n):
 
 
 # returns uniform samples in [0, N-1] without replacement the values
-# 0.6 and 100 are based on empirical tests of the functions and would
+# 0.35 and 10000 are based on empirical tests of the functions and would
 # need to be changed if the functions are changed
-def sample_without_replacement(n, N, dtype=np.int64):
+def sample_without_replacement(n, N, dtype=np.int64, rng=None):
     """Returns uniform samples in [0, N-1] without replacement. It will use
     Knuth sampling or rejection sampling depending on the parameters n and N.
 
     .. note::
 
-        the values 0.6 and 100 are based on empirical tests of the
+        the values 0.35 and 10000 are based on empirical tests of the
         functions and would need to be changed if the functions are
         changed
 
     """
-    if N > 100 and n / float(N) < 0.6:
-        sample = rejection_sampling(n, N, dtype)
+    if N > 10000 and n / float(N) < 0.35:
+        sample = rejection_sampling(n, N, dtype, rng=rng)
     else:
-        sample = Knuth_sampling(n, N, dtype)
+        sample = Knuth_sampling(n, N, dtype, rng=rng)
     return sample
 
 
-# this one would benefit a lot from being cythonized, efficient if n
-# close to N (np.random.choice with replace=False is cythonized and
-# similar in spirit but not better because it shuffles the whole array
-# of size N which is wasteful; once cythonized Knuth_sampling should
-# be superior to it in all situation)
-def Knuth_sampling(n, N, dtype=np.int64):
-    """This is the usual sampling function when n is comparable to N"""
+def Knuth_sampling(n, N, dtype=np.int64, rng=None):
+    """This is the usual sampling function when n is comparable to N
+
+    Instead of Knuth's selection sampling loop, which draws a random
+    number per element in python, a random key is drawn for each of
+    the N elements at once and the elements with the n smallest keys
+    are selected, which gives the same uniform distribution over the
+    subsets of size n. The sample is sorted.
+
+    """
     n = int(n)
+    if n == 0:
+        return np.empty(shape=0, dtype=dtype)
+    if n >= N:
+        return np.arange(N, dtype=dtype)
+    keys = get_generator(rng).random(int(N))
+    return np.sort(np.argpartition(keys, n - 1)[:n]).astype(dtype)
 
-    t = 0  # total input records dealt with
-    m = 0  # number of items selected so far
-    sample = np.zeros(shape=n, dtype=dtype)
-    while m < n:
-        u = np.random.rand()
-        if (N - t) * u < n - m:
-            sample[m] = t
-            m = m + 1
-        t = t + 1
-    return sample
 
+def rejection_sampling(n, N, dtype=np.int64, rng=None):
+    """Using rejection sampling to keep a good performance if n << N
+
+    Enough elements are drawn with replacement at once to get slightly
+    more than n distinct ones on average, the draw being repeated for
+    the missing elements if needed. The excess distinct elements are
+    then removed uniformly: the set of the distinct drawn elements is
+    invariant by permutation of [0, N-1], so the remaining subset is
+    uniform. The sample is sorted.
 
-# maybe use array for the first iteration then use python native sets
-# for faster set operations ?
-def rejection_sampling(n, N, dtype=np.int64):
-    """Using rejection sampling to keep a good performance if n << N"""
-    remaining = n
+    """
+    n = int(n)
+    rng = get_generator(rng)
     sample = np.array([], dtype=dtype)
-    while remaining > 0:
-        new_sample = np.random.randint(0, int(N), int(remaining)).astype(dtype)
-        # keeping only unique element:
-        sample = np.union1d(sample, np.unique(new_sample))
-        remaining = n - sample.shape[0]
+    while sample.shape[0] < n:
+        missing = n - sample.shape[0]
+        remaining = N - sample.shape[0]
+        # number of draws giving on average the missing distinct
+        # elements, with a margin of a few standard deviations
+        target = min(missing + 3 * np.sqrt(missing) + 10, remaining - 1)
+        draws = int(np.ceil(-remaining * np.log1p(-target / remaining)))
+        new_sample = rng.integers(0, int(N), draws).astype(dtype)
+        sample = np.union1d(sample, new_sample)
+    excess = sample.shape[0] - n
+    if excess > 0:
+        sample = np.delete(
+            sample,
+            sample_without_replacement(excess, sample.shape[0], rng=rng))
     return sample
 
 
+def sample_groups(offsets, fraction, rng=None):
+    """Sample a fraction of each group of elements without replacement
+
+    The elements of group i are the positions offsets[i] to
+    offsets[i + 1] - 1 of an array. ceil(fraction * n) elements are
+    sampled in a group of n elements, so that each non-empty group
+    keeps at least one element. Returns the sorted sampled positions.
+
+    """
+    rng = get_generator(rng)
+    sample = [np.empty(shape=0, dtype=np.int64)]
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        n = int(math.ceil(fraction * (end - start)))
+        sample.append(
+            start + np.sort(sample_without_replacement(
+                n, end - start, rng=rng)))
+    return np.concatenate(sample)
+
+
 # Profiling hypergeometric sampling + sampling without replacement together:
 
 # ChunkSize
@@ -43,12 +43,13 @@ import h5py
 import numpy as np
 import os
 
-import ABXpy.h5tools.h52np as h52np
+import ABXpy.misc.triplets as triplets_io
 import ABXpy.misc.type_fitting as type_fitting
 
 
 # FIXME: include distance computation here
-def score(task_file, distance_file, score_file=None, score_group='scores'):
+def score(task_file, distance_file, score_file=None, score_group='scores',
+          task=None):
     """Calculate the score of a task and put the results in a hdf5 file.
 
     Parameters
@@ -60,6 +61,9 @@ def score(task_file, distance_file, score_file=None, score_group='scores'):
         The hdf5 file containing the distances between the pairs
     score_file : string, optional
         The hdf5 file that will contain the results
+    task : string, optional
+        The name of the task to score when task_file is a TaskSet file
+        (see ABXpy.taskset), whose pairs are shared by its tasks
     """
     if score_file is None:
         (basename_task, _) = os.path.splitext(task_file)
@@ -75,38 +79,52 @@ def score(task_file, distance_file, score_file=None, score_group='scores'):
     #     bys = [by for by in t['triplets']]
     # FIXME skip empty by datasets, this should not be necessary anymore when
     # empty datasets are filtered at the task file generation level
-    with h5py.File(task_file, 'r') as t:
+    with h5py.File(task_file, 'r') as fid:
+        t = triplets_io.task_group(fid, task)
         bys = t['bys'][...]
         # bys = t['feat_dbs'].keys()
-        n_triplets = t['triplets']['data'].shape[0]
+        n_triplets = triplets_io.n_triplets(t)
+        symmetric = triplets_io.is_symmetric(fid)
+    # the pairs of the distance file must be encoded as in the task file
+    with h5py.File(distance_file, 'r') as d:
+        if bool(d.attrs.get('symmetric_pairs', False)) != symmetric:
+            raise ValueError(
+                'The distance file {} was not computed on the pairs of '
+                'the task file {} (symmetric pairs mismatch)'
+                .format(distance_file, task_file))
     with h5py.File(score_file, 'w') as s:
         s.create_dataset('scores', (n_triplets, 1), dtype=np.int8)
         for n_by, by in enumerate(bys):
-            with h5py.File(task_file, 'r') as t, h5py.File(distance_file, 'r') as d:
+            with h5py.File(task_file, 'r') as fid, h5py.File(distance_file, 'r') as d:
+                t = triplets_io.task_group(fid, task)
                 trip_attrs = t['triplets']['by_index'][n_by]
-                pair_attrs = t['unique_pairs'].attrs[by]
-                # FIXME here we make the assumption
-                # that this fits into memory ...
-                dis = d['distances']['data'][pair_attrs[1]:pair_attrs[2]][...]
-                dis = np.reshape(dis, dis.shape[0])
-                # FIXME idem + only unique_pairs used ?
-                pairs = t['unique_pairs']['data'][pair_attrs[1]:pair_attrs[2]][...]
-                pairs = np.reshape(pairs, pairs.shape[0])
-                base = pair_attrs[0]
+                # the pairs of the tasks of a TaskSet are shared and
+                # indexed by the items of the TaskSet
+                if task is None:
+                    items = None
+                    pairs, dis, base = _read_pairs(fid, d, by)
+                else:
+                    items = triplets_io.read_items(t, n_by)
+                    if n_by == 0:
+                        pairs, dis, base = _read_pairs(
+                            fid, d, triplets_io.SHARED_PAIRS)
                 pair_key_type = type_fitting.fit_integer_type((base) ** 2 - 1,
                                                               is_signed=False)
-            with h52np.H52NP(task_file) as t:
-                inp = t.add_subdataset('triplets', 'data', indexes=trip_attrs)
+            with h5py.File(task_file, 'r') as fid:
+                t = triplets_io.task_group(fid, task)
+                # the triplets are enumerated by chunks, whether they are
+                # stored explicitly or factorized
                 idx_start = trip_attrs[0]
-                for triplets in inp:
+                for triplets in triplets_io.read_triplets(t, n_by):
+                    if items is not None:
+                        triplets = items[triplets]
                     triplets = pair_key_type(triplets)
                     idx_end = idx_start + triplets.shape[0]
 
-                    pairs_AX = triplets[:, 0] + base * triplets[:, 2]
-                    # FIXME change the encoding (and type_fitting) so that
-                    # A,B and B,A have the same code ... (take a=min(a,b),
-                    # b=max(a,b))
-                    pairs_BX = triplets[:, 1] + base * triplets[:, 2]
+                    pairs_AX = triplets_io.pair_keys(
+                        triplets[:, 0], triplets[:, 2], base, symmetric)
+                    pairs_BX = triplets_io.pair_keys(
+                        triplets[:, 1], triplets[:, 2], base, symmetric)
                     dis_AX = dis[np.searchsorted(pairs, pairs_AX)]
 
                     dis_BX = dis[np.searchsorted(pairs, pairs_BX)]
@@ -119,28 +137,44 @@ def score(task_file, distance_file, score_file=None, score_group='scores'):
                     idx_start = idx_end
 
 
+def _read_pairs(taskfid, distancefid, by):
+    """Load the unique pairs of a 'by' block and their distances"""
+    pair_attrs = taskfid['unique_pairs'].attrs[by]
+    # FIXME here we make the assumption
+    # that this fits into memory ...
+    dis = distancefid['distances']['data'][pair_attrs[1]:pair_attrs[2]][...]
+    dis = np.reshape(dis, dis.shape[0])
+    # FIXME idem + only unique_pairs used ?
+    pairs = taskfid['unique_pairs']['data'][pair_attrs[1]:pair_attrs[2]][...]
+    pairs = np.reshape(pairs, pairs.shape[0])
+    return pairs, dis, pair_attrs[0]
+
+
 def main():
     # parser (the usage string is specified explicitly because the default
     # does not show that the mandatory arguments must come before the mandatory
     # ones; otherwise parsing is not possible beacause optional arguments can
     # have various numbers of inputs)
-    parser = argparse.ArgumentParser(usage="%(prog)s task distance [score]",
-                                     description='ABX score computation')
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s task distance [score] [--task TASK]",
+        description='ABX score computation')
     # I/O files
     g1 = parser.add_argument_group('I/O files')
-    g1.add_argument('task', help='task file generated by the task module, \
+    g1.add_argument('task_file', metavar='task', help='task file generated by the task module, \
         containing the triplets and the pairs associated to the task \
         specification')
     g1.add_argument('distance', help='distance file generated by the distance \
         package, containing the distance between the pairs of a task')
     g1.add_argument('score', nargs='?', default=None, help='optional: score \
         file, where the results of the computation will be put')
+    parser.add_argument('--task', default=None, help='name of the task to \
+        score when the task file is a TaskSet file')
     args = parser.parse_args()
 
     if os.path.exists(args.score):
         print("Warning: overwriting score file {}".format(args.score))
         os.remove(args.score)
-    score(args.task, args.distance, args.score)
+    score(args.task_file, args.distance, args.score, task=args.task)
 
 
 if __name__ == '__main__':
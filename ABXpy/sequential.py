@@ -0,0 +1,340 @@
+"""This module estimates the results of an ABX discrimination task by
+sequential sampling
+
+Instead of computing the distances of all the pairs of a task, scoring
+all its triplets and collapsing the scores (see the distance, score and
+analyze modules), the triplets of each cell (the triplets sharing the
+same on, across and by labels) are drawn at random by rounds. Only the
+distances needed by the drawn triplets are computed, and a cell stops
+being sampled as soon as its average score is known with the requested
+precision, or when all its triplets have been drawn.
+
+It requires a task file and a feature file, and outputs a tab separated
+csv file in the format of the analyze module, with two additional
+columns: the total number of triplets of the cell and the precision
+achieved on its score, that is the half-width of its confidence
+interval.
+
+Usage
+-----
+Form the command line:
+
+.. code-block:: bash
+
+    python sequential.py data.features data.abx data.csv -n 1 -p 0.01
+
+In python:
+
+.. code-block:: python
+
+    import ABXpy.sequential
+    import ABXpy.distance
+    # Prerequisite: calculate a task data.abx
+    distance, symmetric = ABXpy.distance.get_distance()
+    ABXpy.sequential.estimate(
+        'data.features', 'data.abx', 'data.csv', distance, normalized=1,
+        precision=0.01, symmetric=symmetric)
+
+"""
+
+import argparse
+import os
+import sys
+import warnings
+
+import h5features
+import h5py
+import numpy as np
+import pandas
+import scipy.stats
+
+import ABXpy.distance
+import ABXpy.misc.triplets as triplets_io
+from ABXpy.analyze import npdecode, npencode
+from ABXpy.distances.distances import Features_Accessor, pair_distances
+from ABXpy.h5tools.h5io import read_indexed
+from ABXpy.misc.type_fitting import fit_integer_type
+from ABXpy.task import by_block_generator
+
+
+def half_width(sums, n, sizes, confidence):
+    """Half-width of the confidence intervals of the scores of cells
+
+    The interval is the Agresti-Coull interval of a proportion, with a
+    finite population correction since the triplets of a cell are
+    drawn without replacement: the half-width is 0 once all the
+    triplets of a cell have been drawn.
+
+    Parameters
+    ----------
+    sums : array
+        the sums of the scores (0, 1/2 or 1) of the drawn triplets
+    n : array
+        the numbers of drawn triplets
+    sizes : array
+        the numbers of triplets of the cells
+    confidence : float
+        the confidence level of the intervals
+
+    """
+    z = scipy.stats.norm.ppf(0.5 + confidence / 2.)
+    n = np.float64(n)
+    p = (sums + z ** 2 / 2) / (n + z ** 2)
+    correction = np.where(
+        sizes > 1, (sizes - n) / np.maximum(sizes - 1, 1), 0)
+    return z * np.sqrt(p * (1 - p) / (n + z ** 2) * correction)
+
+
+def read_block(taskfid, by, n_by):
+    """Load the indexed regressors of the triplets of a 'by' block
+
+    Returns them and a function returning the triplets of the 'by'
+    block at some positions, so that only the drawn triplets are read
+    from the task file.
+
+    """
+    if triplets_io.is_factorized(taskfid):
+        indices = list(triplets_io.read_regressors(taskfid, by, n_by))
+        indices = (np.concatenate(indices) if indices
+                   else np.empty((0, 0), dtype=np.int64))
+    else:
+        indices = read_indexed(taskfid['regressors'][by])
+
+    def read_triplets(positions):
+        return triplets_io.read_triplets_at(taskfid, n_by, positions)
+    return read_triplets, indices
+
+
+def estimate_block(triplets, cells, distance, get_features, by_db,
+                   normalized=None, precision=0.005, confidence=0.95,
+                   round_size=200, symmetric=True, rng=None):
+    """Estimate the scores of the cells of a 'by' block by rounds
+
+    Parameters
+    ----------
+    triplets : array of shape (n, 3) or callable
+        the A, B and X items of the triplets, indexed in the 'by' block,
+        or a function returning the triplets at some positions (see
+        read_block)
+    cells : array of shape (n,)
+        the cell of each triplet, from 0 to the number of cells - 1
+    distance : callable
+        the distance function
+    get_features : callable
+        returns the features of the items of a dataframe, indexed by
+        their 'by'-specific index
+    by_db : pandas.DataFrame
+        the items of the 'by' block
+    normalized : int or None
+        the normalization parameter passed to the distance, if not None
+    precision : float
+        the target half-width of the confidence interval of each cell
+    confidence : float
+        the confidence level of the intervals
+    round_size : int
+        the number of triplets drawn for each cell still sampled, at
+        each round
+    symmetric : bool
+        whether the distance is symmetric, in which case the distance
+        of (A, X) is used for (X, A)
+    rng : numpy.random.Generator, optional
+        the random generator used to draw the triplets
+
+    Returns the sum of the scores (between 0 and 1) of the drawn
+    triplets of each cell, the number of drawn triplets and the number
+    of triplets of each cell.
+
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    if not callable(triplets):
+        triplets = triplets.__getitem__
+    sizes = np.bincount(cells)
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    # drawing the triplets of a cell in order after this permutation is
+    # drawing them at random without replacement
+    permut = np.lexsort((rng.random(len(cells)), cells))
+    base = len(by_db)
+    key_type = fit_integer_type(base ** 2 - 1, is_signed=False)
+    sums = np.zeros(len(sizes))
+    n = np.zeros(len(sizes), dtype=np.int64)
+    cache = {}
+    features = {}
+    active = np.arange(len(sizes))
+    while len(active) > 0:
+        counts = np.minimum(round_size, sizes[active] - n[active])
+        starts = offsets[active] + n[active]
+        drawn = np.repeat(active, counts)
+        positions = (np.repeat(starts - np.cumsum(counts) + counts, counts) +
+                     np.arange(np.sum(counts)))
+        batch = key_type(triplets(permut[positions]))
+        keys_AX = triplets_io.pair_keys(
+            batch[:, 0], batch[:, 2], base, symmetric)
+        keys_BX = triplets_io.pair_keys(
+            batch[:, 1], batch[:, 2], base, symmetric)
+
+        # only the distances not computed at a previous round are needed
+        new = np.array([key for key in np.unique(
+            np.concatenate([keys_AX, keys_BX])) if key not in cache],
+            dtype=key_type)
+        pairs = np.column_stack([np.mod(new, base), new // base])
+        missing = np.setdiff1d(np.unique(pairs), list(features))
+        features.update(get_features(by_db.iloc[missing]))
+        for key, dis in zip(new, pair_distances(
+                pairs, features, by_db, distance, normalized)[:, 0]):
+            cache[key] = dis
+
+        dis_AX = np.array([cache[key] for key in keys_AX])
+        dis_BX = np.array([cache[key] for key in keys_BX])
+        # 1 if X closer to A, 0 if X closer to B, 1/2 if equal distance
+        scores = (np.int8(dis_AX < dis_BX) + np.int8(dis_AX <= dis_BX)) / 2.
+        sums += np.bincount(drawn, weights=scores, minlength=len(sizes))
+        n += np.bincount(drawn, minlength=len(sizes))
+        widths = half_width(sums[active], n[active], sizes[active],
+                            confidence)
+        active = active[(widths > precision) & (n[active] < sizes[active])]
+    return sums, n, sizes
+
+
+def estimate(feature_file, task_file, result_file, distance,
+             normalized=None, precision=0.005, confidence=0.95,
+             round_size=200, symmetric=True, seed=None, group='features'):
+    """Estimate the results of a task by sequential sampling
+
+    Parameters
+    ----------
+    feature_file : string, h5features file
+        the file containing the features of the items
+    task_file : string, hdf5 file
+        the file containing the triplets of the task
+    result_file : string, csv file
+        the file that will contain the results
+    distance : callable
+        the distance function
+    normalized : int or None
+        the normalization parameter passed to the distance, if not None
+    precision : float
+        the target half-width of the confidence interval of the score
+        of each cell, 0 to score all the triplets
+    confidence : float
+        the confidence level of the intervals
+    round_size : int
+        the number of triplets drawn for each cell still sampled, at
+        each round
+    symmetric : bool
+        whether the distance is symmetric
+    seed : int, optional
+        the seed of the random draws, each 'by' block having its own
+        random stream
+    group : string
+        the group to read in the h5features file
+
+    """
+    data = h5features.read(feature_file, group)
+    get_features = Features_Accessor(data[0], data[1]).get_features_from_raw
+    with open(result_file, 'w+') as fid, \
+            h5py.File(task_file, 'r') as taskfid:
+        aux = taskfid['regressors']
+        regs = aux[list(aux)[0]]['indexed_datasets']
+        fid.write(u''.join(reg + '\t' for reg in regs) +
+                  'by\tscore\tn\tn_triplets\tprecision\n')
+        for n_by, by in enumerate(taskfid['bys'][...]):
+            triplets, indices = read_block(taskfid, by, n_by)
+            if indices.shape[0] == 0:
+                continue
+            n_indices = np.max(indices, 0) + 1
+            ind_type = fit_integer_type(np.prod(n_indices), is_signed=False)
+            unique_index, cells = np.unique(
+                npencode(indices, n_indices, ind_type), return_inverse=True)
+
+            with pandas.HDFStore(task_file, 'r') as store:
+                by_db = store['feat_dbs/' + by]
+            sums, n, sizes = estimate_block(
+                triplets, cells, distance, get_features, by_db,
+                normalized=normalized, precision=precision,
+                confidence=confidence, round_size=round_size,
+                symmetric=symmetric, rng=by_block_generator(seed, by))
+            widths = half_width(sums, n, sizes, confidence)
+
+            tfrk = taskfid['regressors'][by]
+            indexes = [tfrk['indexes'][reg][:]
+                       for reg in tfrk['indexed_datasets']]
+            for i, key in enumerate(npdecode(unique_index, n_indices)):
+                result = ([index[int(k)] for index, k in zip(indexes, key)] +
+                          [by, sums[i] / n[i], n[i], sizes[i], widths[i]])
+                fid.write('\t'.join(map(str, result)) + u'\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Estimate the results of an ABX discrimination task '
+        'by drawing its triplets at random until the score of each cell '
+        'is known with the requested precision')
+
+    parser.add_argument(
+        'features',
+        help='h5features file containing the feature to evaluate')
+
+    parser.add_argument(
+        '-g', '--group', default='features',
+        help='group to read in the h5features file, default is %(default)s')
+
+    parser.add_argument(
+        'task', help='task file')
+
+    parser.add_argument(
+        'output', help='output file in csv format')
+
+    parser.add_argument(
+        '-d', '--distance', metavar='distancemodule.distancefunction',
+        help='distance to use, as in abx-distance, '
+        'defaults to dtw cosine distance')
+
+    parser.add_argument(
+        '--symmetric', action='store_true',
+        help='the custom distance given by --distance is symmetric, '
+        'as in abx-distance')
+
+    parser.add_argument(
+        '-n', '--normalization', type=int, default=None,
+        help='if dtw distance selected, compute with normalization (1) or '
+        'with sum (0)')
+
+    parser.add_argument(
+        '-p', '--precision', type=float, default=0.005,
+        help='target half-width of the confidence interval of the score '
+        'of each cell, default is %(default)s')
+
+    parser.add_argument(
+        '-c', '--confidence', type=float, default=0.95,
+        help='confidence level of the intervals, default is %(default)s')
+
+    parser.add_argument(
+        '-r', '--round-size', type=int, default=200,
+        help='number of triplets drawn by round for each cell, '
+        'default is %(default)s')
+
+    parser.add_argument(
+        '-s', '--seed', type=int, default=None,
+        help='seed of the random draws')
+
+    args = parser.parse_args()
+
+    if os.path.exists(args.output):
+        warnings.warn('Overwriting results file ' + args.output, UserWarning)
+        os.remove(args.output)
+
+    # if dtw distance selected, fore use of normalization parameter :
+    if (args.distance is None and args.normalization is None):
+        sys.exit("ERROR : DTW normalization parameter not specified !")
+
+    distance, symmetric = ABXpy.distance.get_distance(
+        args.distance, args.symmetric)
+    estimate(args.features, args.task, args.output, distance,
+             normalized=args.normalization, precision=args.precision,
+             confidence=args.confidence, round_size=args.round_size,
+             symmetric=symmetric, seed=args.seed, group=args.group)
+
+
+if __name__ == '__main__':
+    main()
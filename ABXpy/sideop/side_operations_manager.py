@@ -398,6 +398,22 @@ class SideOperationsManager(object):
         # evaluate dbfuns
         return result_generator(getattr(self, name), context)
 
+    # evaluate the dbfuns of a stage for several on/across blocks at
+    # once: blocks contains, for each element of indices (or for each
+    # block for the on_across_by stage), an item of its on/across
+    # block. Only valid for dbfuns evaluated element-wise.
+    def evaluate_blocks(self, name, db, blocks, indices=None):
+        context = {}
+        for field in (self.by_context, self.on_context, self.across_context):
+            for radical, extension in field[name]:
+                context[radical + extension] = list(db[radical][blocks])
+        if indices is not None:
+            context = self.set_A_B_X_context(
+                name + '_context', context, name, db, indices)
+
+        # evaluate dbfuns
+        return result_generator(getattr(self, name), context)
+
     def evaluate_A(self, *args):
         return self.evaluate_A_B_X('A', *args)
 
@@ -62,7 +62,13 @@ attribute; A,B and X share the same 'by' attribute
 """
 
 import argparse
+import copy
+import hashlib
+import itertools
+import json
+import multiprocessing
 import os
+import shutil
 import sys
 import tempfile
 
@@ -71,10 +77,13 @@ from six import iteritems, itervalues
 import h5py
 import numpy as np
 import pandas as pd
+import scipy.sparse
 import tables
 import warnings
 
 import ABXpy.database.database as database
+import ABXpy.dbfun.dbfun_column as dbfun_column
+import ABXpy.dbfun.dbfun_lookuptable as dbfun_lookuptable
 import ABXpy.h5tools.np2h5 as np2h5
 import ABXpy.h5tools.h52np as h52np
 import ABXpy.h5tools.h5_handler as h5_handler
@@ -82,15 +91,17 @@ import ABXpy.h5tools.h5io as h5io
 import ABXpy.sampling.sampler as sampler
 import ABXpy.sideop.filter_manager as filter_manager
 import ABXpy.sideop.regressor_manager as regressor_manager
+from ABXpy.misc.blocks import (
+    AttributeTable, Block, BlockAcrossIndex, BlockArrays, BlockFrames,
+    BlockGroups, BlockStats)
 import ABXpy.misc.progress_display as progress_display
+import ABXpy.misc.tinytree as tinytree
+import ABXpy.misc.triplets as triplets_io
 from ABXpy.misc.type_fitting import fit_integer_type
 
 # FIXME many of the fixmes should be presented as feature requests in
 # a github instead of fixmes
 #
-# FIXME get a memory and speed efficient mechanism for storing a task
-# on disk and loading it back (pickling doesn't work well)
-#
 # FIXME filter out empty 'on-across-by' blocks and empty 'by' blocks
 # as soon as possible (i.e. when computing stats)
 #
@@ -138,6 +149,32 @@ from ABXpy.misc.type_fitting import fit_integer_type
 # be carried out
 
 
+# on/across blocks with at most BATCH_MAX_BLOCK_SIZE triplets are
+# processed by batches of about BATCH_SIZE triplets, see
+# Task._write_batch
+BATCH_MAX_BLOCK_SIZE = 1000
+BATCH_SIZE = 100000
+
+# when thresholding, the on/across blocks with more than
+# THRESHOLD_SAMPLING_MIN_SIZE potential triplets are sampled before
+# the triplets are built, see Task._sample_triplets
+THRESHOLD_SAMPLING_MIN_SIZE = 10 ** 7
+
+# version of the files written by Task.save, the files of another
+# version cannot be loaded
+TASK_FILE_VERSION = 1
+
+# the integer codes of the items of a 'by' block, see
+# Task._init_prepare_by_block
+CODES = ['index', 'on', 'across', 'on_members', 'on_offsets',
+         'across_members', 'across_offsets']
+
+# the scalar statistics of a 'by' block, see Task.compute_statistics
+BY_STATS = ['nb_items', 'nb_on_levels', 'nb_across_levels',
+            'nb_on_across_levels', 'nb_triplets', 'nb_across_pairs',
+            'nb_on_pairs']
+
+
 class Task(object):
     """Define an ABX task for a given database.
 
@@ -183,9 +220,20 @@ class Task(object):
     verbose : bool, optional
         display additionnal information is set to True.
 
+    cache : directory, optional
+        when specified, the prepared task is saved in this directory
+        (see Task.save) and loaded back by the next instantiations of the
+        same task on the same database, instead of being prepared again.
+
+    loaded : tuple, optional
+        the database db_name as loaded by ABXpy.database.database.load
+        with features_info=True, to share it between several tasks
+        instead of reading it again (see ABXpy.taskset).
+
     """
     def __init__(self, db_name, on, across=None, by=None,
-                 filters=None, regressors=None, verbose=False):
+                 filters=None, regressors=None, verbose=False, cache=None,
+                 loaded=None):
         # check the item file is here
         if not os.path.isfile(db_name):
             raise AssertionError('item file {} not found'.format(db_name))
@@ -201,9 +249,29 @@ class Task(object):
         self.across = self._init_as_list(across)
         self.by = self._init_as_list(by)
 
+        # the task specification, a task file can be updated only by
+        # the same task (see generate_triplets)
+        self._specification = repr(
+            (self.on, self.across, self.by, filters, regressors))
+
+        if cache is not None:
+            cache_file = os.path.join(
+                cache, cache_key(db_name, self._specification) + '.task')
+            if os.path.exists(cache_file):
+                if self.verbose:
+                    print('loading the task from {}'.format(cache_file))
+                self._load(cache_file)
+                self.database = db_name
+                return
+
         # load the item database and check it
-        self.db, self.db_hierarchy, feat_db = database.load(
-            self.database, features_info=True)
+        if loaded is None:
+            self.db, self.db_hierarchy, feat_db = database.load(
+                self.database, features_info=True)
+        else:
+            # the dummy columns below are added to a copy
+            db, self.db_hierarchy, feat_db = loaded
+            self.db = db.copy()
         self._init_check_database()
 
         # if 'by' or 'across' are empty create appropriate dummy
@@ -219,31 +287,43 @@ class Task(object):
             self.across = ['#across']
 
         # setup filters
+        self.filters_specification = [] if filters is None else filters
         self.filters = filter_manager.FilterManager(
             self.db_hierarchy, self.on, self.across, self.by,
-            [] if filters is None else filters)
+            self.filters_specification)
 
         # setup regressors
+        self.regressors_specification = (
+            [] if regressors is None else regressors)
         self.regressors = regressor_manager.RegressorManager(
             self.db, self.db_hierarchy, self.on, self.across, self.by,
-            [] if regressors is None else regressors)
+            self.regressors_specification)
 
-        # some other attributes that are populated during the database
-        # preparation below
-        self.by_dbs = {}
+        # prepare the database for generating the triplets, the items
+        # and codes of the 'by' blocks are populated here
         self.types = {}
-        self.feat_dbs = {}
-        self.on_blocks = {}
-        self.across_blocks = {}
-        self.on_across_blocks = {}
-        self.antiacross_blocks = {}
-
-        # prepare the database for generating the triplets
         self._init_prepare_database(feat_db)
+        self._init_block_groups()
         self._init_prepare_types()
 
-        # compute some statistics about the task
-        self.compute_statistics()
+        # the statistics about the task are computed on first access
+        self._stats = None
+        self._by_stats = None
+
+        if cache is not None and self.by_dbs:
+            # written under a temporary name then renamed, so that an
+            # interrupted save leaves no corrupted cache file
+            if not os.path.exists(cache):
+                os.makedirs(cache)
+            fd, tmp_file = tempfile.mkstemp(dir=cache, suffix='.tmp')
+            os.close(fd)
+            os.remove(tmp_file)
+            try:
+                self.save(tmp_file)
+                os.rename(tmp_file, cache_file)
+            finally:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
 
     @staticmethod
     def _init_as_list(arg):
@@ -282,56 +362,135 @@ class Task(object):
         if self.verbose:
             print("input database verified")
 
+    def _init_block_groups(self):
+        """The on, across and on/across groups of the 'by' blocks
+
+        The GroupBy objects of a 'by' block are created when accessed,
+        see BlockGroups.
+
+        """
+        self.on_blocks = BlockGroups(self.by_dbs, self.on)
+        self.across_blocks = BlockGroups(self.by_dbs, self.across)
+        self.on_across_blocks = BlockGroups(
+            self.by_dbs, self.on + self.across)
+
     def _init_prepare_database(self, feat_db):
-        """Prepare the database for triplet generation"""
+        """Prepare the database for triplet generation
+
+        The by, on and across values of the items are encoded once into
+        integer codes for the whole database, and the items of each 'by'
+        block are given by a single stable sort of the by codes. The
+        items and codes of all the 'by' blocks are stored in shared
+        tables and arrays, sorted by block (see ABXpy.misc.blocks).
+
+        """
         by_groups = self.db.groupby(self.by)
+        by_codes = by_groups.ngroup().values
+        by_keys = by_groups.size().index
+
+        # codes of the on and across values in each 'by' block, the
+        # blocks with missing values are encoded by groupby
+        on_codes = self.db.groupby(self.on).ngroup().values
+        across_codes = self.db.groupby(self.across).ngroup().values
+        missing = (on_codes < 0) | (across_codes < 0)
+        on_codes = block_codes(by_codes, on_codes)
+        across_codes = block_codes(by_codes, across_codes)
+
+        # the items of each 'by' block are contiguous in order, items
+        # with a missing by value (code -1) being ignored
+        order = np.argsort(by_codes, kind='stable')
+        order = order[np.searchsorted(by_codes[order], 0):]
+        blocks = by_codes[order]
+        bounds = np.searchsorted(blocks, np.arange(len(by_keys) + 1))
+        has_missing = np.bincount(
+            blocks, weights=missing[order], minlength=len(by_keys)) > 0
+
+        # the index of the items is relative to the 'by' block, the
+        # original index could be conserved in an additional column if
+        # necessary, but this would add another constraint on the
+        # possible column names
+        labels = np.arange(len(order)) - bounds[blocks]
+        self.by_dbs = BlockFrames(self.db.take(order))
+        self.feat_dbs = BlockFrames(feat_db.take(order))
+        self.codes = BlockArrays(block_item_codes(
+            bounds, on_codes[order], across_codes[order], labels))
+        self.antiacross_index = {}
+        if len(self.across) > 1:
+            self.antiacross_index = BlockAcrossIndex(block_across_index(
+                bounds, np.column_stack(
+                    [block_codes(by_codes, pd.factorize(self.db[col])[0])
+                     for col in self.across])[order], labels))
 
         if self.verbose:
             display = progress_display.ProgressDisplay()
-            display.add('block', 'Preprocessing by block', len(by_groups))
+            display.add('block', 'Preprocessing by block', len(by_keys))
 
-        for by_key, by_frame in by_groups:
+        for i, by_key in enumerate(by_keys):
             if self.verbose:
                 display.update('block', 1)
                 display.display()
 
-            # allow to get by values as well as values of other variables
-            # that are determined by these
-            by_values = dict(by_frame.iloc[0])
-
-            # apply 'by' filters
-            if self.filters.by_filter(by_values):
-                # get analogous feat_db
-                by_feat_db = feat_db.iloc[by_frame.index]
-
-                # drop indexes
-                by_frame = by_frame.reset_index(drop=True)
+            block = Block(i, bounds[i], bounds[i + 1])
+            by_frame = None
+            if self.filters.by or self.filters.generic:
+                # allow to get by values as well as values of other
+                # variables that are determined by these
+                by_frame = self.by_dbs.build(block)
+                by_values = dict(by_frame.iloc[0])
+
+                # apply 'by' filters
+                if not self.filters.by_filter(by_values):
+                    continue
+
+                # apply generic filters, the codes are then computed
+                # on the remaining items
+                if self.filters.generic:
+                    by_frame = self.filters.generic_filter(
+                        by_values, by_frame)
+                else:
+                    by_frame = None
+            if by_frame is None and has_missing[i]:
+                by_frame = self.by_dbs.build(block)
 
-                # reset_index to get an index relative to the 'by' db,
-                # the original index could be conserved in an additional
-                # 'index' column if necessary by removing the drop=True, but
-                # this would add another constraint on the possible column name
-                by_feat_db = by_feat_db.reset_index(drop=True)
+            self._init_prepare_by_block(by_key, block, by_frame)
 
-                # apply generic filters
-                by_frame = self.filters.generic_filter(by_values, by_frame)
+    def _init_prepare_by_block(self, by_key, block, by_frame=None):
+        """Add a 'by' block to the prepared database
 
-                self.by_dbs[by_key] = by_frame
-                self.feat_dbs[by_key] = by_feat_db
+        block is the position of the items of the 'by' block in the
+        shared tables. If by_frame is specified (when some items are
+        filtered out or have missing values), it is used as the items
+        of the 'by' block instead, and their codes are computed on it.
 
-                def _by_dbs(l): return self.by_dbs[by_key].groupby(l)
-                self.on_blocks[by_key] = _by_dbs(self.on)
-                self.across_blocks[by_key] = _by_dbs(self.across)
-                self.on_across_blocks[by_key] = _by_dbs(self.on + self.across)
+        """
+        self.feat_dbs.add(by_key, block)
+        if by_frame is None:
+            self.by_dbs.add(by_key, block)
+            self.codes.add(by_key, block)
+            if len(self.across) > 1:
+                self.antiacross_index.add(by_key, block)
+            return
 
-                if len(self.across) > 1:
-                    self.antiacross_blocks[by_key] = dict()
-                    for across_key in self.across_blocks[by_key].groups:
-                        b = True
-                        for i, col in enumerate(self.across):
-                            b = b * (by_frame[col] != across_key[i])
-                        self.antiacross_blocks[by_key][across_key] = (
-                            by_frame[b].index)
+        self.by_dbs[by_key] = by_frame
+
+        # integer codes of the 'on' and 'across' levels of each
+        # item, and the items of each level as sorted arrays
+        self.codes[by_key] = item_codes(
+            by_frame.index.values,
+            by_frame.groupby(self.on).ngroup().values,
+            by_frame.groupby(self.across).ngroup().values)
+
+        if len(self.across) > 1:
+            # inverted index of the across columns: the integer code of
+            # the value of each item in each column (0 for missing
+            # values), and for each column the items sorted by code,
+            # see antiacross_items
+            index = by_frame.index.values
+            columns = np.column_stack(
+                [pd.factorize(by_frame[col])[0] + 1 for col in self.across])
+            self.antiacross_index[by_key] = {
+                'codes': columns,
+                'members': [group_members(c, index) for c in columns.T]}
 
     def _init_prepare_types(self):
         """Determining appropriate numeric type to represent index
@@ -343,8 +502,210 @@ class Task(object):
         # len(db)-1 wouldn't work here because there could be missing
         # index due to generic filtering
         self.types = {
-            key: fit_integer_type(np.max(db.index.values), is_signed=False)
-            for key, db in iteritems(self.by_dbs)}
+            key: fit_integer_type(
+                np.max(self.codes[key]['index']), is_signed=False)
+            for key in self.by_dbs}
+
+    def save(self, path):
+        """Save the prepared task to a file, see Task.load
+
+        The item database, the integer codes and the statistics of the
+        'by' blocks are stored as arrays in a HDF5 file (one table or
+        array for all the 'by' blocks), so that loading the task does
+        not parse the item file and prepare the 'by' blocks again. The
+        statistics are computed if they are not already.
+
+        """
+        if os.path.exists(path):
+            raise ValueError('The file already exists: {}'.format(path))
+        if not self.by_dbs:
+            raise ValueError('Cannot save a task without any \'by\' block')
+
+        bys = list(self.by_dbs)
+        n_bys = range(len(bys))
+        by_stats = [self.by_stats[by] for by in bys]
+
+        def _concat(frames):
+            # the 'by' block of each row in the '#block' column
+            return pd.concat(
+                frames, keys=n_bys,
+                names=['#block'] + list(frames[0].index.names)).reset_index(
+                    level='#block')
+
+        def _levels(name, extra=None):
+            frame = _concat(
+                [stats[name].to_frame('count') for stats in by_stats])
+            if extra is not None:
+                frame[extra] = np.concatenate(
+                    [[stats[extra][key] for key in stats[name].index]
+                     for stats in by_stats]).astype(np.int64)
+            return frame.reset_index()
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', tables.NaturalNameWarning)
+            with pd.HDFStore(path, 'w') as store:
+                store.put('db', self.db, format='table')
+                store.put('bys', pd.DataFrame(
+                    [by if isinstance(by, tuple) else (by,) for by in bys],
+                    columns=self.by), format='table')
+                store.put('by_dbs', _concat(
+                    [self.by_dbs[by] for by in bys]), format='table')
+                store.put('feat_dbs', _concat(
+                    [self.feat_dbs[by] for by in bys]), format='table')
+                store.put('by_stats', pd.DataFrame(
+                    [[stats[name] for name in BY_STATS] for stats in by_stats],
+                    columns=BY_STATS, dtype=np.int64), format='table')
+                for name in ('on_levels', 'across_levels'):
+                    store.put(name, _levels(name), format='table')
+                store.put('on_across_levels',
+                          _levels('on_across_levels', 'block_sizes'),
+                          format='table')
+
+        with h5py.File(path, 'a') as fh:
+            fh.attrs['version'] = TASK_FILE_VERSION
+            fh.attrs['task'] = json.dumps({
+                'database': self.database,
+                'on': self.on, 'across': self.across, 'by': self.by,
+                'filters': self.filters_specification,
+                'regressors': self.regressors_specification,
+                'specification': self._specification,
+                'hierarchy': [hierarchy_to_list(tree)
+                              for tree in self.db_hierarchy],
+                'stats': self.stats}, default=int)
+            g = fh.create_group('codes')
+            for name in CODES:
+                arrays = [self.codes[by][name] for by in bys]
+                g.create_dataset(name, data=np.concatenate(arrays))
+                g.create_dataset(name + '_lengths', data=np.array(
+                    [len(a) for a in arrays], dtype=np.int64))
+
+    @classmethod
+    def load(cls, path, verbose=False):
+        """Load a task saved with Task.save"""
+        task = cls.__new__(cls)
+        task.verbose = verbose
+        task._load(path)
+        return task
+
+    def _load(self, path):
+        with h5py.File(path, 'r') as fh:
+            if fh.attrs.get('version', None) != TASK_FILE_VERSION:
+                raise ValueError(
+                    'Not a task saved by this version: {}'.format(path))
+            spec = json.loads(fh.attrs['task'])
+            codes = {}
+            for name in CODES:
+                lengths = fh['codes'][name + '_lengths'][...]
+                codes[name] = (fh['codes'][name][...], np.concatenate(
+                    ([0], np.cumsum(lengths))))
+
+        with pd.HDFStore(path, 'r') as store:
+            self.db = store['db']
+            bys = store['bys']
+            by_dbs = store['by_dbs']
+            feat_dbs = store['feat_dbs']
+            by_stats = store['by_stats']
+            levels = {name: store[name] for name in
+                      ('on_levels', 'across_levels', 'on_across_levels')}
+
+        self.database = spec['database']
+        self.on = spec['on']
+        self.across = spec['across']
+        self.by = spec['by']
+        self.filters_specification = spec['filters']
+        self.regressors_specification = spec['regressors']
+        self._specification = spec['specification']
+        self.db_hierarchy = [hierarchy_from_list(tree)
+                             for tree in spec['hierarchy']]
+        self.filters = filter_manager.FilterManager(
+            self.db_hierarchy, self.on, self.across, self.by,
+            self.filters_specification)
+        self.regressors = regressor_manager.RegressorManager(
+            self.db, self.db_hierarchy, self.on, self.across, self.by,
+            self.regressors_specification)
+
+        keys = [tuple(row) if len(self.by) > 1 else row[0]
+                for row in bys.itertuples(index=False)]
+        self.by_dbs = self._load_frames(keys, by_dbs)
+        self.feat_dbs = self._load_frames(keys, feat_dbs)
+        self.codes = BlockArrays(codes)
+        self.antiacross_index = {}
+        if len(self.across) > 1:
+            blocks = by_dbs['#block'].values
+            self.antiacross_index = BlockAcrossIndex(block_across_index(
+                codes['index'][1], np.column_stack(
+                    [block_codes(blocks, pd.factorize(by_dbs[col])[0])
+                     for col in self.across]), by_dbs.index.values))
+        for i, by_key in enumerate(keys):
+            block = Block(i, 0, 0)
+            self.codes.add(by_key, block)
+            if len(self.across) > 1:
+                self.antiacross_index.add(by_key, block)
+        self._init_block_groups()
+        self.types = {}
+        self._init_prepare_types()
+
+        self._stats = spec['stats']
+        series = {}
+        for name, cols in (('on_levels', self.on),
+                           ('across_levels', self.across),
+                           ('on_across_levels', self.on + self.across)):
+            series[name] = levels[name].set_index(['#block'] + cols)['count']
+            series[name].name = None
+        self._by_stats = BlockStats(
+            keys, {name: by_stats[name].values for name in BY_STATS},
+            series, levels['on_across_levels']['block_sizes'].values)
+
+    @staticmethod
+    def _load_frames(keys, frame):
+        """The frames of the 'by' blocks stored in a single frame
+
+        The frames indexed from 0 are stored as Block of the frame,
+        the other ones (with items removed by generic filters) as
+        explicit frames.
+
+        """
+        bounds = np.searchsorted(
+            frame['#block'].values, np.arange(len(keys) + 1))
+        frames = BlockFrames(frame.drop(columns='#block'))
+        sizes = np.diff(bounds)
+        compact = frame.index.values == (
+            np.arange(len(frame)) - np.repeat(bounds[:-1], sizes))
+        for i, by_key in enumerate(keys):
+            block = Block(i, bounds[i], bounds[i + 1])
+            if compact[block.start:block.stop].all():
+                frames.add(by_key, block)
+            else:
+                frames[by_key] = frames.table.iloc[block.start:block.stop]
+        return frames
+
+    @property
+    def stats(self):
+        """Statistics about the whole task, see compute_statistics"""
+        if self._stats is None:
+            self.compute_statistics()
+        return self._stats
+
+    @stats.setter
+    def stats(self, value):
+        self._stats = value
+
+    @property
+    def by_stats(self):
+        """Statistics about each 'by' block, see compute_statistics"""
+        if self._by_stats is None:
+            self.compute_statistics()
+        return self._by_stats
+
+    @by_stats.setter
+    def by_stats(self, value):
+        self._by_stats = value
+
+    @property
+    def n_blocks(self):
+        # FIXME remove empty by blocks then remove empty on_across_by
+        # blocks when computing the stats
+        return self.stats['nb_blocks']
 
     def compute_statistics(self, approximate=False):
         """Compute the statistics of the task
@@ -368,6 +729,78 @@ class Task(object):
         self.stats['nb_by_levels'] = len(self.by_dbs)
         self.by_stats = {}
 
+        # the number of triplets has a closed form in each block when
+        # there are no filters to evaluate on the blocks or their items
+        if not self.filters.on_across_by and (
+                approximate or not self.stats['approximate']):
+            self._compute_statistics_vectorized()
+        else:
+            self._compute_statistics_by_block(approximate)
+
+        self.stats['nb_blocks'] = sum(
+            [bystats['nb_on_across_levels']
+             for bystats in self.by_stats.values()])
+        self.stats['nb_triplets'] = sum(
+            [bystats['nb_triplets'] for bystats in self.by_stats.values()])
+
+    def _items_table(self):
+        """Concatenate the on and across columns of all the by blocks
+
+        The by block of each item is given by its position in
+        self.by_dbs, in the '#block' column.
+
+        """
+        if isinstance(self.by_dbs, BlockFrames):
+            return self.by_dbs.concat(self.on + self.across)
+        return pd.concat(
+            [db[self.on + self.across] for db in self.by_dbs.values()],
+            keys=range(len(self.by_dbs)),
+            names=['#block', '#item']).reset_index(level='#block')
+
+    def _compute_statistics_vectorized(self):
+        """Compute the statistics of all the blocks at once
+
+        All the counts are obtained from group sizes on the whole items
+        table, see block_counts, and stored as arrays for all the
+        blocks, see BlockStats.
+
+        """
+        if not self.by_dbs:
+            return
+
+        items = self._items_table()
+        index, n_A, n_B, n_X, n_antiX = block_counts(
+            items, self.on, self.across, self.across == ['#across'])
+        nb_triplets = n_A * n_B * n_antiX
+
+        # sums by 'by' block
+        n_bys = len(self.by_dbs)
+        bounds = np.searchsorted(
+            index.get_level_values('#block'), np.arange(n_bys + 1))
+
+        def _sum(values):
+            sums = np.concatenate(([0], np.cumsum(values)))
+            return sums[bounds[1:]] - sums[bounds[:-1]]
+
+        self.by_stats = BlockStats(
+            list(self.by_dbs),
+            {'nb_items': np.bincount(items['#block'].values,
+                                     minlength=n_bys),
+             'nb_triplets': _sum(nb_triplets),
+             'nb_across_pairs': _sum(n_A * n_B),
+             'nb_on_pairs': _sum(n_A * n_X)},
+            {name: items.groupby(['#block'] + cols).size()
+             for name, cols in (('on_levels', self.on),
+                                ('across_levels', self.across),
+                                ('on_across_levels', self.on + self.across))},
+            nb_triplets)
+
+    def _compute_statistics_by_block(self, approximate):
+        """Compute the statistics iterating over on/across blocks
+
+        Used when some filters have to be evaluated in each block.
+
+        """
         if self.verbose:
             display = progress_display.ProgressDisplay()
             display.add('block', 'Computing statistics for by block',
@@ -388,17 +821,15 @@ class Task(object):
             stats['nb_on_across_levels'] = len(stats['on_across_levels'])
             self.by_stats[by] = stats
 
-        self.stats['nb_blocks'] = sum(
-            [bystats['nb_on_across_levels']
-             for bystats in self.by_stats.values()])
-
         if self.verbose:
             display = progress_display.ProgressDisplay()
             display.add(
                 'block', 'Computing statistics for by/on/across block',
-                self.stats['nb_blocks'])
+                sum([bystats['nb_on_across_levels']
+                     for bystats in self.by_stats.values()]))
 
         for by, db in iteritems(self.by_dbs):
+            attributes = AttributeTable(db)
             stats = self.by_stats[by]
             stats['block_sizes'] = {}
             stats['nb_triplets'] = 0
@@ -412,7 +843,7 @@ class Task(object):
                     display.display()
 
                 block = self.on_across_blocks[by].groups[block_key]
-                on_across_by_values = dict(db.iloc[block[0]])
+                on_across_by_values = attributes.row(block[0])
 
                 # retrieve the on and across keys (as they are stored
                 # in the panda object)
@@ -455,16 +886,9 @@ class Task(object):
                 else:
                     stats['block_sizes'][block_key] = 0
 
-        self.stats['nb_triplets'] = sum(
-            [bystats['nb_triplets'] for bystats in self.by_stats.values()])
-
-        # FIXME remove empty by blocks then remove empty on_across_by
-        # blocks here, also reset self.n_blocks in consequence
-        self.n_blocks = self.stats['nb_blocks']
-
     def on_across_triplets(self, by, on, across,
                            on_across_block, on_across_by_values,
-                           with_regressors=True):
+                           with_regressors=True, quota=None):
         """Generate all possible triplets for a given by block.
 
         Given an on_across_block of the database and the parameters of the
@@ -489,6 +913,10 @@ class Task(object):
         with_regressors : bool, optional
             By default, true
 
+        quota : int, optional
+            The maximal number of triplets of the block, a uniform
+            sample of the triplets is returned if there are more.
+
         Returns
         -------
 
@@ -499,32 +927,7 @@ class Task(object):
             the regressors generated
 
         """
-        # find all possible A, B, X where A and X have the 'on'
-        # feature of the block and A and B have the 'across' feature
-        # of the block
-        A = np.array(on_across_block, dtype=self.types[by])
-        on_set = set(self.on_blocks[by].groups[on])
-
-        # FIXME quick fix to process case with no across, but better
-        # done in a separate loop...
-        if self.across == ['#across']:
-            # in this case A is a singleton and B can be anything in
-            # the by block that doesn't have the same 'on' as A
-            B = np.array(
-                list(set(self.by_dbs[by].index).difference(on_set)),
-                dtype=self.types[by])
-        else:
-            # remove B with the same 'on' than A
-            B = np.array(
-                list(set(self.across_blocks[by].groups[across]).difference(A)),
-                dtype=self.types[by])
-
-        # remove X with the same 'across' than A
-        if type(across) is tuple:
-            antiacross_set = set(self.antiacross_blocks[by][across])
-            X = np.array(list(antiacross_set & on_set), dtype=self.types[by])
-        else:
-            X = np.array(list(on_set.difference(A)), dtype=self.types[by])
+        A, B, X = self._ABX_candidates(by, across, on_across_block)
 
         # apply singleton filters
         db = self.by_dbs[by]
@@ -538,6 +941,11 @@ class Task(object):
             iX = self.filters.X_filter(on_across_by_values, db, X)
             X = X[iX]
 
+        # sample the candidates to limit the number of pairs
+        if (with_regressors and self.items_fraction < 1 and
+                len(A) * len(B) * len(X) > 0):
+            A, B, X = self._sample_items(on_across_by_values, db, A, B, X)
+
         # instantiate A, B, X regressors here
         if with_regressors:
             self.regressors.set_A_regressors(on_across_by_values, db, A)
@@ -549,9 +957,23 @@ class Task(object):
         size = len(A) * len(B) * len(X)
         on_across_block_index = [0]
 
-        if size > 0:
+        if size > 0 and self._sample_before_materialize(
+                size, with_regressors):
+            triplets, iA, iB, iX, on_across_block_index = (
+                self._sample_triplets(on_across_by_values, db, A, B, X))
+            # the sampled triplets are already filtered and sorted
+            ABX_filter_ind = np.arange(triplets.shape[0])
+            thr_sort_permut = ABX_filter_ind
+        elif size > 0:
             ind_type = fit_integer_type(size, is_signed=False)
-            indices = np.arange(size, dtype=ind_type)
+            if (quota is not None and quota < size and
+                    not (self.threshold or self.filters.ABX)):
+                # sample the triplets before building them
+                indices = np.sort(sampler.sample_without_replacement(
+                    quota, size, dtype=ind_type, rng=self.rng))
+                size = quota
+            else:
+                indices = np.arange(size, dtype=ind_type)
 
             # generate triplets from indices
             iX = np.mod(indices, len(X))
@@ -604,7 +1026,7 @@ class Task(object):
                     for i in range(1, len(n_regs)):
                         new_index = regs[:, i] + n_regs[i] * new_index
 
-                    permut = np.argsort(new_index)
+                    permut = counting_sort(new_index, np.prod(n_regs))
 
                     # the organization should be revamped: the real
                     # sorting is done by the line just above, while
@@ -615,13 +1037,13 @@ class Task(object):
                     # function...
                     thr_sort_permut, on_across_block_index = (
                         sort_and_threshold(
-                            permut, new_index, reg_ind_type,
-                            threshold=self.threshold))
+                            permut, new_index, ind_type,
+                            threshold=self.threshold, rng=self.rng))
                     triplets = triplets[thr_sort_permut]
                 else:
                     # FIXME was a bug breaking tests -> variable need
                     # to be defined
-                    thr_sort_permut = np.empty(shape=0, dtype=np.uint8)
+                    thr_sort_permut = np.arange(size)
 
         else:
             # empty block...
@@ -640,6 +1062,15 @@ class Task(object):
 
             thr_sort_permut = np.empty(shape=0, dtype=np.uint8)
 
+        n_triplets = triplets.shape[0]
+        if quota is not None and quota < n_triplets:
+            # sample the thresholded or filtered triplets, keeping them
+            # in order
+            keep = np.sort(sampler.sample_without_replacement(
+                quota, n_triplets, rng=self.rng))
+            triplets = triplets[keep]
+            thr_sort_permut = thr_sort_permut[keep]
+
         if not with_regressors:
             return triplets
         else:
@@ -662,16 +1093,207 @@ class Task(object):
                     regressors,
                     np.array(on_across_block_index)[:, None])
 
-    # FIXME add a mechanism to allow the specification of a random seed in a
-    # way that would produce reliably the same triplets on different machines
-    # (means cross-platform random number generator + having its state so as
-    # to be sure that no other random number generation calls to it are
-    # altering the sequence).
-    #
-    # FIXME use an object that guarantees that the stream will not be
-    # perturbed by external codes calls to np.random.
-    def generate_triplets(self, output=None,
-                          threshold=None, tmpdir=None, seed=None):
+    def _sample_items(self, on_across_by_values, db, A, B, X):
+        """Helper method for Task.on_across_triplets
+
+        Returns a sample of a fraction self.items_fraction of the A, B
+        and X candidates of a block. The B (resp. X) candidates are
+        grouped by B (resp. X) regressors, the groups being the
+        regressor cells used for thresholding, and each group is
+        sampled separately so that all the cells of the block are still
+        represented.
+
+        """
+        A = A[sampler.sample_groups(
+            [0, len(A)], self.items_fraction, rng=self.rng)]
+        sampled = [A]
+        for stage, items in (('B', B), ('X', X)):
+            getattr(self.regressors, 'set_{}_regressors'.format(stage))(
+                on_across_by_values, db, items)
+            regs = getattr(self.regressors, stage + '_regressors')
+            members, offsets = regressor_cells(
+                [reg for stage_regs in regs for reg in stage_regs],
+                len(items))
+            sampled.append(items[np.sort(members[sampler.sample_groups(
+                offsets, self.items_fraction, rng=self.rng)])])
+        return sampled
+
+    def _sample_before_materialize(self, size, with_regressors):
+        """True if the triplets of a block are sampled before being built
+
+        This is possible when thresholding on B or X regressors, and
+        is done for the blocks with more than
+        THRESHOLD_SAMPLING_MIN_SIZE potential triplets.
+
+        """
+        return bool(
+            with_regressors and self.threshold
+            and size > THRESHOLD_SAMPLING_MIN_SIZE
+            and any(self.regressors.B_regressors
+                    + self.regressors.X_regressors))
+
+    def _sample_triplets(self, on_across_by_values, db, A, B, X):
+        """Helper method for Task.on_across_triplets
+
+        Samples the triplets of a block without building all the A, B, X
+        combinations. The regressor cells used for thresholding only
+        depend on the B and X items, so the size of each cell is known
+        before any triplet is built. At most self.threshold flat indices
+        are drawn in each cell and only the sampled triplets are
+        decoded.
+
+        Without ABX filters, the same random draws as in
+        sort_and_threshold are made so that the sampled triplets are
+        the same as with the full computation. With ABX filters, each
+        oversized cell is enumerated by batches of BATCH_SIZE triplets
+        to count the triplets passing the filters, and self.threshold
+        of them are sampled across the batches with an
+        IncrementalSampler, the batches being filtered again only if
+        some of their triplets are sampled. The sizes of the cells in
+        the returned on_across_block_index are thus the exact numbers
+        of triplets passing the filters, as with the full computation,
+        and only a batch of triplets is built at once.
+
+        Returns the sampled triplets, their A, B and X indices and the
+        on_across_block_index.
+
+        """
+        B_members, B_offsets = regressor_cells(
+            [reg for regs in self.regressors.B_regressors for reg in regs],
+            len(B))
+        X_members, X_offsets = regressor_cells(
+            [reg for regs in self.regressors.X_regressors for reg in regs],
+            len(X))
+        n_A = len(A)
+        n_B = np.diff(B_offsets)
+        n_X = np.diff(X_offsets)
+        ind_type = fit_integer_type(n_A * len(B) * len(X), is_signed=False)
+
+        def decode(cell_B, cell_X, n_BX, n_Xc, ranks):
+            ranks = ranks.astype(np.int64)
+            iA = ranks // n_BX
+            iB = cell_B[(ranks // n_Xc) % (n_BX // n_Xc)]
+            iX = cell_X[ranks % n_Xc]
+            return iA, iB, iX
+
+        def filtered(cell_B, cell_X, n_BX, n_Xc, start, stop):
+            # the triplets of ranks start to stop - 1 of a cell passing
+            # the ABX filters
+            iA, iB, iX = decode(
+                cell_B, cell_X, n_BX, n_Xc, np.arange(start, stop))
+            triplets = np.column_stack((A[iA], B[iB], X[iX]))
+            kept = self.filters.ABX_filter(on_across_by_values, db, triplets)
+            return iA[kept], iB[kept], iX[kept]
+
+        sampled, sizes = [], []
+        # the cells are ordered by B regressors first, then by X
+        # regressors, as in on_across_triplets
+        for c in range(len(n_B)):
+            cell_B = B_members[B_offsets[c]:B_offsets[c + 1]]
+            for d in range(len(n_X)):
+                cell_X = X_members[X_offsets[d]:X_offsets[d + 1]]
+                n_Xc = int(n_X[d])
+                n_BX = int(n_B[c]) * n_Xc
+                cell_size = n_A * n_BX
+
+                if not self.filters.ABX:
+                    if cell_size > self.threshold:
+                        ranks = sampler.sample_without_replacement(
+                            self.threshold, cell_size, dtype=ind_type,
+                            rng=self.rng)
+                    else:
+                        ranks = np.arange(cell_size, dtype=ind_type)
+                    sampled.append(decode(cell_B, cell_X, n_BX, n_Xc, ranks))
+                    sizes.append(cell_size)
+                    continue
+
+                starts = range(0, cell_size, BATCH_SIZE)
+                kept, counts, n_kept = [], [], 0
+                for start in starts:
+                    ind = filtered(cell_B, cell_X, n_BX, n_Xc, start,
+                                   min(start + BATCH_SIZE, cell_size))
+                    counts.append(len(ind[0]))
+                    n_kept += counts[-1]
+                    # the triplets passing the filters are kept only
+                    # while the cell is below the threshold
+                    if n_kept <= self.threshold:
+                        kept.append(ind)
+
+                if n_kept > self.threshold:
+                    incremental = sampler.IncrementalSampler(
+                        n_kept, self.threshold, rng=self.rng)
+                    kept = []
+                    for start, count in zip(starts, counts):
+                        if count == 0:
+                            continue
+                        subset = incremental.sample(count)
+                        if len(subset):
+                            ind = filtered(
+                                cell_B, cell_X, n_BX, n_Xc, start,
+                                min(start + BATCH_SIZE, cell_size))
+                            kept.append(tuple(i[subset] for i in ind))
+                if n_kept > 0:
+                    sampled.append(
+                        tuple(np.concatenate(i) for i in zip(*kept)))
+                    sizes.append(n_kept)
+
+        if sampled:
+            iA, iB, iX = (np.concatenate(i) for i in zip(*sampled))
+        else:
+            iA = iB = iX = np.empty(shape=0, dtype=np.int64)
+        triplets = np.column_stack((A[iA], B[iB], X[iX]))
+        on_across_block_index = np.concatenate(
+            ([0], np.cumsum(sizes, dtype=np.int64)))
+        return triplets, iA, iB, iX, on_across_block_index
+
+    def _ABX_candidates(self, by, across, on_across_block):
+        """Return the possible A, B and X items of an on/across block
+
+        A and X have the 'on' feature of the block and A and B have
+        the 'across' feature of the block. The three arrays are sorted.
+
+        """
+        codes = self.codes[by]
+        A = np.asarray(on_across_block)
+
+        # the 'on' and 'across' levels of the block are the ones of
+        # any of its items
+        first = np.searchsorted(codes['index'], A[0])
+        on_code = codes['on'][first]
+        across_code = codes['across'][first]
+        on_members = codes['on_members'][
+            codes['on_offsets'][on_code]:codes['on_offsets'][on_code + 1]]
+
+        # without across, the blocks are generated by 'on' levels in
+        # _compute_no_across_triplets, unless they have to be processed
+        # one by one
+        if self.across == ['#across']:
+            # in this case A is a singleton and B can be anything in
+            # the by block that doesn't have the same 'on' as A
+            B = codes['index'][codes['on'] != on_code]
+        else:
+            # remove B with the same 'on' than A
+            across_members = codes['across_members'][
+                codes['across_offsets'][across_code]:
+                codes['across_offsets'][across_code + 1]]
+            B = np.setdiff1d(across_members, A, assume_unique=True)
+
+        # remove X with the same 'across' than A
+        if type(across) is tuple:
+            X = antiacross_items(
+                self.antiacross_index[by], first, on_members)
+        else:
+            X = np.setdiff1d(on_members, A, assume_unique=True)
+
+        return (A.astype(self.types[by]),
+                B.astype(self.types[by]),
+                X.astype(self.types[by]))
+
+    def generate_triplets(self, output=None, threshold=None, tmpdir=None,
+                          seed=None, n_cpu=1, factorized=False,
+                          symmetric_pairs=False, update=None, resume=False,
+                          max_triplets=None, min_block_triplets=0,
+                          max_pairs=None, memory=1000):
         """Generate all possible triplets for the whole task
 
         Generate the triplets and the pairs for an ABXpy.Task and
@@ -692,13 +1314,72 @@ class Task(object):
         seed : int, optional
            seed for initializing the random number generator
 
-        """
-        # reinitialize the random generator with the provided seed
-        # (TODO this is only used for sampling, so it should be moved
-        # out during code refactoring -> put that in main(), or in
-        # sampling module?)
-        np.random.seed(seed)
+        n_cpu : int, optional
+           number of processes among which the 'by' blocks are
+           distributed, default to 1. When a seed is given, the
+           generated task does not depend on n_cpu.
+
+        factorized : bool, optional
+           when True, store only the A, B and X candidates of each
+           on/across block instead of all the triplets, default to
+           False. This is not possible with A, B, X or ABX filters or
+           with a threshold, in which case the triplets are stored
+           explicitly.
+
+        symmetric_pairs : bool, optional
+           when True, the pairs (i, j) and (j, i) are encoded with the
+           same key so that their distance is computed only once,
+           default to False. This must be used only with symmetric
+           distances (e.g. not with the Kullback-Leibler divergence),
+           the distances are then computed with
+           compute_distances(symmetric=True).
+
+        update : filename, optional
+           a task file previously generated by the same task on a
+           former version of the database. Its 'by' blocks whose items
+           did not change are copied to the output file instead of
+           being generated again. The task files store a hash of the
+           items of each 'by' block for that purpose.
+
+        resume : bool, optional
+           when True, each 'by' block is generated in its own file in
+           the checkpoint directory output + '.checkpoint' and recorded
+           there once complete, so that a run interrupted before the
+           end can be resumed by running it again with resume=True, the
+           recorded blocks being skipped. The checkpoint directory is
+           removed once the output file is written. Default to False.
+
+        max_triplets : int, optional
+           maximal number of triplets of the task. When the task has
+           more triplets, this budget is allocated to the on/across
+           blocks proportionally to their number of triplets (as given
+           by the task statistics) and each block is uniformly sampled
+           down to its share, see allocate_triplets. With a threshold,
+           the blocks are sampled after thresholding, so the task can
+           have less triplets than max_triplets.
+
+        min_block_triplets : int, optional
+           when max_triplets is given, each on/across block keeps at
+           least this number of triplets (or all of them if it has
+           less), the remainder of the budget being allocated
+           proportionally. Default to 0.
+
+        max_pairs : int, optional
+           approximate maximal number of unique pairs of the task, which
+           drives the cost of the distances computation. The A, B and X
+           candidates of each on/across block are sampled, keeping the
+           same fraction of the items in each block (at least one item
+           of each group of B or X candidates sharing the same
+           regressors), and the triplets are formed among the sampled
+           items only, see Task._sample_items. The fraction is estimated
+           from the block sizes before filtering.
+
+        memory : float, optional
+           the memory (in Mo) available to make the pairs of a 'by'
+           block unique. The pairs of the 'by' blocks exceeding it are
+           sorted on disk, in tmpdir. Default to 1000.
 
+        """
         # check we have triplets in the database
         if self.stats['nb_triplets'] == 0:
             warnings.warn('There are no possible ABX triplets'
@@ -706,18 +1387,75 @@ class Task(object):
             return
         self.total_n_triplets = self.stats['nb_triplets']
 
-        # setup threshold
+        # setup threshold and seed. Each 'by' block is sampled with its
+        # own random generator, spawned from the seed (see
+        # by_block_generator), so the sampled triplets of a block do
+        # not depend on the other blocks nor on external calls to
+        # np.random
         self.threshold = threshold if threshold is not None else False
+        self.seed = seed
+
+        # a block can be factorized only if its triplets are the whole
+        # cartesian product of its A, B and X candidates
+        if factorized and (self.threshold or self.filters.A or
+                           self.filters.B or self.filters.X or
+                           self.filters.ABX or self.regressors.ABX or
+                           max_triplets is not None or
+                           max_pairs is not None):
+            warnings.warn(
+                'Cannot factorize a task with A, B, X or ABX filters, '
+                'a threshold or a maximal number of triplets or pairs, '
+                'storing the triplets explicitly', UserWarning)
+            factorized = False
+        self.factorized = factorized
+        self.symmetric_pairs = symmetric_pairs
+        self.memory = memory
+
+        # number of triplets to keep in each on/across block
+        self.max_triplets = max_triplets
+        self.min_block_triplets = min_block_triplets
+        self.block_quotas = self._allocate_triplets()
+
+        # fraction of the A, B and X candidates kept in each block
+        self.max_pairs = max_pairs
+        self.items_fraction = self._items_fraction()
 
         # setup output file, raise an error if the file already exists
         if output is None:
             output = os.path.splitext(self.database)[0] + '.abx'
+        checkpoint = output + '.checkpoint'
         if os.path.exists(output):
-            raise ValueError(
-                'The output file already exists: {}'.format(output))
+            if resume and _interrupted_merge(checkpoint):
+                # the previous run was interrupted while writing output
+                warnings.warn(
+                    'Removing the output file {} left incomplete by the '
+                    'interrupted run'.format(output), UserWarning)
+                os.remove(output)
+            else:
+                raise ValueError(
+                    'The output file already exists: {}'.format(output))
         if self.verbose:
             print('writing output to {}'.format(output))
 
+        if update is not None:
+            unchanged = self._unchanged_bys(update)
+            if unchanged:
+                self._update_triplets(
+                    output, update, unchanged, tmpdir, n_cpu)
+                self._write_hashes(output)
+                return
+
+        if resume:
+            self._generate_triplets_resumable(
+                output, checkpoint, tmpdir, n_cpu)
+            self._write_hashes(output)
+            return
+
+        if n_cpu > 1 and len(self.by_dbs) > 1:
+            self._generate_triplets_parallel(output, tmpdir, n_cpu)
+            self._write_hashes(output)
+            return
+
         self.n_triplets = self.total_n_triplets
 
         display = None
@@ -730,27 +1468,16 @@ class Task(object):
                 'triplets', 'Triplets considered:', self.total_n_triplets)
 
         by_block_indices = [0]
+        by_block_block_indices = [0]
         self.current_index = 0
+        self.current_block_index = 0
 
         # fill output file with list of needed ABX triplets, it is done
         # independently for each 'by' value
         with np2h5.NP2H5(h5file=output) as fh:
-            # FIXME test if not fixed size impacts performance a lot
-            out = fh.add_dataset(
-                group='triplets',
-                dataset='data',
-                n_rows=self.n_triplets,
-                n_columns=3,
-                item_type=fit_integer_type(self.total_n_triplets),
-                fixed_size=False)
-
-            out_block_index = fh.add_dataset(
-                group='triplets',
-                dataset='on_across_block_index',
-                n_rows=self.stats['nb_blocks'],
-                n_columns=1,
-                item_type=fit_integer_type(self.stats['nb_blocks']),
-                fixed_size=False)
+            out, out_block_index = self._add_triplets_datasets(fh)
+            if self.factorized:
+                self.current_item_index = 0
 
             empty_by_blocks = []
             bys = []
@@ -764,22 +1491,35 @@ class Task(object):
                 # variables that are determined by these
                 by_values = dict(db.iloc[0])
 
+                self.rng = by_block_generator(self.seed, by)
+
                 datasets, indexes = self.regressors.get_regressor_info()
+                scalar_names = self._scalar_regressor_names()
                 with h5io.H5IO(
                         filename=output,
                         datasets=datasets,
                         indexes=indexes,
-                        group='/regressors/{}/'.format(str(by))) as out_regs:
-                    self._compute_triplets(
-                        by, out, out_block_index, out_regs, db, fh,
-                        by_values, display=display)
+                        group='/regressors/{}/'.format(str(by)),
+                        run_length=scalar_names) as out_regs:
+                    if self.factorized:
+                        self._compute_factorized_triplets(
+                            by, out, out_block_index, out_regs, db,
+                            by_values, display=display)
+                    else:
+                        self._compute_triplets(
+                            by, out, out_block_index, out_regs, db, fh,
+                            by_values, display=display)
 
                     # if no triplets found: delete by block
                     if self.current_index == by_block_indices[-1]:
                         empty_by_blocks.append(by)
                     else:
                         by_block_indices.append(self.current_index)
+                        by_block_block_indices.append(
+                            self.current_block_index)
                         bys.append(by)
+                        if self.factorized:
+                            self._write_roles(output, by)
 
             # saving by index, deleting empty by blocks:
             aux = np.array(
@@ -796,29 +1536,555 @@ class Task(object):
 
             fh.file['triplets'].create_dataset(
                 'by_index', data=by_block_indices)
-            fh.file['triplets/data'].resize(aux[-1], axis=0)
+            n_triplets = aux[-1]
+            aux = np.array(by_block_block_indices, dtype=np.int64)
+            fh.file['triplets'].create_dataset(
+                'by_block_index',
+                data=np.hstack((aux[:-1, None], aux[1:, None])))
+            if self.factorized:
+                fh.file['triplets'].attrs['factorized'] = True
+                fh.file['triplets/items'].resize(
+                    self.current_item_index, axis=0)
+                fh.file['triplets/blocks'].resize(
+                    self.current_block_index, axis=0)
+            else:
+                fh.file['triplets/data'].resize(n_triplets, axis=0)
+                fh.file['triplets/on_across_block_index'].resize(
+                    self.current_block_index, axis=0)
+
+        if self.verbose:
+            print('done.')
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', tables.NaturalNameWarning)
+            self._generate_pairs(output, tmpdir=tmpdir, memory=self.memory)
+        self._write_hashes(output)
+
+    def _generate_triplets_parallel(self, output, tmpdir, n_cpu):
+        """Generate the task file by distributing 'by' blocks on n_cpu
+
+        The 'by' blocks are split in contiguous chunks of similar
+        number of triplets, each chunk is written by a worker process
+        to a shard (a complete task file restricted to its 'by'
+        blocks) and the shards are finally merged in the output file,
+        following the order of the serial implementation.
+
+        """
+        # several chunks by cpu so that a single big 'by' block does
+        # not delay the whole pool too much
+        bys = list(self.by_dbs)
+        weights = np.array(
+            [self.by_stats[by]['nb_triplets'] + 1 for by in bys],
+            dtype=np.float64)
+        n_chunks = min(len(bys), 4 * n_cpu)
+        bounds = np.searchsorted(
+            np.cumsum(weights),
+            np.sum(weights) * np.arange(1, n_chunks) / n_chunks)
+        chunks = [list(c) for c in np.split(np.arange(len(bys)), bounds)
+                  if c.size > 0]
+
+        shards_dir = tempfile.mkdtemp(dir=tmpdir)
+        try:
+            shards = [os.path.join(shards_dir, 'shard{}.abx'.format(i))
+                      for i in range(len(chunks))]
+            jobs = [([bys[i] for i in chunk], shard, tmpdir)
+                    for chunk, shard in zip(chunks, shards)]
+
+            # the task cannot be pickled (dbfun objects hold compiled
+            # code), so it is inherited by the forked workers instead of
+            # being sent to them
+            global _worker_task
+            _worker_task = self
+            try:
+                pool = multiprocessing.get_context('fork').Pool(n_cpu)
+                try:
+                    done = pool.map(_generate_triplets_worker, jobs)
+                finally:
+                    pool.close()
+                    pool.join()
+            finally:
+                _worker_task = None
+
+            # the workers deleted the empty by blocks on their copy only
+            done = set(by for job_bys in done for by in job_bys)
+            for by in bys:
+                if by not in done:
+                    del self.by_dbs[by]
+
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', tables.NaturalNameWarning)
+                self._merge_shards(
+                    output, [(shard, None) for shard in shards])
+        finally:
+            shutil.rmtree(shards_dir, ignore_errors=True)
 
         if self.verbose:
             print('done.')
 
+    def _generate_triplets_resumable(self, output, checkpoint, tmpdir, n_cpu):
+        """Generate the task file 'by' block by 'by' block, with checkpoints
+
+        Each 'by' block (triplets and unique pairs) is written to its own
+        shard in the checkpoint directory and recorded, with the hash of
+        its items, as an attribute of the 'completed' group of the
+        manifest.h5 file of the directory once the shard is complete.
+        The recorded blocks whose items did not change are not
+        generated again. The shards are finally merged in the output
+        file and the checkpoint directory is removed.
+
+        """
+        manifest = os.path.join(checkpoint, 'manifest.h5')
+        if not os.path.exists(manifest):
+            if not os.path.exists(checkpoint):
+                os.makedirs(checkpoint)
+            with h5py.File(manifest, 'w') as fh:
+                fh.attrs['task_hash'] = self._task_hash()
+                fh.create_group('completed')
+        with h5py.File(manifest, 'r') as fh:
+            if fh.attrs['task_hash'] != self._task_hash():
+                raise ValueError(
+                    'The checkpoint directory {} was not made by the same '
+                    'task, remove it to start again'.format(checkpoint))
+            completed = dict(fh['completed'].attrs)
+
+        hashes = {by: self._by_hash(by) for by in self.by_dbs}
+        shards = {by: os.path.join(
+            checkpoint, hashlib.sha1(str(by).encode('utf8')).hexdigest() +
+            '.abx') for by in self.by_dbs}
+        remaining = [by for by in self.by_dbs
+                     if completed.get(str(by)) != hashes[by]]
+        for by in remaining:
+            # remove the shards of the interrupted blocks
+            if os.path.exists(shards[by]):
+                os.remove(shards[by])
+        if self.verbose:
+            print('resuming from {}: {} on {} by blocks to generate'.format(
+                checkpoint, len(remaining), len(self.by_dbs)))
+
+        def _record(by):
+            with h5py.File(manifest, 'a') as fh:
+                fh['completed'].attrs[str(by)] = hashes[by]
+
+        all_by_dbs = self.by_dbs
+        if n_cpu > 1 and len(remaining) > 1:
+            # see _generate_triplets_parallel
+            global _worker_task
+            _worker_task = self
+            try:
+                pool = multiprocessing.get_context('fork').Pool(n_cpu)
+                try:
+                    jobs = [([by], shards[by], tmpdir) for by in remaining]
+                    for by, _ in zip(remaining, pool.imap(
+                            _generate_triplets_worker, jobs)):
+                        _record(by)
+                finally:
+                    pool.close()
+                    pool.join()
+            finally:
+                _worker_task = None
+        else:
+            verbose = self.verbose
+            self.verbose = False
+            try:
+                for by in remaining:
+                    self.by_dbs = {by: all_by_dbs[by]}
+                    self.generate_triplets(
+                        output=shards[by], threshold=self.threshold or None,
+                        tmpdir=tmpdir, seed=self.seed,
+                        factorized=self.factorized,
+                        symmetric_pairs=self.symmetric_pairs,
+                        max_triplets=self.max_triplets,
+                        min_block_triplets=self.min_block_triplets,
+                        max_pairs=self.max_pairs, memory=self.memory)
+                    _record(by)
+            finally:
+                self.by_dbs = all_by_dbs
+                self.verbose = verbose
+
+        # an output file found when resuming is removed only if it was
+        # being written from the shards, see _interrupted_merge
+        with h5py.File(manifest, 'a') as fh:
+            fh.attrs['merging'] = True
         with warnings.catch_warnings():
             warnings.simplefilter('ignore', tables.NaturalNameWarning)
-            self._generate_pairs(output, tmpdir=tmpdir)
+            self._merge_shards(
+                output, [(shards[by], None) for by in self.by_dbs])
+        shutil.rmtree(checkpoint, ignore_errors=True)
+
+        if self.verbose:
+            print('done.')
+
+    def _add_triplets_datasets(self, fh):
+        """Create the datasets of the triplets in a task file
+
+        Returns the datasets for the triplets (or for the A, B and X
+        candidates of the blocks if the task is factorized) and for the
+        on_across_block_index (or the blocks).
+
+        """
+        if self.factorized:
+            # A, B and X candidates of each on/across block
+            out = fh.add_dataset(
+                group='triplets',
+                dataset='items',
+                n_columns=1,
+                item_type=fit_integer_type(
+                    max([np.max(self.codes[by]['index'])
+                         for by in self.by_dbs]),
+                    is_signed=False),
+                fixed_size=False)
+
+            # start of the candidates and number of A, B and X
+            # candidates of each on/across block
+            out_block_index = fh.add_dataset(
+                group='triplets',
+                dataset='blocks',
+                n_rows=self.stats['nb_blocks'],
+                n_columns=4,
+                item_type=np.int64,
+                fixed_size=False)
+        else:
+            # FIXME test if not fixed size impacts performance a lot
+            out = fh.add_dataset(
+                group='triplets',
+                dataset='data',
+                n_rows=self.total_n_triplets,
+                n_columns=3,
+                item_type=fit_integer_type(self.total_n_triplets),
+                fixed_size=False)
+
+            out_block_index = fh.add_dataset(
+                group='triplets',
+                dataset='on_across_block_index',
+                n_rows=self.stats['nb_blocks'],
+                n_columns=1,
+                item_type=fit_integer_type(self.stats['nb_blocks']),
+                fixed_size=False)
+        return out, out_block_index
+
+    def _merge_shards(self, output, shards):
+        """Concatenate the 'by' blocks of several task files
+
+        shards is a list of (filename, bys) with bys the 'by' blocks to
+        take from that file, or None for all of them. The 'by' blocks
+        are written in the order of self.by_dbs.
+
+        """
+        by_block_indices = [0]
+        by_block_block_indices = [0]
+        pairs_index = 0
+        n_block_index = 0
+        n_items = 0
+        sources = {}
+        fin, fin_name = None, None
+        with np2h5.NP2H5(h5file=output) as fh:
+            out, out_block_index = self._add_triplets_datasets(fh)
+            out_pairs = fh.add_dataset(
+                'unique_pairs', 'data', n_columns=1,
+                item_type=np.int64, fixed_size=False)
+            fh.file['unique_pairs/data'].attrs['symmetric'] = (
+                self.symmetric_pairs)
+            regressors = fh.file.require_group('regressors')
+
+            for shard, shard_bys in shards:
+                if not os.path.exists(shard):
+                    # all the by blocks of that shard were empty
+                    continue
+
+                with h5py.File(shard, 'r') as f:
+                    for n_by, by in enumerate(f['bys'][...]):
+                        if shard_bys is None or by in shard_bys:
+                            sources[by] = (shard, n_by)
+
+                    # regressors are also stored for empty by blocks
+                    for by in f['regressors']:
+                        if ((shard_bys is None or by in shard_bys) and
+                                by not in regressors):
+                            f.copy('regressors/' + by, regressors)
+
+            # there can be a shard by 'by' block, so only one shard is
+            # opened at a time
+            bys = [str(by) for by in self.by_dbs if str(by) in sources]
+            try:
+                for by in bys:
+                    shard, n_by = sources[by]
+                    if fin_name != shard:
+                        if fin is not None:
+                            fin.close()
+                        fin, fin_name = h5py.File(shard, 'r'), shard
+                    start, stop = fin['triplets/by_index'][n_by]
+                    by_block_indices.append(
+                        by_block_indices[-1] + stop - start)
+
+                    block_start, block_stop = (
+                        fin['triplets/by_block_index'][n_by])
+                    if self.factorized:
+                        # shift the start of the candidates of each block
+                        block_index = fin['triplets/blocks'][
+                            block_start:block_stop]
+                        first = block_index[0, 0]
+                        last = block_index[-1, 0] + np.sum(block_index[-1, 1:])
+                        out.write(fin['triplets/items'][first:last])
+                        block_index[:, 0] += n_items - first
+                        n_items += last - first
+                    else:
+                        out.write(fin['triplets/data'][start:stop])
+                        block_index = fin['triplets/on_across_block_index'][
+                            block_start:block_stop]
+                    out_block_index.write(block_index)
+                    n_block_index += block_index.shape[0]
+                    by_block_block_indices.append(n_block_index)
+
+                    base, start, stop = fin['unique_pairs'].attrs[by]
+                    out_pairs.write(fin['unique_pairs/data'][start:stop])
+                    fh.file['unique_pairs'].attrs[by] = (
+                        base, pairs_index, pairs_index + stop - start)
+                    pairs_index += stop - start
+            finally:
+                if fin is not None:
+                    fin.close()
+
+            aux = np.array(
+                by_block_indices,
+                dtype=fit_integer_type(by_block_indices[-1]))
+            fh.file.create_dataset(
+                'bys', (aux.shape[0] - 1,),
+                dtype=h5py.special_dtype(vlen=str))
+            fh.file['bys'][:] = bys
+            fh.file['triplets'].create_dataset(
+                'by_index',
+                data=np.hstack((aux[:-1, None], aux[1:, None])))
+            n_triplets = aux[-1]
+            aux = np.array(by_block_block_indices, dtype=np.int64)
+            fh.file['triplets'].create_dataset(
+                'by_block_index',
+                data=np.hstack((aux[:-1, None], aux[1:, None])))
+            if self.factorized:
+                fh.file['triplets'].attrs['factorized'] = True
+                fh.file['triplets/items'].resize(n_items, axis=0)
+                fh.file['triplets/blocks'].resize(n_block_index, axis=0)
+            else:
+                fh.file['triplets/data'].resize(n_triplets, axis=0)
+                fh.file['triplets/on_across_block_index'].resize(
+                    n_block_index, axis=0)
+
+        # delete the empty by blocks
+        for by in list(self.by_dbs):
+            if str(by) not in sources:
+                del self.by_dbs[by]
+
+        store = pd.HDFStore(output)
+        for by, feat_db in iteritems(self.feat_dbs):
+            if by in self.by_dbs:
+                store.append('/feat_dbs/' + str(by), feat_db,
+                             expectedrows=len(feat_db))
+        store.close()
+
+    def _unchanged_bys(self, update):
+        """The 'by' blocks of the task that can be copied from a task file
+
+        Returns the 'by' blocks whose items are the same as when the
+        task file update was generated, or an empty list if it was
+        generated by another task.
+
+        """
+        with h5py.File(update, 'r') as fh:
+            task_hash, hashes = triplets_io.read_hashes(fh)
+        if task_hash != self._task_hash():
+            warnings.warn(
+                'The task file {} was not generated by the same task, '
+                'it cannot be updated'.format(update), UserWarning)
+            return []
+        return [by for by in self.by_dbs
+                if hashes.get(str(by)) == self._by_hash(by)]
+
+    def _update_triplets(self, output, update, unchanged, tmpdir, n_cpu):
+        """Generate the task file, copying unchanged 'by' blocks
+
+        The 'by' blocks which are not in unchanged are written to a
+        temporary task file, which is then merged with the unchanged
+        blocks of the task file update.
+
+        """
+        all_by_dbs = self.by_dbs
+        self.by_dbs = {by: db for by, db in iteritems(all_by_dbs)
+                       if by not in unchanged}
+        shard_dir = tempfile.mkdtemp(dir=tmpdir)
+        try:
+            shard = os.path.join(shard_dir, 'update.abx')
+            try:
+                if self.by_dbs:
+                    self.generate_triplets(
+                        output=shard, threshold=self.threshold or None,
+                        tmpdir=tmpdir, seed=self.seed, n_cpu=n_cpu,
+                        factorized=self.factorized,
+                        symmetric_pairs=self.symmetric_pairs,
+                        max_triplets=self.max_triplets,
+                        min_block_triplets=self.min_block_triplets,
+                        max_pairs=self.max_pairs, memory=self.memory)
+            finally:
+                # empty by blocks were deleted by generate_triplets
+                self.by_dbs = {by: db for by, db in iteritems(all_by_dbs)
+                               if by in unchanged or by in self.by_dbs}
+
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', tables.NaturalNameWarning)
+                self._merge_shards(
+                    output, [(update, [str(by) for by in unchanged]),
+                             (shard, None)])
+        finally:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+        if self.verbose:
+            print('done.')
+
+    def _task_hash(self):
+        """Hash of the task specification and generation parameters"""
+        return hashlib.sha1(repr(
+            (self._specification, self.threshold, self.seed,
+             self.factorized, self.symmetric_pairs, self.max_triplets,
+             self.min_block_triplets, self.max_pairs)).encode('utf8')
+        ).hexdigest()
+
+    def _by_hash(self, by):
+        """Hash of the items of a 'by' block and of its sampling
+
+        The triplets quotas and the fraction of sampled items of a block
+        depend on the whole task.
+
+        """
+        h = by_block_hash(self.by_dbs[by], self.feat_dbs[by])
+        if self.block_quotas is not None or self.items_fraction < 1:
+            quotas = (sorted(self.block_quotas[by].items())
+                      if self.block_quotas is not None else None)
+            h = hashlib.sha1(repr(
+                (h, quotas, self.items_fraction)).encode('utf8')
+            ).hexdigest()
+        return h
+
+    def _allocate_triplets(self):
+        """Number of triplets to keep in each on/across block
+
+        Returns None if there is no maximal number of triplets, else a
+        dict by -> {block_key: quota}, see allocate_triplets. The
+        allocation only depends on the task statistics so it is the
+        same when generating a subset of the 'by' blocks.
+
+        """
+        if self.max_triplets is None:
+            return None
+        key = (self.max_triplets, self.min_block_triplets)
+        if getattr(self, '_quotas_key', None) == key:
+            return self.block_quotas
+
+        blocks = [(by, block_key) for by, stats in iteritems(self.by_stats)
+                  for block_key in stats['block_sizes']]
+        sizes = [self.by_stats[by]['block_sizes'][block_key]
+                 for by, block_key in blocks]
+        quotas = {by: {} for by in self.by_stats}
+        for (by, block_key), quota in zip(blocks, allocate_triplets(
+                sizes, self.max_triplets, self.min_block_triplets)):
+            quotas[by][block_key] = int(quota)
+        self._quotas_key = key
+        return quotas
+
+    def _items_fraction(self):
+        """Fraction of the A, B and X candidates kept in each block
+
+        Returns 1 if there is no maximal number of pairs, else the
+        largest fraction for which the estimated number of unique pairs
+        of the task is at most self.max_pairs. Sampling a fraction f of
+        the candidates of a block with n_A, n_B and n_X candidates
+        leaves about f * n_X * f * (n_A + n_B) AX and BX pairs (with at
+        least one candidate of each kind).
+
+        """
+        if self.max_pairs is None or not self.by_dbs:
+            return 1.
+        # computed once for the whole task, as for the quotas
+        if getattr(self, '_fraction_key', None) == self.max_pairs:
+            return self.items_fraction
+        self._fraction_key = self.max_pairs
+
+        _, n_A, n_B, _, n_X = block_counts(
+            self._items_table(), self.on, self.across,
+            self.across == ['#across'])
+
+        def n_pairs(fraction):
+            def kept(n):
+                return np.minimum(n, np.maximum(np.ceil(fraction * n), 1))
+            return np.sum(kept(n_X) * (kept(n_A) + kept(n_B)))
+
+        if n_pairs(1.) <= self.max_pairs:
+            return 1.
+        # bisection on the fraction, the number of pairs increasing
+        # with it
+        low, high = 0., 1.
+        for _ in range(50):
+            middle = (low + high) / 2
+            if n_pairs(middle) <= self.max_pairs:
+                low = middle
+            else:
+                high = middle
+        return low
+
+    def _write_hashes(self, output):
+        """Store the hashes used to update the task file"""
+        by_keys = {str(by): by for by in self.by_dbs}
+        with h5py.File(output, 'a') as fh:
+            hashes = [self._by_hash(by_keys[by]) for by in fh['bys'][...]]
+            fh.create_dataset(
+                'by_hashes', (len(hashes),),
+                dtype=h5py.special_dtype(vlen=str))
+            fh['by_hashes'][:] = hashes
+            fh.attrs['task_hash'] = self._task_hash()
 
     def _compute_triplets(self, by, out, out_block_index,
                           out_regs, db, fh, by_values, display=None):
         # instantiate by regressors here
         self.regressors.set_by_regressors(by_values)
 
+        # small on/across blocks are accumulated and processed together,
+        # see _write_batch
+        batch = [] if self._batchable() else None
+        batch_size = 0
+        quotas = self.block_quotas[by] if self.block_quotas else {}
+
+        if batch is not None and not quotas and self.across == ['#across']:
+            self._compute_no_across_triplets(
+                by, out, out_block_index, out_regs, db, display)
+            return
+
         # iterate over on/across blocks
+        attributes = AttributeTable(db)
         on_across_blocks = iteritems(self.on_across_blocks[by].groups)
         for block_key, block in on_across_blocks:
+            if batch is not None:
+                _, across = on_across_from_key(block_key)
+                A, B, X = self._ABX_candidates(by, across, block)
+                size = len(A) * len(B) * len(X)
+                # the blocks to sample are processed one by one
+                if (size <= BATCH_MAX_BLOCK_SIZE and
+                        quotas.get(block_key, size) >= size):
+                    batch.append((block_key, A, B, X))
+                    batch_size += size
+                    if batch_size >= BATCH_SIZE:
+                        self._write_batch(by, batch, out, out_block_index,
+                                          out_regs, db, display)
+                        batch, batch_size = [], 0
+                    continue
+
+                # keep the order of the blocks in the output
+                self._write_batch(by, batch, out, out_block_index,
+                                  out_regs, db, display)
+                batch, batch_size = [], 0
+
             if self.verbose:
                 display.update('block', 1)
 
             # allow to get on, across, by values as well as values of
             # other variables that are determined by these
-            on_across_by_values = dict(db.iloc[block[0]])
+            on_across_by_values = attributes.loc(block[0])
             if self.filters.on_across_by_filter(on_across_by_values):
                 # instantiate on_across_by regressors here
                 self.regressors.set_on_across_by_regressors(
@@ -828,12 +2094,15 @@ class Task(object):
 
                 triplets, regressors, on_across_block_index = (
                     self.on_across_triplets(
-                        by, on, across, block, on_across_by_values))
+                        by, on, across, block, on_across_by_values,
+                        quota=quotas.get(block_key)))
 
                 out.write(triplets)
-                out_regs.write(regressors, indexed=True)
+                out_regs.write(regressors, indexed=True,
+                               run_lengths=[triplets.shape[0]])
                 out_block_index.write(on_across_block_index)
                 self.current_index += triplets.shape[0]
+                self.current_block_index += on_across_block_index.shape[0]
 
                 if self.verbose:
                     display.update(
@@ -843,148 +2112,459 @@ class Task(object):
             if self.verbose:
                 display.display()
 
-    # FIXME clean this function (maybe do a few well-separated sub-functions
-    # for getting the pairs and unique them)
-    def _generate_pairs(self, output=None, tmpdir=None):
-        """Generate the pairs associated to the triplet list"""
+        if batch:
+            self._write_batch(
+                by, batch, out, out_block_index, out_regs, db, display)
+
+    def _compute_no_across_triplets(self, by, out, out_block_index,
+                                    out_regs, db, display=None):
+        """Write the triplets of a 'by' block of a task without 'across'
+
+        Without 'across' attribute, each item is its own on/across
+        block (see the dummy '#across' column), and the blocks of an
+        'on' level share their candidates: B is any item of another
+        'on' level and X any item of the 'on' level but A. The triplets
+        of consecutive blocks of an 'on' level are thus generated
+        together from the items of the level, without going through
+        the on/across groups, and written as by _write_batch.
+
+        """
+        codes = self.codes[by]
+        members, offsets = codes['on_members'], codes['on_offsets']
+        index = codes['index'].astype(self.types[by])
+
+        # the regressors of B and X depend on the 'on' level of the
+        # block only through the 'on' context, without it they are
+        # evaluated once for all the items of the 'by' block
+        shared = not any(self.regressors.on_context[stage]
+                         for stage in ('B', 'X'))
+        if shared:
+            all_regs = [self._candidate_regressors(stage, db, index, index)
+                        for stage in ('B', 'X')]
+
+        for on_code in range(len(offsets) - 1):
+            start, stop = offsets[on_code], offsets[on_code + 1]
+            # the items are sorted within a level, so are the candidates
+            A = members[start:stop].astype(self.types[by])
+            B = np.sort(np.concatenate(
+                (members[:start], members[stop:]))).astype(self.types[by])
+            if shared:
+                B_regs, X_regs = (
+                    [(name, reg[np.searchsorted(index, items)])
+                     for name, reg in regs]
+                    for regs, items in zip(all_regs, (B, A)))
+            else:
+                B_regs, X_regs = (
+                    self._candidate_regressors(
+                        stage, db, items, np.repeat(A[0], len(items)))
+                    for stage, items in (('B', B), ('X', A)))
+
+            n_X = len(A) - 1
+            block_size = len(B) * n_X
+            step = max(1, BATCH_SIZE // max(block_size, 1))
+            for first in range(0, len(A), step):
+                last = min(first + step, len(A))
+                sizes = np.repeat(np.int64(block_size), last - first)
+                # the triplets of the blocks, in the order of
+                # on_across_triplets, are indexed by (A, B, X)
+                shape = (last - first, len(B), n_X)
+                iA = np.arange(first, last)[:, None, None]
+                iX = np.arange(n_X)[None, None, :]
+                seg = np.broadcast_to(iA - first, shape).ravel()
+                iB = np.broadcast_to(
+                    np.arange(len(B))[None, :, None], shape).ravel()
+                # X skips the position of A in the level
+                iX = np.broadcast_to(iX + (iX >= iA), shape).ravel()
+                A_regs = self._candidate_regressors(
+                    'A', db, A[first:last], A[first:last])
+                self._write_blocks(
+                    by, A[first:last], sizes, seg,
+                    np.column_stack((A[first + seg], B[iB], A[iX])),
+                    ((A_regs, seg), (B_regs, iB), (X_regs, iX)),
+                    out, out_block_index, out_regs, db, display)
+
+    def _compute_factorized_triplets(self, by, out_items, out_blocks,
+                                     out_regs, db, by_values, display=None):
+        """Write the A, B and X candidates of the on/across blocks
+
+        Used instead of _compute_triplets for factorized task files,
+        the regressors are stored for each candidate, see _write_roles.
+
+        """
+        # instantiate by regressors here
+        self.regressors.set_by_regressors(by_values)
+
+        # iterate over on/across blocks
+        attributes = AttributeTable(db)
+        on_across_blocks = iteritems(self.on_across_blocks[by].groups)
+        for block_key, block in on_across_blocks:
+            if self.verbose:
+                display.update('block', 1)
+
+            on_across_by_values = attributes.loc(block[0])
+            if self.filters.on_across_by_filter(on_across_by_values):
+                _, across = on_across_from_key(block_key)
+                A, B, X = self._ABX_candidates(by, across, block)
+                size = len(A) * len(B) * len(X)
+                if size == 0:
+                    continue
+
+                # instantiate on_across_by, A, B, X regressors here
+                self.regressors.set_on_across_by_regressors(
+                    on_across_by_values)
+                self.regressors.set_A_regressors(on_across_by_values, db, A)
+                self.regressors.set_B_regressors(on_across_by_values, db, B)
+                self.regressors.set_X_regressors(on_across_by_values, db, X)
+
+                # each regressor is defined on the candidates it is read
+                # on, and set to 0 on the others, the by and on_across_by
+                # regressors are stored once for the block
+                n_items = len(A) + len(B) + len(X)
+                regressors = self._scalar_regressors()
+
+                candidates = [0, len(A), len(A) + len(B), n_items]
+                for i, stage in enumerate(('A', 'B', 'X')):
+                    for names, regs in zip(
+                            getattr(self.regressors, stage + '_names'),
+                            getattr(self.regressors, stage + '_regressors')):
+                        for name, reg in zip(names, regs):
+                            reg = np.asarray(reg)
+                            regressors[name] = np.zeros(
+                                n_items, dtype=reg.dtype)
+                            regressors[name][
+                                candidates[i]:candidates[i + 1]] = reg
+
+                out_items.write(np.concatenate((A, B, X))[:, None])
+                out_blocks.write(np.array(
+                    [[self.current_item_index, len(A), len(B), len(X)]]))
+                out_regs.write(regressors, indexed=True,
+                               run_lengths=[n_items])
+                self.current_index += size
+                self.current_item_index += n_items
+                self.current_block_index += 1
+
+                if self.verbose:
+                    display.update('triplets', size)
+
+            if self.verbose:
+                display.display()
+
+    def _write_roles(self, output, by):
+        """Store the roles of the regressors of a factorized 'by' block
+
+        The role of each column of the indexed regressors is 0, 1 or 2
+        if it is read on the A, B or X item of a triplet.
+
+        """
+        roles = {}
+        for role, stages in ((0, ('by', 'on_across_by', 'A')),
+                             (1, ('B',)), (2, ('X',))):
+            for stage in stages:
+                for names in getattr(self.regressors, stage + '_names'):
+                    for name in names:
+                        roles[name] = role
+
+        with h5py.File(output, 'a') as fh:
+            group = fh['regressors'][str(by)]
+            dims = np.diff(np.concatenate(
+                ([0], group['indexed_cumudims'][...].astype(np.int64))))
+            group.create_dataset('roles', data=np.repeat(
+                [roles[name] for name in group['non_fused_datasets'][...]],
+                dims).astype(np.uint8))
+
+    def _batchable(self):
+        """Return True if the on/across blocks can be processed in batches
+
+        This requires that no filter has to be evaluated in the blocks
+        and that all the regressors computed in the blocks are
+        evaluated element-wise (database columns or lookup tables).
+
+        """
+        if (self.filters.on_across_by or self.filters.A or self.filters.B
+                or self.filters.X or self.filters.ABX or self.regressors.ABX):
+            return False
+
+        # the candidates are sampled block by block
+        if self.items_fraction < 1:
+            return False
+
+        # the B and X regressors are needed to sort the triplets
+        if not (self.regressors.B or self.regressors.X):
+            return False
+
+        return all(
+            isinstance(db_fun, (dbfun_column.DBfun_Column,
+                                dbfun_lookuptable.DBfun_LookupTable))
+            for stage in ('on_across_by', 'A', 'B', 'X')
+            for db_fun in getattr(self.regressors, stage))
+
+    def _write_batch(self, by, batch, out, out_block_index, out_regs,
+                     db, display=None):
+        """Generate and write the triplets of several on/across blocks
+
+        batch is a list of (block_key, A, B, X) for consecutive
+        on/across blocks of the 'by' block. The triplets, regressors
+        and on_across_block_index are the same as if the blocks were
+        processed one by one with on_across_triplets, but they are
+        computed for the whole batch in a few numpy calls and written
+        at once.
+
+        """
+        if not batch:
+            return
+
+        n_A = np.array([len(A) for _, A, _, _ in batch], dtype=np.int64)
+        n_B = np.array([len(B) for _, _, B, _ in batch], dtype=np.int64)
+        n_X = np.array([len(X) for _, _, _, X in batch], dtype=np.int64)
+        sizes = n_A * n_B * n_X
+        offsets = np.concatenate(([0], np.cumsum(sizes)))
+        size = offsets[-1]
+
+        # concatenated A, B and X candidates, with the block of each
+        # of them given by one of its items
+        A, B, X = (np.concatenate([block[i] for block in batch])
+                   for i in (1, 2, 3))
+        first = np.array([block[1][0] for block in batch])
+        A_blocks = np.repeat(first, n_A)
+        B_blocks = np.repeat(first, n_B)
+        X_blocks = np.repeat(first, n_X)
+
+        # generate triplets from indices, as in on_across_triplets but
+        # with the indices relative to the block of each triplet
+        seg = np.repeat(np.arange(len(batch)), sizes)
+        indices = np.arange(size, dtype=np.int64) - offsets[seg]
+        iX = np.mod(indices, n_X[seg])
+        iB = np.mod(np.floor_divide(indices, n_X[seg]), n_B[seg])
+        iA = np.floor_divide(indices, n_B[seg] * n_X[seg])
+        iA += np.concatenate(([0], np.cumsum(n_A)))[seg]
+        iB += np.concatenate(([0], np.cumsum(n_B)))[seg]
+        iX += np.concatenate(([0], np.cumsum(n_X)))[seg]
+
+        self._write_blocks(
+            by, first, sizes, seg, np.column_stack((A[iA], B[iB], X[iX])),
+            ((self._candidate_regressors('A', db, A, A_blocks), iA),
+             (self._candidate_regressors('B', db, B, B_blocks), iB),
+             (self._candidate_regressors('X', db, X, X_blocks), iX)),
+            out, out_block_index, out_regs, db, display)
+
+    def _candidate_regressors(self, stage, db, items, blocks):
+        """Evaluate the regressors of A, B or X candidates
+
+        blocks contains an item of the on/across block of each
+        candidate, giving the context of its regressors. Returns the
+        list of the (name, values) of the regressors.
+
+        """
+        return [(name, np.asarray(reg)) for names, regs in zip(
+                    getattr(self.regressors, stage + '_names'),
+                    self.regressors.evaluate_blocks(stage, db, blocks, items))
+                for name, reg in zip(names, regs)]
+
+    def _write_blocks(self, by, first, sizes, seg, triplets, candidates,
+                      out, out_block_index, out_regs, db, display=None):
+        """Write the triplets of consecutive on/across blocks
+
+        first contains an item of each block, sizes the number of
+        triplets of each block and seg the block of each triplet.
+        candidates contains, for A, B and X, the regressors of the
+        candidates (see _candidate_regressors) and the position of the
+        candidate of each triplet.
+
+        """
+        offsets = np.concatenate(([0], np.cumsum(sizes)))
+        size = offsets[-1]
+
+        # regressors of the A, B, X items
+        regressors = {}
+        sort_keys = []
+        for stage, (regs, ind) in zip('ABX', candidates):
+            for name, reg in regs:
+                regressors[name] = reg[ind]
+                if stage != 'A':
+                    sort_keys.append(regressors[name])
+
+        # sort the triplets of each block on their B and X regressors
+        # (with a stable sort, as in on_across_triplets), then threshold
+        # the groups of triplets with the same regressors
+        if size > 0:
+            groups = encode_keys([seg] + sort_keys)
+            if groups is not None:
+                order = counting_sort(groups, np.max(groups) + 1)
+            else:
+                order = np.lexsort(sort_keys[::-1] + [seg])
+                change = seg[order][1:] != seg[order][:-1]
+                for key in sort_keys:
+                    change |= key[order][1:] != key[order][:-1]
+                groups = np.empty(size, dtype=np.int64)
+                groups[order] = np.concatenate(([0], np.cumsum(change)))
+            permut, starts = sort_and_threshold(
+                order, groups, fit_integer_type(size, is_signed=False),
+                threshold=self.threshold, rng=self.rng)
+            starts = starts[:-1]
+        else:
+            permut = np.empty(shape=0, dtype=np.int64)
+            starts = np.empty(shape=0, dtype=np.int64)
+
+        triplets = triplets[permut]
+        for name in regressors:
+            regressors[name] = regressors[name][permut]
+
+        # the by and on_across_by regressors are stored once per block
+        for names, regs in zip(
+                self.regressors.by_names, self.regressors.by_regressors):
+            for name, reg in zip(names, regs):
+                regressors[name] = np.tile(np.array(reg), (len(sizes), 1))
+        for names, regs in zip(
+                self.regressors.on_across_by_names,
+                self.regressors.evaluate_blocks('on_across_by', db, first)):
+            for name, reg in zip(names, regs):
+                regressors[name] = np.asarray(reg)[:, None]
+
+        # for each block, the start of its groups of triplets relative
+        # to the block, then the size of the block
+        n_groups = np.bincount(seg[starts], minlength=len(sizes))
+        ends = np.cumsum(n_groups + 1) - 1
+        on_across_block_index = np.empty(
+            len(starts) + len(sizes), dtype=np.int64)
+        is_end = np.zeros(len(on_across_block_index), dtype=bool)
+        is_end[ends] = True
+        on_across_block_index[ends] = sizes
+        on_across_block_index[~is_end] = starts - offsets[seg[starts]]
+
+        out.write(triplets)
+        out_regs.write(regressors, indexed=True, run_lengths=np.bincount(
+            seg[permut], minlength=len(sizes)))
+        out_block_index.write(on_across_block_index[:, None])
+        self.current_index += triplets.shape[0]
+        self.current_block_index += on_across_block_index.shape[0]
+
+        if self.verbose:
+            display.update('block', len(sizes))
+            display.update('triplets', int(size))
+            display.display()
 
+    def _generate_pairs(self, output=None, tmpdir=None, memory=1000):
+        """Generate the pairs associated to the triplet list
+
+        The unique pairs of a 'by' block are computed in memory when
+        possible given the available memory (in Mo), else they are
+        sorted on disk and made unique while being written to the task
+        file.
+
+        """
         # FIXME change this to a random file name to avoid overwriting problems
         # default name for output file
         if output is None:
             (basename, _) = os.path.splitext(self.database)
             output = basename + '.abx'
-        # list all pairs
-        n_pairs_dict = {}
-        max_ind_dict = {}
+
+        _, output_tmp = tempfile.mkstemp(dir=tmpdir)
         try:
-            _, output_tmp = tempfile.mkstemp(dir=tmpdir)
-            for n_by, (by, db) in enumerate(iteritems(self.by_dbs)):
-                if self.verbose > 0:
-                    print("Writing AX/BX pairs to task file...")
-                with h5py.File(output, 'a') as fh:
-                    triplets_attrs = fh['/triplets']['by_index'][n_by][...]
-                max_ind = np.max(db.index.values)
-                max_ind_dict[by] = max_ind
-                pair_key_type = fit_integer_type(
-                    (max_ind + 1) ** 2 - 1, is_signed=False)
-                with h52np.H52NP(output) as f_in:
-                    with np2h5.NP2H5(output_tmp) as f_out:
-                        inp = f_in.add_subdataset('triplets', 'data',
-                                                  indexes=triplets_attrs)
-                        out = f_out.add_dataset(
-                            'pairs', str(by), n_columns=1,
-                            item_type=pair_key_type, fixed_size=False)
-                        for data in inp:
-                            triplets = pair_key_type(data)
-                            n = triplets.shape[0]
-                            ind = np.arange(n)
-                            i1 = 2 * ind
-                            i2 = 2 * ind + 1
-
-                            pairs = np.empty(
-                                shape=(2 * n, 1),
-                                dtype=pair_key_type)
-
-                            # FIXME change the encoding (and type_fitting)
-                            # so that A,B and B,A have the same code ...
-                            # (take a=min(a,b), b=max(a,b))
-                            # FIXME but allow a flag to control the
-                            # behavior to be able to enforce A,X and B,X
-                            # order when using assymetrical distance
-                            # functions
-                            pairs[i1, 0] = triplets[:, 0] + (
-                                max_ind + 1) * triplets[:, 2]  # AX
-                            pairs[i2, 0] = triplets[:, 1] + (
-                                max_ind + 1) * triplets[:, 2]  # BX
-
-                            # FIXME do a unique here already? Do not store
-                            # the inverse mapping ? (could sort triplets on
-                            # pair1, complete pair1, sort on pair2,
-                            # complete pair 2 and shuffle ?)
-                            out.write(pairs)
-
-                    sort_pairs(output_tmp, by, tmpdir=tmpdir)
-
-                    # counting unique
-                    with np2h5.NP2H5(output_tmp) as f_out:
-                        with h52np.H52NP(output_tmp) as f_in:
-                            inp = f_in.add_dataset('pairs', str(by))
-                            n_pairs = 0
-                            last = -1
-                            for pairs in inp:
-                                # unique alters the shape
-                                pairs = np.reshape(pairs, (pairs.shape[0], 1))
-                                n_pairs += np.unique(pairs).size
-                                if pairs[0, 0] == last:
-                                    n_pairs -= 1
-                                if pairs.size > 0:
-                                    last = pairs[-1, 0]
-                        n_pairs_dict[by] = n_pairs
-
-                    # FIXME should have a unique function directly instead of
-                    # sorting + unique ?
-                    with np2h5.NP2H5(output_tmp) as f_out:
-                        with h52np.H52NP(output_tmp) as f_in:
-                            inp = f_in.add_dataset('pairs', str(by))
-                            out = f_out.add_dataset(
-                                'unique_pairs', str(by),
-                                n_rows=n_pairs,
-                                n_columns=1,
-                                item_type=pair_key_type,
-                                fixed_size=False)
-
-                            # out = out_unique_pairs
-                            last = -1
-                            for pairs in inp:
-                                pairs = np.unique(pairs)
-                                # unique alters the shape
-                                pairs = np.reshape(pairs, (pairs.shape[0], 1))
-                                if pairs[0, 0] == last:
-                                    pairs = pairs[1:]
-                                if pairs.size > 0:
-                                    last = pairs[-1, 0]
-                                    out.write(pairs)
-
-                        # store for ulterior decoding
-                        store = pd.HDFStore(output)
-
-                        # use append to make use of table format,
-                        # which is better at handling strings without
-                        # much space (fixed-size format)
-                        store.append('/feat_dbs/' + str(by), self.feat_dbs[by],
-                                     expectedrows=len(self.feat_dbs[by]))
-                        store.close()
-                        # FIXME generate inverse mapping to triplets
-                        # (1 and 2) ?
-
-            # Now merge all datasets
-            by_index = 0
             with np2h5.NP2H5(output) as f_out:
-                n_rows = sum(itervalues(n_pairs_dict))
-                out_unique_pairs = f_out.add_dataset(
-                    'unique_pairs', 'data', n_rows=n_rows, n_columns=1,
+                out = f_out.add_dataset(
+                    'unique_pairs', 'data', n_columns=1,
                     item_type=np.int64, fixed_size=False)
+                f_out.file['unique_pairs/data'].attrs['symmetric'] = (
+                    self.symmetric_pairs)
+                n_pairs = 0
                 for n_by, (by, db) in enumerate(iteritems(self.by_dbs)):
-                    triplets_attrs = f_out.file['/triplets']['by_index'][n_by]
-                    if triplets_attrs[0] == triplets_attrs[1]:
-                        # subdataset is empty
-                        continue
-
-                    with h52np.H52NP(output_tmp) as f_in:
-                        inp = f_in.add_dataset('unique_pairs', str(by))
-                        for pairs in inp:
-                            out_unique_pairs.write(pairs)
-
-                    with h5py.File(output, 'a') as fh:
-                        fh['/unique_pairs'].attrs[str(by)] = (
-                            max_ind_dict[by] + 1,
-                            by_index, by_index + n_pairs_dict[by])
-                    by_index += n_pairs_dict[by]
+                    if self.verbose > 0:
+                        print("Writing AX/BX pairs to task file...")
+                    base = np.max(db.index.values) + 1
+                    pair_key_type = fit_integer_type(
+                        base ** 2 - 1, is_signed=False)
+
+                    # np.unique needs about three times the size of the
+                    # pairs (concatenation, sort and result)
+                    size = (self._n_pairs(f_out.file, n_by) *
+                            np.dtype(pair_key_type).itemsize)
+                    if 3 * size <= 0.75 * memory * 1e6:
+                        pairs = np.unique(np.concatenate(list(
+                            self._pairs(f_out.file, n_by, base,
+                                        pair_key_type))))
+                        out.write(np.reshape(pairs, (pairs.shape[0], 1)))
+                        n_by_pairs = pairs.shape[0]
+                    else:
+                        n_by_pairs = self._external_unique_pairs(
+                            f_out.file, n_by, by, base, pair_key_type, out,
+                            output_tmp, tmpdir, memory)
+
+                    f_out.file['unique_pairs'].attrs[str(by)] = (
+                        base, n_pairs, n_pairs + n_by_pairs)
+                    n_pairs += n_by_pairs
         finally:
             os.remove(output_tmp)
+
+        # store for ulterior decoding, use append to make use of table
+        # format, which is better at handling strings without much
+        # space (fixed-size format)
+        store = pd.HDFStore(output)
+        for by in self.by_dbs:
+            store.append('/feat_dbs/' + str(by), self.feat_dbs[by],
+                         expectedrows=len(self.feat_dbs[by]))
+        store.close()
+
         if self.verbose:
             print("done.")
 
+    def _n_pairs(self, fid, n_by):
+        """Number of AX and BX pairs (with duplicates) of a 'by' block"""
+        if self.factorized:
+            _, blocks = triplets_io.read_blocks(fid, n_by)
+            return np.sum((blocks[:, 1] + blocks[:, 2]) * blocks[:, 3])
+        start, stop = fid['triplets/by_index'][n_by]
+        return 2 * (stop - start)
+
+    def _pairs(self, fid, n_by, base, pair_key_type):
+        """Yields the AX and BX pairs of a 'by' block, with duplicates"""
+        if self.factorized:
+            # no need to enumerate the triplets
+            items, blocks = triplets_io.read_blocks(fid, n_by)
+            for pairs in factorized_pairs(
+                    items, blocks, base, pair_key_type,
+                    symmetric=self.symmetric_pairs):
+                yield pairs
+        else:
+            for triplets in triplets_io.read_triplets(fid, n_by):
+                triplets = pair_key_type(triplets)
+                yield np.concatenate([
+                    triplets_io.pair_keys(
+                        triplets[:, i], triplets[:, 2], base,
+                        symmetric=self.symmetric_pairs)
+                    for i in (0, 1)])[:, None]
+
+    def _external_unique_pairs(self, fid, n_by, by, base, pair_key_type,
+                               out, output_tmp, tmpdir, memory):
+        """Write the unique pairs of a 'by' block sorted on disk
+
+        The pairs are written to output_tmp and sorted there (see
+        sort_pairs), they are then made unique and written to out in a
+        single pass. Returns the number of unique pairs.
+
+        """
+        with np2h5.NP2H5(output_tmp) as f_tmp:
+            out_tmp = f_tmp.add_dataset(
+                'pairs', str(by), n_columns=1,
+                item_type=pair_key_type, fixed_size=False)
+            for pairs in self._pairs(fid, n_by, base, pair_key_type):
+                out_tmp.write(pairs)
+
+        sort_pairs(output_tmp, by, memory=memory, tmpdir=tmpdir)
+
+        n_pairs = 0
+        last = -1
+        with h52np.H52NP(output_tmp) as f_in:
+            inp = f_in.add_dataset('pairs', str(by))
+            for pairs in inp:
+                pairs = np.unique(pairs)
+                if pairs.size > 0 and pairs[0] == last:
+                    pairs = pairs[1:]
+                if pairs.size > 0:
+                    last = pairs[-1]
+                    out.write(np.reshape(pairs, (pairs.shape[0], 1)))
+                    n_pairs += pairs.shape[0]
+        return n_pairs
+
     # number of triplets when triplets with same on, across, by are
     # counted as one
     #
@@ -1013,40 +2593,16 @@ class Task(object):
                 display.display()
 
             n = 0
+            attributes = AttributeTable(db)
             # iterate over on/across blocks
             for block_key, n_block in (
                     iteritems(self.by_stats[by]['on_across_levels'])):
                 block = self.on_across_blocks[by].groups[block_key]
-                on_across_by_values = dict(db.ix[block[0]])
+                on_across_by_values = attributes.loc(block[0])
                 on, across = on_across_from_key(block_key)
 
                 if self.filters.on_across_by_filter(on_across_by_values):
-                    # find all possible A, B, X where A and X have the 'on'
-                    # feature of the block and A and B have the 'across'
-                    # feature of the block
-                    A = np.array(
-                        self.on_across_blocks[by].groups[block_key],
-                        dtype=self.types[by])
-                    X = self.on_blocks[by].groups[on]
-
-                    # FIXME quick fix to process case whith no across, but
-                    # better done in a separate loop ...
-                    if self.across == ['#across']:
-                        # in this case A is a singleton and B can be anything
-                        # in the by block that doesn't have the same 'on' as A
-                        B = np.array(
-                            list(set(self.by_dbs[by].index).difference(X)),
-                            dtype=self.types[by])
-                    else:
-                        B = self.across_blocks[by].groups[across]
-
-                        # remove B with the same 'on' than A
-                        B = np.array(
-                            list(set(B).difference(A)), dtype=self.types[by])
-
-                    # remove X with the same 'across' than A
-                    X = np.array(
-                        list(set(X).difference(A)), dtype=self.types[by])
+                    A, B, X = self._ABX_candidates(by, across, block)
 
                     if B.size > 0 and X.size > 0:
                         # case were there was no across specified is different
@@ -1081,7 +2637,7 @@ class Task(object):
         if not(summarized):
             for by, stats in iteritems(self.by_stats):
                 stream.write('### by level: %s ###\n' % str(by))
-                pprint.pprint(stats, stream)
+                pprint.pprint(dict(stats), stream)
         else:
             try:
                 self.compute_nb_levels()
@@ -1108,6 +2664,143 @@ class Task(object):
                 stream.write(
                     'nb_on_across_levels: %d\n' % stats['nb_on_across_levels'])
 
+    def estimate(self, feature_file=None, feature_group='features',
+                 symmetric_pairs=False):
+        """Estimate the size and cost of the task before generating it
+
+        The number of triplets is given by the task statistics (see
+        compute_statistics) and the number of unique pairs of each 'by'
+        block is computed from the on/across blocks, without generating
+        the triplets (see unique_pair_sums). The numbers of pairs are
+        upper bounds when the task has filters. The sampling of the
+        triplets (threshold, max_triplets or max_pairs) is not taken
+        into account and the triplets are assumed stored explicitly
+        (not factorized).
+
+        Parameters
+        ----------
+
+        feature_file : str, optional
+            the h5features file of the features of the items. When
+            given, the cost of the DTW distances is estimated as the
+            sum over the unique pairs of the products of the numbers of
+            frames of their two items, read from the h5features index.
+
+        feature_group : str, optional
+            the group to read in feature_file
+
+        symmetric_pairs : bool, optional
+            count the pairs (i, j) and (j, i) once, see
+            generate_triplets
+
+        Returns a dict with the numbers of triplets ('nb_triplets') and
+        unique pairs ('nb_pairs'), the DTW cost ('dtw_cost', None
+        without feature_file), the size in bytes of the main datasets
+        of the task, distance and score files ('task_size',
+        'distance_size' and 'score_size', without the HDF5 and item
+        tables overhead, significant for small tasks), whether the
+        numbers of pairs are upper bounds ('approximate') and a
+        DataFrame of the numbers of triplets, pairs and DTW cost of
+        each 'by' block ('by_blocks').
+
+        """
+        bys = list(self.by_dbs)
+        by_blocks = pd.DataFrame(
+            {'nb_triplets': [self.by_stats[by]['nb_triplets'] for by in bys]},
+            index=pd.Index([str(by) for by in bys], name='by'))
+        items = self._items_table()
+        no_across = self.across == ['#across']
+        by_blocks['nb_pairs'] = np.int64(np.round(unique_pair_sums(
+            items, self.on, self.across, no_across=no_across,
+            symmetric=symmetric_pairs)))
+        if feature_file is not None:
+            # imported here so that the tasks do not depend on the
+            # distances and h5features modules
+            from ABXpy.distances.distances import frame_counts
+
+            # the frames of each item, in the order of the items table
+            frames = frame_counts(feature_file, feature_group, pd.concat(
+                [self.feat_dbs[by] for by in bys]))
+            by_blocks['dtw_cost'] = np.int64(np.round(unique_pair_sums(
+                items, self.on, self.across, weights=frames,
+                no_across=no_across, symmetric=symmetric_pairs)))
+
+        n_triplets = int(by_blocks['nb_triplets'].sum())
+        n_pairs = int(by_blocks['nb_pairs'].sum())
+        n_blocks = self.stats['nb_blocks']
+
+        # the main datasets of the task file: the triplets, their
+        # regressors, stored once per on/across block for the by and
+        # on_across_by regressors, and the unique pairs
+        names, indexes = self.regressors.get_regressor_info()
+        scalar_names = set(self._scalar_regressor_names())
+        reg_size = np.dtype(fit_integer_type(
+            max([len(index) for index in indexes.values()] + [1]),
+            is_signed=False)).itemsize
+        task_size = (
+            n_triplets * 3 * np.dtype(fit_integer_type(n_triplets)).itemsize +
+            n_triplets * len(set(names) - scalar_names) * reg_size +
+            n_blocks * (len(scalar_names) * reg_size + 8 +
+                        np.dtype(fit_integer_type(n_blocks)).itemsize) +
+            n_pairs * 8)
+
+        return {
+            'nb_triplets': n_triplets,
+            'nb_pairs': n_pairs,
+            'dtw_cost': (int(by_blocks['dtw_cost'].sum())
+                         if feature_file is not None else None),
+            'task_size': task_size,
+            'distance_size': n_pairs * 8,
+            'score_size': n_triplets,
+            'approximate': bool(
+                self.filters.on_across_by or self.filters.A or
+                self.filters.B or self.filters.X or self.filters.ABX),
+            'by_blocks': by_blocks}
+
+    def print_estimate(self, feature_file=None, feature_group='features',
+                       symmetric_pairs=False, stream=None):
+        """Print the estimated size and cost of the task, see estimate"""
+        stream = sys.stdout if stream is None else stream
+        estimate = self.estimate(feature_file, feature_group, symmetric_pairs)
+
+        stream.write('\n\n###### Estimated task ######\n\n')
+        if estimate['approximate']:
+            stream.write('(upper bounds, the filters are ignored)\n')
+        stream.write('nb_triplets: %d\n' % estimate['nb_triplets'])
+        stream.write('nb_pairs: %d\n' % estimate['nb_pairs'])
+        if estimate['dtw_cost'] is not None:
+            stream.write('dtw_cost: %d frame pairs\n' % estimate['dtw_cost'])
+        for name in ('task', 'distance', 'score'):
+            stream.write('%s_size: %.3g Mo\n' % (
+                name, estimate[name + '_size'] / 2. ** 20))
+
+        stream.write('\n\n###### by blocks estimates ######\n\n')
+        stream.write(estimate['by_blocks'].to_string() + '\n')
+
+    def _scalar_regressor_names(self):
+        """Names of the by and on_across_by regressors"""
+        return [name for stage in ('by', 'on_across_by')
+                for names in getattr(self.regressors, stage + '_names')
+                for name in names]
+
+    def _scalar_regressors(self):
+        """Current values of the by and on_across_by regressors
+
+        The regressors constant in an on/across block are written to
+        the task file once per block, run length encoded (see
+        ABXpy.h5tools.h5io.read_indexed), instead of once per triplet.
+        Returns a dict of arrays with one row.
+
+        """
+        scalar_names = (
+            self.regressors.by_names + self.regressors.on_across_by_names)
+        scalar_regressors = (
+            self.regressors.by_regressors
+            + self.regressors.on_across_by_regressors)
+        return {name: np.tile(np.array(reg), (1, 1))
+                for names, regs in zip(scalar_names, scalar_regressors)
+                for name, reg in zip(names, regs)}
+
     def _compute_regressors(self, triplets, iA, iB, iX,
                             ABX_filter_ind, thr_sort_permut):
         """Helper method for Task.on_across_triplets"""
@@ -1120,17 +2813,10 @@ class Task(object):
         #
         # FIXME change manager API so that self.regressors.A contains the
         # data and not the list of dbfun_s ?
-        regressors = {}
-
-        scalar_names = (
-            self.regressors.by_names + self.regressors.on_across_by_names)
-        scalar_regressors = (
-            self.regressors.by_regressors
-            + self.regressors.on_across_by_regressors)
-        for names, regs in zip(scalar_names, scalar_regressors):
-            for name, reg in zip(names, regs):
-                regressors[name] = np.tile(
-                    np.array(reg), (np.size(triplets, 0), 1))
+        #
+        # the by and on_across_by regressors are the same for all the
+        # triplets, they are given once for the block
+        regressors = self._scalar_regressors()
 
         # lots of code duplication below...
         for names, regs in zip(self.regressors.A_names,
@@ -1139,7 +2825,7 @@ class Task(object):
                 regressors[name] = reg[iA]
                 if self.filters.ABX:
                     regressors[name] = regressors[name][ABX_filter_ind]
-                    regressors[name] = regressors[name][thr_sort_permut]
+                regressors[name] = regressors[name][thr_sort_permut]
 
         for names, regs in zip(self.regressors.B_names,
                                self.regressors.B_regressors):
@@ -1166,6 +2852,514 @@ class Task(object):
         return regressors
 
 
+def block_counts(items, on, across, no_across=False, weights=None):
+    """Count the possible A, B and X items of all the on/across blocks
+
+    items is a DataFrame with a '#block' column identifying the 'by'
+    block of each item and the on and across columns of the task.
+
+    Returns the (#block, on, across) index of the on/across blocks and,
+    for each block, the number n_A of items in the block, the number
+    n_B of items sharing its across value but not its on value, the
+    number n_X of items sharing its on value but not its across value
+    and the number n_antiX of items sharing its on value and differing
+    from it on all the across columns (equal to n_X when there is only
+    one across column). The counts are obtained from the group sizes
+    of the whole table, using the inclusion-exclusion principle for
+    n_antiX. When weights is the name of a column of items, the items
+    are counted with their weight.
+
+    """
+    block = ['#block']
+
+    def _count(cols):
+        groups = items.groupby(block + cols)
+        return groups.size() if weights is None else groups[weights].sum()
+
+    on_across = _count(on + across)
+    index = on_across.index
+
+    def _sizes(cols):
+        # size of the groups defined by cols, for each on/across block
+        dropped = [col for col in on + across if col not in cols]
+        return _count(cols).reindex(
+            index.droplevel(dropped) if dropped else index).values
+
+    n_A = on_across.values
+    n_on = _sizes(on)
+    if no_across:
+        n_B = _sizes([]) - n_on
+    else:
+        n_B = _sizes(across) - n_A
+    n_X = n_on - n_A
+
+    if len(across) > 1:
+        n_antiX = np.zeros_like(n_X)
+        for k in range(len(across) + 1):
+            for cols in itertools.combinations(across, k):
+                n_antiX += (-1) ** k * _sizes(on + list(cols))
+    else:
+        n_antiX = n_X
+
+    return index, n_A, n_B, n_X, n_antiX
+
+
+def unique_pair_sums(items, on, across, weights=None, no_across=False,
+                     symmetric=False):
+    """Sum a weight over the unique pairs of all the 'by' blocks
+
+    items is a DataFrame as in block_counts and weights gives a weight
+    to each item, the weight of a pair being the product of the
+    weights of its two items (by default 1, the sum being the number
+    of unique pairs). The pairs are those of the triplets of the task
+    without filters: the AX pairs join an item to an item with the
+    same on value, the BX pairs join an item to an item with another
+    on value, and a pair is counted once even if it appears in several
+    triplets. With symmetric, the pairs (i, j) and (j, i) are counted
+    once, as with symmetric_pairs in Task.generate_triplets.
+
+    The pairs are counted on the on/across blocks, each ordered pair
+    belonging to exactly one block (the block of A for an AX pair, the
+    block with the on value of X and the across values of B for a BX
+    pair), and the pairs (i, j) such that (j, i) is also a pair are
+    counted with the inclusion-exclusion principle on the across
+    columns. Returns an array with the sum of each 'by' block.
+
+    """
+    n_blocks = items['#block'].max() + 1 if len(items) else 0
+    if weights is None:
+        weights = np.ones(len(items))
+    items = items.assign(**{'#weight': np.asarray(weights, np.float64)})
+    block = ['#block']
+
+    if no_across:
+        # the triplets of a block are made of A and X sharing their on
+        # value and of any B with another on value
+        groups = items.groupby(block + on)['#weight']
+        n_on, w_on = groups.size().values, groups.sum().values
+        squares = (items['#weight'] ** 2).groupby(
+            [items[col] for col in block + on]).sum().values
+        by = groups.size().index.get_level_values('#block').values
+        w_by = np.bincount(by, w_on, n_blocks)[by]
+        n_by = np.bincount(by, n_on, n_blocks)[by]
+        # X needs another A with its on value
+        valid = n_on > 1
+        ax = np.where(valid & (n_by > n_on), w_on ** 2 - squares, 0)
+        bx = np.where(valid, w_on * (w_by - w_on), 0)
+        sums = np.bincount(by, ax + bx, n_blocks)
+        if symmetric:
+            # all the AX pairs are reversible, a BX pair is reversible
+            # if B also has another item with its on value
+            w_valid = np.where(valid, w_on, 0)
+            sums -= (np.bincount(by, ax, n_blocks) +
+                     np.bincount(by, w_valid, n_blocks) ** 2 -
+                     np.bincount(by, w_valid ** 2, n_blocks)) / 2
+        return sums
+
+    index, n_A, n_B, _, _ = block_counts(items, on, across)
+    _, w_A, w_B, _, w_antiX = block_counts(
+        items, on, across, weights='#weight')
+    by = index.get_level_values('#block').values
+    # an AX pair needs a B, a BX pair always has its A in its block
+    ax = np.where(n_B > 0, w_A * w_antiX, 0)
+    sums = np.bincount(by, ax + w_B * w_antiX, n_blocks)
+    if not symmetric:
+        return sums
+
+    cells = index.to_frame(index=False)
+    cells['#weight'] = w_A
+    cells['#valid'] = np.where(n_B > 0, w_A, 0)
+    columns = cells.groupby(block + across).ngroup().values
+    both = np.zeros(n_blocks)
+    for k in range(len(across) + 1):
+        for cols in itertools.combinations(across, k):
+            sign = (-1) ** k
+            # reversible AX pairs: both items in a block with a B
+            groups = cells.groupby(block + on + list(cols))
+            valid = groups['#valid'].sum()
+            both += sign * np.bincount(
+                valid.index.get_level_values('#block').values,
+                valid.values ** 2, n_blocks)
+
+            # reversible BX pairs (B, X): the blocks with the on value
+            # of X and the across values of B and with the on value of
+            # B and the across values of X both exist
+            rows = groups.ngroup().values
+            shape = (rows.max() + 1, columns.max() + 1)
+            weighted = scipy.sparse.csr_matrix(
+                (cells['#weight'].values, (rows, columns)), shape=shape)
+            exists = scipy.sparse.csr_matrix(
+                (np.ones(len(rows)), (rows, columns)), shape=shape)
+            products = weighted.dot(exists.T).tocsr()
+            row_by = np.zeros(shape[0], dtype=np.int64)
+            row_by[rows] = cells['#block'].values
+            # the terms with the same on value are removed
+            row_sums = (np.asarray(
+                products.multiply(products.T).sum(axis=1)).ravel() -
+                products.diagonal() ** 2)
+            both += sign * np.bincount(row_by, row_sums, n_blocks)
+    return sums - both / 2
+
+
+def group_members(codes, labels):
+    """Group labels by code
+
+    Returns the labels sorted by code (and by label within a code) and
+    the offsets of each code in this array, the labels of code i being
+    members[offsets[i]:offsets[i + 1]].
+
+    """
+    n_codes = np.max(codes) + 1
+    order = counting_sort(codes, n_codes)
+    offsets = np.concatenate(
+        ([0], np.cumsum(np.bincount(codes, minlength=n_codes))))
+    return labels[order], offsets
+
+
+def item_codes(index, on_codes, across_codes):
+    """Integer codes of the items of a 'by' block
+
+    index is the index of the items in the 'by' block and on_codes and
+    across_codes the codes of their on and across values, from 0 in
+    the order of the values. Returns the codes as stored in Task.codes,
+    with the items of each on and across value (see group_members).
+
+    """
+    on_members, on_offsets = group_members(on_codes, index)
+    across_members, across_offsets = group_members(across_codes, index)
+    return {
+        'index': index,
+        'on': on_codes,
+        'across': across_codes,
+        'on_members': on_members,
+        'on_offsets': on_offsets,
+        'across_members': across_members,
+        'across_offsets': across_offsets}
+
+
+def group_blocks(bounds, codes, labels):
+    """Group the labels of the items of several blocks by code
+
+    The items are sorted by block, the items of block i being between
+    bounds[i] and bounds[i + 1], and codes are their codes renumbered
+    from 0 in each block (see block_codes). Returns the members of all
+    the blocks (as given by group_members on each block) and their
+    offsets, the offsets of block i being between offset_bounds[i] and
+    offset_bounds[i + 1].
+
+    """
+    n_blocks = len(bounds) - 1
+    sizes = np.diff(bounds)
+    n_codes = np.zeros(n_blocks, dtype=np.int64)
+    if len(codes):
+        starts = bounds[:-1][sizes > 0]
+        n_codes[sizes > 0] = np.maximum.reduceat(codes, starts) + 1
+
+    # the codes of all the blocks are made distinct by shifting them
+    # by the number of codes of the previous blocks
+    first = np.concatenate(([0], np.cumsum(n_codes)))
+    groups = np.repeat(first[:-1], sizes) + codes
+    members = labels[counting_sort(groups, first[-1])]
+
+    # each block has an additional offset (its leading 0)
+    group_blocks = np.repeat(np.arange(n_blocks), n_codes)
+    offsets = np.zeros(first[-1] + n_blocks, dtype=np.int64)
+    offsets[np.arange(first[-1]) + group_blocks + 1] = np.cumsum(
+        np.bincount(groups, minlength=first[-1])) - bounds[group_blocks]
+    return members, offsets, first + np.arange(n_blocks + 1)
+
+
+def block_item_codes(bounds, on_codes, across_codes, labels):
+    """Integer codes of the items of several 'by' blocks
+
+    The items are sorted by block (see group_blocks), labels being
+    their index in their 'by' block. Returns the arrays of a
+    BlockArrays giving the codes of each block as item_codes.
+
+    """
+    arrays = {'index': (labels, bounds),
+              'on': (on_codes, bounds),
+              'across': (across_codes, bounds)}
+    for name, codes in (('on', on_codes), ('across', across_codes)):
+        members, offsets, offset_bounds = group_blocks(bounds, codes, labels)
+        arrays[name + '_members'] = (members, bounds)
+        arrays[name + '_offsets'] = (offsets, offset_bounds)
+    return arrays
+
+
+def block_across_index(bounds, columns, labels):
+    """Inverted index of the across columns of several 'by' blocks
+
+    columns are the codes of the items in each across column,
+    renumbered from 0 in each block. Returns the arrays of a
+    BlockAcrossIndex, see Task._init_prepare_by_block.
+
+    """
+    arrays = {'codes': (columns, bounds)}
+    for i, codes in enumerate(columns.T):
+        members, offsets, offset_bounds = group_blocks(bounds, codes, labels)
+        arrays['members{}'.format(i)] = (members, bounds)
+        arrays['offsets{}'.format(i)] = (offsets, offset_bounds)
+    return arrays
+
+
+def block_codes(blocks, codes):
+    """Renumber integer codes from 0 within each block
+
+    blocks and codes are integer codes of the items of a table (-1 for
+    a missing value). The codes of the items of each block are
+    renumbered from 0 to the number of distinct codes in the block
+    minus 1, keeping their order, so that they are the codes a groupby
+    would give on the items of the block alone.
+
+    """
+    if len(codes) == 0:
+        return codes
+    n_codes = np.int64(np.max(codes)) + 2
+    keys = blocks * n_codes + codes + 1
+    unique, inverse = np.unique(keys, return_inverse=True)
+    # the keys of a block are between block * n_codes (included) and
+    # (block + 1) * n_codes (excluded)
+    return inverse - np.searchsorted(unique, blocks * n_codes)
+
+
+def counting_sort(keys, n_keys):
+    """Stable sort of non-negative integer keys smaller than n_keys
+
+    Returns the same permutation as np.argsort(keys, kind='mergesort')
+    in linear time: the keys are sorted by digits of 8 or 16 bits from
+    the least significant one, each pass being a stable counting sort
+    (numpy sorts the integers of at most 16 bits with a radix sort).
+
+    """
+    if keys.dtype.kind not in 'iu':
+        return np.argsort(keys, kind='mergesort')
+    permut = None
+    shift = 0
+    while True:
+        digits = keys if permut is None else keys[permut]
+        if (n_keys - 1) >> shift < 256:
+            digits, width = (digits >> shift).astype(np.uint8), 8
+        else:
+            digits, width = ((digits >> shift) & 0xFFFF).astype(
+                np.uint16), 16
+        order = np.argsort(digits, kind='stable')
+        permut = order if permut is None else permut[order]
+        shift += width
+        if (n_keys - 1) >> shift <= 0:
+            return permut
+
+
+def encode_keys(keys):
+    """Encode several integer keys in a single one
+
+    The encoded keys are in the lexicographic order of the keys, as in
+    analyze.npencode. Returns None if some keys are not non-negative
+    integers or if the encoded keys could overflow.
+
+    """
+    if not all(key.dtype.kind in 'biu' and
+               (key.size == 0 or np.min(key) >= 0) for key in keys):
+        return None
+    n_values = [np.max(key) + 1 if key.size else 1 for key in keys]
+    if np.prod(n_values, dtype=np.float64) >= 2 ** 63:
+        return None
+    encoded = keys[0].astype(np.int64)
+    for key, n in zip(keys[1:], n_values[1:]):
+        encoded = encoded * np.int64(n) + key.astype(np.int64)
+    return encoded
+
+
+def antiacross_items(antiacross_index, position, items):
+    """Select the items differing from an item on all the across columns
+
+    antiacross_index is the inverted index of the across columns of a
+    'by' block (see Task._init_prepare_by_block) and position the
+    position of the item in the 'by' block. Returns the sorted items
+    of the sorted array items differing from the item on all the
+    across columns, that is the items minus the ones sharing the value
+    of the item in some column.
+
+    """
+    shared = [members[offsets[code]:offsets[code + 1]]
+              for (members, offsets), code in zip(
+                  antiacross_index['members'],
+                  antiacross_index['codes'][position])]
+    return np.setdiff1d(items, np.concatenate(shared))
+
+
+def regressor_cells(regs, n):
+    """Group n items by their values of the regressors regs
+
+    Returns the items sorted by cell, the cells being in the
+    lexicographic order of the regressor values, and the offsets of
+    each cell in this array (see group_members). Without regressors,
+    all the items are in a single cell.
+
+    """
+    if regs:
+        _, codes = np.unique(
+            np.column_stack(regs), axis=0, return_inverse=True)
+        codes = codes.ravel()
+    else:
+        codes = np.zeros(n, dtype=np.int64)
+    return group_members(codes, np.arange(n))
+
+
+# the task being processed by the workers of
+# Task._generate_triplets_parallel, inherited at fork
+_worker_task = None
+
+
+def _generate_triplets_worker(args):
+    """Write a shard of the task restricted to some 'by' blocks
+
+    Returns the list of the non-empty 'by' blocks of the shard.
+
+    """
+    bys, shard, tmpdir = args
+    # a worker process can run several jobs, so the inherited task is
+    # not modified
+    task = copy.copy(_worker_task)
+    task.by_dbs = {by: task.by_dbs[by] for by in bys}
+    task.verbose = False
+    with warnings.catch_warnings():
+        # shards with no triplet are expected
+        warnings.simplefilter('ignore', UserWarning)
+        task.generate_triplets(
+            output=shard, threshold=task.threshold or None,
+            tmpdir=tmpdir, seed=task.seed, factorized=task.factorized,
+            symmetric_pairs=task.symmetric_pairs,
+            max_triplets=task.max_triplets,
+            min_block_triplets=task.min_block_triplets,
+            max_pairs=task.max_pairs, memory=task.memory)
+    return list(task.by_dbs) if os.path.exists(shard) else []
+
+
+def _interrupted_merge(checkpoint):
+    """True if the shards of a checkpoint directory were being merged
+
+    The output file of Task.generate_triplets(resume=True) is written
+    from the shards of the checkpoint directory, which is removed once
+    the output file is complete, see Task._generate_triplets_resumable.
+
+    """
+    manifest = os.path.join(checkpoint, 'manifest.h5')
+    if not os.path.exists(manifest):
+        return False
+    with h5py.File(manifest, 'r') as fh:
+        return bool(fh.attrs.get('merging', False))
+
+
+def by_block_generator(seed, by):
+    """Returns the random generator used to sample a 'by' block
+
+    Its stream is spawned from numpy.random.SeedSequence(seed), with a
+    spawn key derived from the 'by' value (instead of the position of
+    the block), so that the triplets sampled in a block only depend on
+    the seed and on the block: not on the other blocks, on the order in
+    which they are processed or on the number of processes. The streams
+    are random if seed is None.
+
+    """
+    key = int(hashlib.sha1(str(by).encode('utf8')).hexdigest(), 16)
+    return np.random.Generator(np.random.PCG64(
+        np.random.SeedSequence(seed, spawn_key=(key,))))
+
+
+def allocate_triplets(sizes, max_triplets, min_block_triplets=0):
+    """Allocate a budget of triplets to blocks of triplets
+
+    Each block gets min_block_triplets triplets (or all its triplets
+    if it has less) and the remainder of the budget is shared
+    proportionally to the number of triplets left in the blocks, the
+    fractional parts being rounded with the largest remainder method.
+
+    Parameters
+    ----------
+
+    sizes : sequence of int
+        The number of triplets of each block
+
+    max_triplets : int
+        The total number of triplets to keep
+
+    min_block_triplets : int, optional
+        The minimal number of triplets kept in each block
+
+    Returns
+    -------
+
+    quotas : numpy.Array
+        The number of triplets to keep in each block, at most its size.
+        They sum to max_triplets, or to the sum of the sizes if it is
+        smaller.
+
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    if max_triplets >= np.sum(sizes):
+        return sizes
+
+    quotas = np.minimum(sizes, min_block_triplets)
+    left = max_triplets - np.sum(quotas)
+    if left < 0:
+        raise ValueError(
+            'Cannot keep {} triplets per block with a maximum of {} '
+            'triplets'.format(min_block_triplets, max_triplets))
+
+    remaining = sizes - quotas
+    shares = remaining * (left / float(np.sum(remaining)))
+    extra = np.minimum(np.floor(shares).astype(np.int64), remaining)
+    largest = np.argsort(extra - shares, kind='mergesort')
+    extra[largest[:left - np.sum(extra)]] += 1
+    return quotas + np.minimum(extra, remaining)
+
+
+def by_block_hash(by_db, feat_db):
+    """Returns a hash of the items of a 'by' block
+
+    by_db and feat_db are the item database and the features location
+    of the 'by' block. The dummy '#across' column is ignored, its values
+    being only used to tell the items apart.
+
+    """
+    h = hashlib.sha1()
+    for db in (by_db.drop(columns='#across', errors='ignore'), feat_db):
+        h.update(repr(list(db.columns)).encode('utf8'))
+        h.update(pd.util.hash_pandas_object(db, index=True).values.tobytes())
+    return h.hexdigest()
+
+
+def cache_key(db_name, specification):
+    """Returns the name of the cached prepared task, see Task
+
+    It is a hash of the files of the database and of the task
+    specification.
+
+    """
+    h = hashlib.sha1(
+        repr((TASK_FILE_VERSION, specification)).encode('utf8'))
+    for filename in database.files(db_name):
+        with open(filename, 'rb') as fin:
+            for chunk in iter(lambda: fin.read(2 ** 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def hierarchy_to_list(tree):
+    """Nested lists [name, [children]] describing a database hierarchy"""
+    return [tree.name, [hierarchy_to_list(child) for child in tree.children]]
+
+
+def hierarchy_from_list(lst):
+    """Build a database hierarchy from hierarchy_to_list"""
+    tree = tinytree.Tree()
+    tree.name = lst[0]
+    for child in lst[1]:
+        tree.addChild(hierarchy_from_list(child))
+    return tree
+
+
 # utility function necessary because of current inconsistencies in panda:
 # you can't seem to index a dataframe with a tuple with only one element,
 # even though tuple with more than one element are fine
@@ -1178,8 +3372,48 @@ def on_across_from_key(key):
     return on, across
 
 
+def factorized_pairs(items, blocks, base, pair_key_type,
+                     chunk_size=triplets_io.CHUNK_SIZE, symmetric=False):
+    """Yields the AX and BX pairs of factorized on/across blocks
+
+    items and blocks are the candidates and the blocks of a 'by' block
+    as returned by ABXpy.misc.triplets.read_blocks. The pairs are the
+    ones of the triplets, with duplicates, encoded with
+    ABXpy.misc.triplets.pair_keys.
+
+    """
+    chunk = []
+    chunk_len = 0
+    for first, n_A, n_B, n_X in blocks:
+        A = pair_key_type(items[first:first + n_A + n_B])
+        X = pair_key_type(items[first + n_A + n_B:first + n_A + n_B + n_X])
+        pairs = triplets_io.pair_keys(
+            A[:, None], X[None, :], base, symmetric=symmetric).reshape(
+                (-1, 1))
+        chunk.append(pairs)
+        chunk_len += pairs.shape[0]
+        if chunk_len >= chunk_size:
+            yield np.concatenate(chunk)
+            chunk, chunk_len = [], 0
+    if chunk:
+        yield np.concatenate(chunk)
+
+
 def sort_and_threshold(permut, new_index, ind_type,
-                       threshold=None, count_only=False):
+                       threshold=None, count_only=False, rng=None):
+    """Sort triplets by regressors and threshold the groups of triplets
+
+    permut sorts new_index, the regressors of the triplets (see
+    counting_sort). The groups of more than threshold triplets are
+    sampled with the random generator rng (see
+    ABXpy.sampling.sampler.get_generator), the other groups are kept
+    as they are without iterating over them.
+
+    Returns the permutation of the kept triplets and the start of each
+    group of triplets followed by the number of triplets, that is the
+    on_across_block_index of the triplets.
+
+    """
     sorted_index = new_index[permut]
     flag = np.concatenate(
         ([True], sorted_index[1:] != sorted_index[:-1], [True]))
@@ -1191,17 +3425,20 @@ def sort_and_threshold(permut, new_index, ind_type,
         return new_index.shape[0] - np.sum(counts[sampled]) + \
             threshold * np.sum(sampled)
 
+    # only the groups to sample are processed one by one, the other
+    # ones are kept as they are
+    sampled = np.nonzero(counts > threshold)[0] if threshold else []
     new_permut = []
     i = 0
-    for c in counts:
-        if threshold and c > threshold:
-            sampled_idx = sampler.sample_without_replacement(
-                threshold, c, dtype=ind_type)
-            sampled_idx += i
-            new_permut.append(permut[sampled_idx])
-        else:
-            new_permut.append(permut[i:i+c])
-        i += c
+    for group in sampled:
+        start, c = unique_idx[group], counts[group]
+        new_permut.append(permut[i:start])
+        sampled_idx = sampler.sample_without_replacement(
+            threshold, c, dtype=ind_type, rng=rng)
+        sampled_idx += start
+        new_permut.append(permut[sampled_idx])
+        i = start + c
+    new_permut.append(permut[i:])
     return np.concatenate(new_permut), unique_idx
 
 
@@ -1288,14 +3525,70 @@ Example call:
         help='add this flag if you only want some statistics '
         'about the specified task')
 
+    parser.add_argument(
+        '--estimate', action='store_true',
+        help='add this flag to only estimate the numbers of triplets and '
+        'unique pairs of the specified task and the size of the task, '
+        'distance and score files, without generating the task')
+
+    parser.add_argument(
+        '--features', metavar='FEATURES', default=None,
+        help='with --estimate, h5features file of the items used to '
+        'estimate the cost of the DTW distances')
+
+    parser.add_argument(
+        '--features-group', default='features',
+        help='group to read in the h5features file, '
+        'default is %(default)s')
+
     parser.add_argument(
         '--tempdir', default=None,
         help='directory where temporary files will be stored')
 
+    parser.add_argument(
+        '--memory', default=1000, type=float,
+        help='memory in Mo available to make the pairs of a \'by\' block '
+        'unique, the pairs of the bigger blocks being sorted on disk in '
+        'the temporary directory, default is %(default)s')
+
     parser.add_argument(
         '--seed', default=None, type=int,
         help='seed used to initialize the pseudo-random number generator')
 
+    parser.add_argument(
+        '-j', '--njobs', default=1, type=int,
+        help='number of cpus to use for generating the triplets, '
+        'default is %(default)s')
+
+    parser.add_argument(
+        '--factorized', action='store_true',
+        help='store only the A, B and X candidates of each on/across '
+        'block instead of all the triplets, not compatible with A, B, X '
+        'or ABX filters or with a threshold')
+
+    parser.add_argument(
+        '--symmetric-pairs', action='store_true',
+        help='encode the pairs (i, j) and (j, i) with the same key so that '
+        'their distance is computed only once, to be used only with '
+        'symmetric distances')
+
+    parser.add_argument(
+        '--cache', metavar='DIRECTORY', default=None,
+        help='directory where the prepared task is cached, the next runs of '
+        'the same task on the same database load it instead of preparing '
+        'the task again')
+
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='checkpoint each \'by\' block in OUTPUT.checkpoint and skip '
+        'the blocks completed by a previous interrupted run')
+
+    parser.add_argument(
+        '--update', metavar='TASKFILE', default=None,
+        help='a task file generated by the same task on a former version of '
+        'the database, the triplets of the unchanged \'by\' blocks are '
+        'copied from it')
+
     # I/O files
     g1 = parser.add_argument_group('I/O files')
     g1.add_argument(
@@ -1333,6 +3626,22 @@ Example call:
         help='threshold on the maximal size of a block of'
         ' triplets sharing the same regressors')
 
+    g2.add_argument(
+        '--max-triplets', default=None, type=int,
+        help='maximal number of triplets of the task, allocated to the '
+        'on/across blocks proportionally to their number of triplets')
+
+    g2.add_argument(
+        '--min-block-triplets', default=0, type=int,
+        help='with --max-triplets, minimal number of triplets kept in each '
+        'on/across block, default is %(default)s')
+
+    g2.add_argument(
+        '--max-pairs', default=None, type=int,
+        help='approximate maximal number of unique pairs of the task, the '
+        'triplets being formed among a sample of the items of each '
+        'on/across block')
+
     return parser.parse_args()
 
 
@@ -1344,7 +3653,7 @@ def main():
     # checks on the output file
     # if args.stats_only:
     #     assert args.output, "The output file was not provided"
-    if args.output and os.path.exists(args.output):
+    if args.output and os.path.exists(args.output) and not args.estimate:
         warnings.warn("Overwriting task file " + args.output, UserWarning)
         os.remove(args.output)
 
@@ -1355,10 +3664,16 @@ def main():
         by=args.by,
         filters=args.filters,
         regressors=args.regressors,
-        verbose=args.verbose)
+        verbose=args.verbose,
+        cache=args.cache)
 
     if args.stats_only:
         task.print_stats()
+    elif args.estimate:
+        task.print_estimate(
+            feature_file=args.features,
+            feature_group=args.features_group,
+            symmetric_pairs=args.symmetric_pairs)
     else:
         if args.tempdir and not os.path.exists(args.tempdir):
             os.makedirs(args.tempdir)
@@ -1368,7 +3683,16 @@ def main():
             output=args.output,
             threshold=args.threshold,
             tmpdir=args.tempdir,
-            seed=args.seed)
+            seed=args.seed,
+            n_cpu=args.njobs,
+            factorized=args.factorized,
+            symmetric_pairs=args.symmetric_pairs,
+            update=args.update,
+            resume=args.resume,
+            max_triplets=args.max_triplets,
+            min_block_triplets=args.min_block_triplets,
+            max_pairs=args.max_pairs,
+            memory=args.memory)
 
 
 if __name__ == '__main__':
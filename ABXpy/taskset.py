@@ -0,0 +1,293 @@
+"""This module generates several ABX tasks on the same database
+
+The tasks of a TaskSet share the item database, which is read only
+once, and their pairs: the AX and BX pairs of all the tasks are stored
+only once, in a global table, so that a single run of the distance
+computation gives the distances needed by all the tasks.
+
+The TaskSet file contains the global table of pairs in the format of
+the pairs of a task file, with a single 'by' block named 'all' made of
+all the distinct items of the database: it is given as the task file
+of the distance computation. Each task is stored in the 'tasks/<name>'
+group in the format of a task file, without its pairs but with the
+position of its items in the global table (see `Files format
+<FilesFormat.html>`_). The tasks are scored and analyzed by giving
+their name to the score and analyze modules.
+
+Usage
+-----
+Form the command line, with the tasks specified in a json file:
+
+.. code-block:: bash
+
+    echo '{"phone": {"on": "phone", "across": "talker"},
+           "talker": {"on": "talker", "by": "phone"}}' > tasks.json
+    abx-taskset data.item tasks.json data.abxs
+    abx-distance data.features data.abxs data.distance -n 1
+    abx-score data.abxs data.distance phone.score --task phone
+    abx-analyze phone.score data.abxs phone.csv --task phone
+
+In python:
+
+.. code-block:: python
+
+    import ABXpy.taskset
+    import ABXpy.distances.distances
+    import ABXpy.score
+    import ABXpy.analyze
+    tasks = ABXpy.taskset.TaskSet('data.item', {
+        'phone': {'on': 'phone', 'across': 'talker'},
+        'talker': {'on': 'talker', 'by': 'phone'}})
+    tasks.generate_triplets('data.abxs')
+    ABXpy.distances.distances.compute_distances(
+        'data.features', '/features/', 'data.abxs', 'data.distance',
+        my_distance, normalized=True)
+    for name in tasks.tasks:
+        ABXpy.score.score(
+            'data.abxs', 'data.distance', name + '.score', task=name)
+        ABXpy.analyze.analyze(
+            'data.abxs', name + '.score', name + '.csv', task=name)
+
+"""
+
+import argparse
+import collections
+import json
+import os
+import tempfile
+import warnings
+
+import h5py
+import numpy as np
+import pandas as pd
+import tables
+
+import ABXpy.database.database as database
+import ABXpy.misc.triplets as triplets_io
+from ABXpy.misc.type_fitting import fit_integer_type
+from ABXpy.task import Task
+
+
+class TaskSet(object):
+    """Define several ABX tasks on the same database
+
+    Parameters
+    ----------
+
+    db_name : str
+        the filename of the database on which the ABX tasks are applied.
+
+    tasks : dict
+        the specification of each task, indexed by the name of the
+        task. A specification is a dict of the arguments of Task: 'on'
+        and optionally 'across', 'by', 'filters' and 'regressors'.
+
+    verbose : bool, optional
+        display additionnal information is set to True.
+
+    """
+    def __init__(self, db_name, tasks, verbose=False):
+        if not os.path.isfile(db_name):
+            raise AssertionError('item file {} not found'.format(db_name))
+        for name in tasks:
+            if not name or '/' in name:
+                raise ValueError('invalid task name: {}'.format(name))
+
+        self.database = db_name
+        self.verbose = verbose
+
+        # the database is read once for all the tasks
+        loaded = database.load(db_name, features_info=True)
+        self.tasks = collections.OrderedDict(
+            (name, Task(db_name, loaded=loaded, verbose=verbose, **spec))
+            for name, spec in tasks.items())
+
+        # the distinct items of the database, two items with the same
+        # features sharing their distances
+        feat_db = loaded[2]
+        self.items = feat_db.drop_duplicates().reset_index(drop=True)
+        self._items_index = pd.MultiIndex.from_frame(self.items)
+
+    def generate_triplets(self, output, tmpdir=None, symmetric_pairs=False,
+                          **kwargs):
+        """Generate the triplets of the tasks and their shared pairs
+
+        Parameters
+        ----------
+
+        output : str
+            the TaskSet file to write
+
+        tmpdir : str, optional
+            the directory of the temporary files, in which the task
+            files are generated before being copied to output
+
+        symmetric_pairs : bool, optional
+            encode the pairs (i, j) and (j, i) with the same key, see
+            Task.generate_triplets
+
+        kwargs : the other arguments of Task.generate_triplets, used
+            for all the tasks (threshold, seed, n_cpu, factorized...)
+
+        """
+        base = len(self.items)
+        key_type = fit_integer_type(base ** 2 - 1, is_signed=False)
+        pairs = np.empty(0, dtype=key_type)
+
+        with h5py.File(output, 'w') as fh:
+            fh.create_group('tasks')
+
+        for name, task in self.tasks.items():
+            if self.verbose:
+                print('generating the task {}'.format(name))
+            fd, task_file = tempfile.mkstemp(dir=tmpdir, suffix='.abx')
+            os.close(fd)
+            os.remove(task_file)
+            try:
+                task.generate_triplets(
+                    output=task_file, tmpdir=tmpdir,
+                    symmetric_pairs=symmetric_pairs, **kwargs)
+                pairs = np.union1d(pairs, self._copy_task(
+                    name, task, task_file, output, key_type,
+                    symmetric_pairs))
+            finally:
+                if os.path.exists(task_file):
+                    os.remove(task_file)
+
+        with h5py.File(output, 'a') as fh:
+            fh.create_dataset(
+                'bys', (1,), dtype=h5py.special_dtype(vlen=str))
+            fh['bys'][:] = [triplets_io.SHARED_PAIRS]
+            fh.create_dataset(
+                'unique_pairs/data', data=pairs.astype(np.int64)[:, None])
+            fh['unique_pairs/data'].attrs['symmetric'] = symmetric_pairs
+            fh['unique_pairs'].attrs[triplets_io.SHARED_PAIRS] = (
+                base, 0, pairs.shape[0])
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', tables.NaturalNameWarning)
+            with pd.HDFStore(output) as store:
+                store.append('/feat_dbs/' + triplets_io.SHARED_PAIRS,
+                             self.items, expectedrows=len(self.items))
+
+    def _copy_task(self, name, task, task_file, output, key_type,
+                   symmetric_pairs):
+        """Copy a task file in the TaskSet file
+
+        The triplets and regressors of the task are copied as they are,
+        with the position of the items of each 'by' block in the items
+        of the TaskSet. Returns the keys of the pairs of the task in the
+        items of the TaskSet.
+
+        """
+        feat_dbs = {str(by): feat_db for by, feat_db in task.feat_dbs.items()}
+        base = len(self.items)
+        items, keys = [], [np.empty(0, dtype=key_type)]
+        with h5py.File(task_file, 'r') as fin, \
+                h5py.File(output, 'a') as fout:
+            group = fout['tasks'].create_group(name)
+            for dset in ('bys', 'triplets', 'regressors'):
+                fin.copy(dset, group)
+
+            for by in fin['bys'][...]:
+                positions = self._items_index.get_indexer(
+                    pd.MultiIndex.from_frame(feat_dbs[by]))
+                items.append(positions)
+
+                by_base, start, stop = fin['unique_pairs'].attrs[by]
+                by_pairs = fin['unique_pairs/data'][start:stop, 0]
+                keys.append(triplets_io.pair_keys(
+                    key_type(positions[np.mod(by_pairs, by_base)]),
+                    key_type(positions[by_pairs // by_base]),
+                    base, symmetric_pairs))
+
+            sizes = np.cumsum([0] + [len(positions) for positions in items])
+            group.create_dataset('items/data', data=np.concatenate(
+                items + [np.empty(0, dtype=np.int64)]).astype(
+                    fit_integer_type(base, is_signed=False)))
+            group.create_dataset('items/by_index', data=np.column_stack(
+                (sizes[:-1], sizes[1:])).astype(np.int64))
+        return np.unique(np.concatenate(keys))
+
+
+def parse_arguments():
+    """Parse command-line arguments"""
+    parser = argparse.ArgumentParser(
+        description='Generate several ABX tasks on the same database, '
+        'sharing their pairs so that the distances of all the tasks are '
+        'computed at once')
+
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='output messages to the standard output')
+
+    parser.add_argument(
+        '--tempdir', default=None,
+        help='directory where temporary files will be stored')
+
+    parser.add_argument(
+        '--seed', default=None, type=int,
+        help='seed used to initialize the pseudo-random number generator')
+
+    parser.add_argument(
+        '-j', '--njobs', default=1, type=int,
+        help='number of cpus to use for generating the triplets, '
+        'default is %(default)s')
+
+    parser.add_argument(
+        '--factorized', action='store_true',
+        help='store only the A, B and X candidates of each on/across '
+        'block instead of all the triplets, see abx-task')
+
+    parser.add_argument(
+        '--symmetric-pairs', action='store_true',
+        help='encode the pairs (i, j) and (j, i) with the same key so that '
+        'their distance is computed only once, to be used only with '
+        'symmetric distances')
+
+    parser.add_argument(
+        '-t', '--threshold', default=None, type=int,
+        help='threshold on the maximal size of a block of'
+        ' triplets sharing the same regressors, for all the tasks')
+
+    parser.add_argument(
+        'database', help='database item file used to form ABX triplets')
+
+    parser.add_argument(
+        'tasks', help='json file specifying the tasks, as a dictionary '
+        'mapping the name of each task to a dictionary with an "on" entry '
+        'and optional "across", "by", "filters" and "regressors" entries')
+
+    parser.add_argument(
+        'output', help='file to write the generated ABX tasks')
+
+    return parser.parse_args()
+
+
+def main():
+    """Command-line API for generating several ABX tasks"""
+    args = parse_arguments()
+
+    if os.path.exists(args.output):
+        warnings.warn("Overwriting task file " + args.output, UserWarning)
+        os.remove(args.output)
+
+    if args.tempdir and not os.path.exists(args.tempdir):
+        os.makedirs(args.tempdir)
+
+    with open(args.tasks) as fid:
+        tasks = json.load(fid, object_pairs_hook=collections.OrderedDict)
+
+    taskset = TaskSet(args.database, tasks, verbose=args.verbose)
+    taskset.generate_triplets(
+        args.output,
+        tmpdir=args.tempdir,
+        symmetric_pairs=args.symmetric_pairs,
+        threshold=args.threshold,
+        seed=args.seed,
+        n_cpu=args.njobs,
+        factorized=args.factorized)
+
+
+if __name__ == '__main__':
+    main()
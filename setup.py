@@ -61,5 +61,7 @@ setuptools.setup(
         'abx-distance = ABXpy.distance:main',
         'abx-analyze = ABXpy.analyze:main',
         'abx-score = ABXpy.score:main',
+        'abx-sequential = ABXpy.sequential:main',
+        'abx-taskset = ABXpy.taskset:main',
     ]}
 )
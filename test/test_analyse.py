@@ -10,7 +10,11 @@ import ABXpy.distances.metrics.dtw as dtw
 import ABXpy.score as score
 import ABXpy.misc.items as items
 import ABXpy.analyze as analyze
+import ABXpy.sequential as sequential
+import ABXpy.taskset as taskset
+import h5py
 import numpy as np
+import pandas
 
 
 frozen_folder = os.path.join(
@@ -107,3 +111,132 @@ def test_frozen_analyze():
 
     finally:
         shutil.rmtree('test_items', ignore_errors=True)
+
+
+def test_factorized_analyze():
+    """The analysis of a factorized task must be the same as the one of
+    the explicit task
+    """
+    try:
+        if not os.path.exists('test_items'):
+            os.makedirs('test_items')
+        item_file = frozen_file('item')
+        feature_file = frozen_file('features')
+        distance_file = 'test_items/data.distance'
+        scorefilename = 'test_items/data.score'
+        taskfilename = 'test_items/data.abx'
+        analyzefilename = 'test_items/data.csv'
+
+        task = ABXpy.task.Task(item_file, 'c0', 'c1', 'c2')
+        task.generate_triplets(taskfilename, factorized=True)
+        distances.compute_distances(
+            feature_file, '/features/', taskfilename,
+            distance_file, dtw_cosine_distance,
+            normalized=True, n_cpu=1)
+        score.score(taskfilename, distance_file, scorefilename)
+        analyze.analyze(taskfilename, scorefilename, analyzefilename)
+
+        assert items.csv_cmp(analyzefilename, frozen_file('csv'))
+
+    finally:
+        shutil.rmtree('test_items', ignore_errors=True)
+
+
+def test_sequential_estimate():
+    """With a precision of 0, the sequential estimation scores all the
+    triplets and gives the results of analyze
+    """
+    try:
+        if not os.path.exists('test_items'):
+            os.makedirs('test_items')
+        item_file = frozen_file('item')
+        feature_file = frozen_file('features')
+        resultfilename = 'test_items/data.csv'
+        columns = ['c1_1', 'c0_1', 'c0_2', 'c1_2', 'by']
+        expected = pandas.read_csv(frozen_file('csv'), sep='\t').sort_values(
+            columns).reset_index(drop=True)
+
+        task = ABXpy.task.Task(item_file, 'c0', 'c1', 'c2')
+        # the drawn triplets are read from the candidates of a factorized
+        # task file and from the stored triplets otherwise
+        for factorized in (True, False):
+            taskfilename = 'test_items/data_{}.abx'.format(factorized)
+            task.generate_triplets(taskfilename, factorized=factorized)
+            sequential.estimate(
+                feature_file, taskfilename, resultfilename,
+                dtw_cosine_distance, normalized=True, precision=0,
+                round_size=10, seed=0, group='/features/')
+            results = pandas.read_csv(resultfilename, sep='\t').sort_values(
+                columns).reset_index(drop=True)
+            assert np.all(results[columns] == expected[columns])
+            assert np.allclose(results['score'], expected['score'])
+            assert np.all(results['n'] == expected['n'])
+            assert np.all(results['n_triplets'] == expected['n'])
+            assert np.all(results['precision'] == 0)
+
+            # a loose precision is reached with fewer triplets
+            sequential.estimate(
+                feature_file, taskfilename, resultfilename,
+                dtw_cosine_distance, normalized=True, precision=0.2,
+                round_size=5, seed=0, group='/features/')
+            results = pandas.read_csv(resultfilename, sep='\t')
+            assert np.sum(results['n']) < np.sum(results['n_triplets'])
+            assert np.all((results['precision'] <= 0.2) |
+                          (results['n'] == results['n_triplets']))
+    finally:
+        shutil.rmtree('test_items', ignore_errors=True)
+
+
+def test_taskset_analyze():
+    """The analysis of the tasks of a TaskSet, scored with the distances
+    of their shared pairs, must be the same as the one of the tasks
+    """
+    try:
+        if not os.path.exists('test_items'):
+            os.makedirs('test_items')
+        item_file = frozen_file('item')
+        feature_file = frozen_file('features')
+        distance_file = 'test_items/data.distance'
+        taskfilename = 'test_items/data.abxs'
+        specs = {'frozen': {'on': 'c0', 'across': 'c1', 'by': 'c2'},
+                 'other': {'on': 'c1', 'across': 'c0', 'by': 'c2'}}
+
+        tasks = taskset.TaskSet(item_file, specs)
+        tasks.generate_triplets(taskfilename, symmetric_pairs=True)
+        distances.compute_distances(
+            feature_file, '/features/', taskfilename,
+            distance_file, dtw_cosine_distance,
+            normalized=True, n_cpu=1, symmetric=True)
+
+        n_pairs = 0
+        for name, spec in specs.items():
+            scorefilename = 'test_items/{}.score'.format(name)
+            analyzefilename = 'test_items/{}.csv'.format(name)
+            score.score(taskfilename, distance_file, scorefilename,
+                        task=name)
+            analyze.analyze(taskfilename, scorefilename, analyzefilename,
+                            task=name)
+
+            # the same task alone
+            ABXpy.task.Task(item_file, **spec).generate_triplets(
+                'test_items/data.abx', symmetric_pairs=True)
+            with h5py.File('test_items/data.abx', 'r') as fid:
+                n_pairs += fid['unique_pairs/data'].shape[0]
+            distances.compute_distances(
+                feature_file, '/features/', 'test_items/data.abx',
+                'test_items/data.distance2', dtw_cosine_distance,
+                normalized=True, n_cpu=1, symmetric=True)
+            score.score('test_items/data.abx', 'test_items/data.distance2',
+                        'test_items/data.score')
+            analyze.analyze('test_items/data.abx', 'test_items/data.score',
+                            'test_items/data.csv')
+            assert items.csv_cmp(analyzefilename, 'test_items/data.csv')
+            for name in ('data.abx', 'data.distance2', 'data.score'):
+                os.remove(os.path.join('test_items', name))
+        assert items.csv_cmp('test_items/frozen.csv', frozen_file('csv'))
+
+        # the pairs shared by the tasks are computed once
+        with h5py.File(taskfilename, 'r') as fid:
+            assert fid['unique_pairs/data'].shape[0] < n_pairs
+    finally:
+        shutil.rmtree('test_items', ignore_errors=True)
@@ -99,6 +99,42 @@ def test_simple_uniformity():
                          n=random.randrange(50, N))
 
 
+def test_sample_without_replacement():
+    for n, N in ((0, 10), (10, 10), (3, 10), (500, 1000), (10, 10 ** 6),
+                 (10 ** 4, 10 ** 5), (10 ** 3, 10 ** 12)):
+        for sample in (sampling.sampler.Knuth_sampling(n, min(N, 10 ** 6)),
+                       sampling.sampler.sample_without_replacement(n, N)):
+            assert len(sample) == n
+            assert np.all(np.diff(sample) > 0)
+            assert n == 0 or (sample[0] >= 0 and sample[-1] < N)
+        if n < N:
+            sample = sampling.sampler.rejection_sampling(n, N)
+            assert len(sample) == n and np.all(np.diff(sample) > 0)
+
+
+def test_hypergeometric_split():
+    sizes = np.array([10, 0, 1000, 3, 10 ** 10, 1])
+    counts = np.array([sampling.sampler.hypergeometric_split(100, sizes)
+                       for _ in range(1000)])
+    assert np.all(counts.sum(axis=1) == 100)
+    assert np.all(counts <= sizes)
+    assert np.all(counts[:, 1] == 0)
+    # the expected counts are 100 * sizes / sum(sizes)
+    assert np.all(counts[:, 4] >= 99)
+    sizes = np.array([100, 200, 700])
+    counts = np.array([sampling.sampler.hypergeometric_split(100, sizes)
+                       for _ in range(1000)])
+    assert np.all(np.abs(counts.mean(axis=0) - [10, 20, 70]) < 1)
+
+
+def test_sample_groups():
+    offsets = np.array([0, 1, 11, 11, 111])
+    sample = sampling.sampler.sample_groups(offsets, 0.25)
+    assert np.all(np.diff(sample) > 0)
+    sizes = np.diff(np.searchsorted(sample, offsets))
+    assert list(sizes) == [1, 3, 0, 25]
+
+
 # import matplotlib.pyplot as plt
 #
 #
@@ -1,9 +1,16 @@
 """This test script contains tests for the basic parameters of score.py"""
 
+import h5py
+import numpy as np
 import os
+import pytest
 import shutil
 
+import pandas as pd
+
 import ABXpy.task
+import ABXpy.distance
+import ABXpy.distances.cache as cache_module
 import ABXpy.distances.distances as distances
 import ABXpy.distances.metrics.cosine as cosine
 import ABXpy.distances.metrics.dtw as dtw
@@ -34,3 +41,227 @@ def test_score():
         score.score(taskfilename, distance_file, scorefilename)
     finally:
         shutil.rmtree('test_items', ignore_errors=True)
+
+
+def test_symmetric_score():
+    try:
+        if not os.path.exists('test_items'):
+            os.makedirs('test_items')
+        item_file = 'test_items/data.item'
+        feature_file = 'test_items/data.features'
+        items.generate_db_and_feat(3, 3, 1, item_file, 2, 3, feature_file)
+        task = ABXpy.task.Task(item_file, 'c0', 'c1', 'c2')
+        n_pairs = {}
+        for symmetric in (False, True):
+            name = 'test_items/data_{}'.format(symmetric)
+            task.generate_triplets(
+                output=name + '.abx', symmetric_pairs=symmetric)
+            distances.compute_distances(
+                feature_file, '/features/', name + '.abx',
+                name + '.distance', dtw_cosine_distance,
+                normalized=True, n_cpu=1, symmetric=True)
+            score.score(name + '.abx', name + '.distance', name + '.score')
+            with h5py.File(name + '.abx', 'r') as fh:
+                n_pairs[symmetric] = fh['unique_pairs/data'].shape[0]
+        assert n_pairs[True] < n_pairs[False]
+
+        # the scores do not depend on the encoding of the pairs
+        with h5py.File('test_items/data_False.score', 'r') as f1, \
+                h5py.File('test_items/data_True.score', 'r') as f2:
+            assert np.array_equal(f1['scores'][...], f2['scores'][...])
+
+        # the encoding of the pairs of the task and distance files
+        # must match
+        with pytest.raises(ValueError):
+            score.score('test_items/data_True.abx',
+                        'test_items/data_False.distance',
+                        'test_items/data.score')
+
+        # symmetric pairs are not allowed with an asymmetric distance,
+        # the distances being asymmetric by default
+        with pytest.raises(ValueError):
+            distances.compute_distances(
+                feature_file, '/features/', 'test_items/data_True.abx',
+                'test_items/data.distance', dtw_cosine_distance,
+                normalized=True, n_cpu=1)
+    finally:
+        shutil.rmtree('test_items', ignore_errors=True)
+
+
+# the built-in distances are symmetric except the Kullback-Leibler
+# divergence, the custom ones only when declared symmetric
+def test_get_distance_symmetric():
+    assert ABXpy.distance.get_distance()[1]
+    assert ABXpy.distance.get_distance('levenshtein')[1]
+    assert not ABXpy.distance.get_distance('dtw_kl')[1]
+    assert not ABXpy.distance.get_distance('dtw_kl', symmetric=True)[1]
+
+    custom = os.path.splitext(cosine.__file__)[0] + '.cosine_distance'
+    function, symmetric = ABXpy.distance.get_distance(custom)
+    assert function.__name__ == 'cosine_distance'
+    assert not symmetric
+    assert ABXpy.distance.get_distance(custom, symmetric=True)[1]
+
+
+def test_update_distances():
+    try:
+        if not os.path.exists('test_items'):
+            os.makedirs('test_items')
+        item_file = 'test_items/data.item'
+        feature_file = 'test_items/data.features'
+        items.generate_db_and_feat(3, 3, 1, item_file, 2, 3, feature_file)
+        task = ABXpy.task.Task(item_file, 'c0', 'c1', 'c2')
+        task.generate_triplets(output='test_items/data1.abx')
+        distances.compute_distances(
+            feature_file, '/features/', 'test_items/data1.abx',
+            'test_items/data1.distance', dtw_cosine_distance,
+            normalized=True, n_cpu=1)
+
+        # remove an item of the 'by' block c2_v2
+        with open(item_file) as fin:
+            lines = fin.readlines()
+        lines.remove([l for l in lines if 'c2_v2' in l][0])
+        with open(item_file, 'w') as fout:
+            fout.writelines(lines)
+        task = ABXpy.task.Task(item_file, 'c0', 'c1', 'c2')
+        task.generate_triplets(
+            output='test_items/data2.abx', update='test_items/data1.abx')
+        # only the distances of the changed 'by' block are computed
+        jobs = distances.create_distance_jobs(
+            'test_items/data2.abx', 'test_items/data4.distance', 1,
+            previous=('test_items/data1.abx', 'test_items/data1.distance'))
+        assert jobs[0]['by'] == ['c2_v2']
+
+        distances.compute_distances(
+            feature_file, '/features/', 'test_items/data2.abx',
+            'test_items/data2.distance', dtw_cosine_distance,
+            normalized=True, n_cpu=1,
+            previous=('test_items/data1.abx', 'test_items/data1.distance'))
+        distances.compute_distances(
+            feature_file, '/features/', 'test_items/data2.abx',
+            'test_items/data3.distance', dtw_cosine_distance,
+            normalized=True, n_cpu=1)
+        with h5py.File('test_items/data2.distance', 'r') as f2, \
+                h5py.File('test_items/data3.distance', 'r') as f3:
+            assert np.array_equal(f2['distances/data'][...],
+                                  f3['distances/data'][...])
+    finally:
+        shutil.rmtree('test_items', ignore_errors=True)
+
+
+CALLS = []
+
+
+def counted_distance(x, y, normalized):
+    CALLS.append(1)
+    return dtw_cosine_distance(x, y, normalized)
+
+
+def test_distance_cache():
+    try:
+        if not os.path.exists('test_items'):
+            os.makedirs('test_items')
+        item_file = 'test_items/data.item'
+        feature_file = 'test_items/data.features'
+        cache = 'test_items/cache'
+        items.generate_db_and_feat(3, 3, 1, item_file, 2, 3, feature_file)
+        ABXpy.task.Task(item_file, 'c0', 'c1', 'c2').generate_triplets(
+            output='test_items/data1.abx')
+        ABXpy.task.Task(item_file, 'c0', 'c1').generate_triplets(
+            output='test_items/data2.abx')
+
+        distances.compute_distances(
+            feature_file, '/features/', 'test_items/data1.abx',
+            'test_items/data1.distance', counted_distance,
+            normalized=True, n_cpu=1, cache=cache)
+        assert len(CALLS) > 0
+
+        # all the distances are read from the cache
+        del CALLS[:]
+        distances.compute_distances(
+            feature_file, '/features/', 'test_items/data1.abx',
+            'test_items/data3.distance', counted_distance,
+            normalized=True, n_cpu=1, cache=cache)
+        assert len(CALLS) == 0
+        with h5py.File('test_items/data1.distance', 'r') as f1, \
+                h5py.File('test_items/data3.distance', 'r') as f3:
+            assert np.array_equal(f1['distances/data'][...],
+                                  f3['distances/data'][...])
+
+        # the distances cached as asymmetric are not read as symmetric
+        distances.compute_distances(
+            feature_file, '/features/', 'test_items/data1.abx',
+            'test_items/data6.distance', counted_distance,
+            normalized=True, n_cpu=1, cache=cache, symmetric=True)
+        with h5py.File('test_items/data1.abx', 'r') as fh:
+            assert len(CALLS) == fh['unique_pairs/data'].shape[0]
+        del CALLS[:]
+
+        # a different task computes only the pairs it does not share
+        distances.compute_distances(
+            feature_file, '/features/', 'test_items/data2.abx',
+            'test_items/data2.distance', counted_distance,
+            normalized=True, n_cpu=1, cache=cache)
+        with h5py.File('test_items/data2.abx', 'r') as fh:
+            n_pairs = fh['unique_pairs/data'].shape[0]
+        assert 0 < len(CALLS) < n_pairs
+        del CALLS[:]
+        distances.compute_distances(
+            feature_file, '/features/', 'test_items/data2.abx',
+            'test_items/data4.distance', counted_distance,
+            normalized=True, n_cpu=1)
+        assert len(CALLS) == n_pairs
+        with h5py.File('test_items/data2.distance', 'r') as f2, \
+                h5py.File('test_items/data4.distance', 'r') as f4:
+            assert np.array_equal(f2['distances/data'][...],
+                                  f4['distances/data'][...])
+
+        # the cache is emptied above its maximal size
+        distances.compute_distances(
+            feature_file, '/features/', 'test_items/data1.abx',
+            'test_items/data5.distance', counted_distance,
+            normalized=False, n_cpu=1, cache=cache, cache_size=0)
+        assert not any(files for _, _, files in os.walk(cache))
+    finally:
+        shutil.rmtree('test_items', ignore_errors=True)
+
+
+# the keys of the pairs are the hashes of their items, the distances are
+# merged in a chunk by shard, and the symmetric keys do not depend on the
+# order of the items
+def test_distance_cache_chunks():
+    try:
+        items_db = pd.DataFrame({'file': ['f{}'.format(i) for i in range(50)],
+                                 'onset': np.arange(50.),
+                                 'offset': np.arange(50.) + 1})
+        hashes = pd.util.hash_pandas_object(items_db, index=False).values
+        A, B = np.triu_indices(50, 1)
+        for symmetric in (False, True):
+            cache = cache_module.DistanceCache(
+                'test_items/cache', str(symmetric), symmetric=symmetric)
+            keys = cache.keys(items_db, A, B)
+            assert keys.dtype == cache_module.KEY_DTYPE
+            first, second = hashes[A], hashes[B]
+            if symmetric:
+                first, second = (np.minimum(first, second),
+                                 np.maximum(first, second))
+            assert np.array_equal(keys['first'], first)
+            assert np.array_equal(keys['second'], second)
+            for i in range(10):
+                cache.store(keys[i::10], np.float64(A + B)[i::10])
+                cache.flush()
+            files = os.listdir(cache.chunks)
+            assert 0 < len(files) <= 2 ** cache_module.SHARD_BITS
+
+            # read back by another instance
+            cache = cache_module.DistanceCache(
+                'test_items/cache', str(symmetric), symmetric=symmetric)
+            values, found = cache.lookup(cache.keys(items_db, B, A))
+            if symmetric:
+                assert found.all() and np.array_equal(values, A + B)
+            else:
+                assert not found.any()
+            values, found = cache.lookup(keys)
+            assert found.all() and np.array_equal(values, A + B)
+    finally:
+        shutil.rmtree('test_items', ignore_errors=True)
@@ -3,10 +3,16 @@
 import h5py
 import numpy as np
 import os
+import pytest
+import shutil
 import warnings
 
 import ABXpy.task
+import ABXpy.database.database as database
+import ABXpy.distances.distances as distances
+import ABXpy.h5tools.h5io as h5io
 import ABXpy.misc.items as items
+import ABXpy.misc.triplets as triplets_io
 
 error_pairs = "pairs incorrectly generated"
 error_triplets = "triplets incorrectly generated"
@@ -101,6 +107,70 @@ def test_multiple_across():
             pass
 
 
+# testing the X candidates of the blocks with several across columns
+# differ from A on all these columns
+def test_antiacross_items():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            task = ABXpy.task.Task('data.item', 'c0', ['c1', 'c2'], 'c3')
+
+        for by, blocks in task.on_across_blocks.items():
+            db = task.by_dbs[by]
+            for key, block in blocks.groups.items():
+                _, across = ABXpy.task.on_across_from_key(key)
+                A, _, X = task._ABX_candidates(by, across, block)
+                values = db.loc[A[0]]
+                expected = db.index[
+                    (db['c0'] == values['c0']) &
+                    (db['c1'] != values['c1']) &
+                    (db['c2'] != values['c2'])]
+                assert np.array_equal(X, expected)
+    finally:
+        try:
+            os.remove('data.item')
+        except OSError:
+            pass
+
+
+# testing the A, B and X candidates taken from the code arrays are the
+# items selected on the database of the 'by' block, and nb_levels counts
+# the X candidates differing from A on all the across columns
+def test_ABX_candidates():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        task = ABXpy.task.Task('data.item', 'c0', ['c1', 'c2'], 'c3')
+        nb_levels = {}
+        for by in task.by_dbs:
+            db = task.by_dbs[by]
+            nb_levels[by] = 0
+            for key, block in task.on_across_blocks[by].groups.items():
+                on, across = ABXpy.task.on_across_from_key(key)
+                A, B, X = task._ABX_candidates(by, across, block)
+                same_on = db['c0'] == on
+                same_across = (db['c1'] == across[0]) & (
+                    db['c2'] == across[1])
+                anti_across = (db['c1'] != across[0]) & (
+                    db['c2'] != across[1])
+                assert np.array_equal(A, db.index[same_on & same_across])
+                assert np.array_equal(B, db.index[~same_on & same_across])
+                assert np.array_equal(X, db.index[same_on & anti_across])
+
+                if len(B) and len(X):
+                    cols = ['c0', 'c1', 'c2']
+                    nb_levels[by] += (
+                        len(db.loc[B].groupby(cols).groups) *
+                        len(db.loc[X].groupby(cols).groups))
+
+        task.compute_nb_levels()
+        for by in task.by_dbs:
+            assert task.by_stats[by]['nb_levels'] == nb_levels[by]
+        assert task.stats['nb_levels'] == sum(nb_levels.values())
+    finally:
+        os.remove('data.item')
+
+
 # testing without any across attribute
 def test_no_across():
     items.generate_testitems(2, 3, name='data.item')
@@ -237,3 +307,779 @@ def test_filter_on_C():
             os.remove('data.item')
         except OSError:
             pass
+
+
+# testing the distribution of by blocks on several cpus gives the
+# same task file than a serial generation
+def test_parallel():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        for output, n_cpu in (('data1.abx', 1), ('data2.abx', 3)):
+            task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2')
+            task.generate_triplets(
+                output=output, threshold=2, seed=0, n_cpu=n_cpu)
+
+        f1 = h5py.File('data1.abx', 'r')
+        f2 = h5py.File('data2.abx', 'r')
+        assert list(f1['bys']) == list(f2['bys'])
+        for dset in ('triplets/data', 'triplets/by_index',
+                     'triplets/on_across_block_index', 'unique_pairs/data'):
+            assert np.array_equal(f1[dset][...], f2[dset][...]), dset
+        for by in f1['bys']:
+            assert np.array_equal(f1['unique_pairs'].attrs[by],
+                                  f2['unique_pairs'].attrs[by])
+            assert np.array_equal(
+                f1['regressors'][by]['indexed_data'][...],
+                f2['regressors'][by]['indexed_data'][...])
+    finally:
+        try:
+            os.remove('data1.abx')
+            os.remove('data2.abx')
+            os.remove('data.item')
+        except OSError:
+            pass
+
+
+# testing the sampled triplets only depend on the seed, not on the
+# global numpy random state nor on the number of processes
+def test_random_streams():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        for output, n_cpu in (('data1.abx', 1), ('data2.abx', 3)):
+            np.random.seed(n_cpu)
+            task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2',
+                                   regressors=['c3_B'])
+            task.generate_triplets(
+                output=output, threshold=1, seed=0, n_cpu=n_cpu)
+
+        with h5py.File('data1.abx', 'r') as f1, \
+                h5py.File('data2.abx', 'r') as f2:
+            assert np.array_equal(f1['triplets/data'][...],
+                                  f2['triplets/data'][...])
+    finally:
+        for f in ('data1.abx', 'data2.abx', 'data.item'):
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+
+# testing the closed-form statistics against the by-block computation
+def test_statistics():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        for across in (None, 'c1', ['c1', 'c3']):
+            task = ABXpy.task.Task('data.item', 'c0', across, 'c2')
+            stats, by_stats = task.stats, task.by_stats
+            task.stats = {'approximate': False}
+            task.by_stats = {}
+            task._compute_statistics_by_block(False)
+            for by, bystats in by_stats.items():
+                for key in ('nb_items', 'nb_triplets', 'nb_across_pairs',
+                            'nb_on_pairs', 'nb_on_across_levels'):
+                    assert bystats[key] == task.by_stats[by][key], key
+                assert bystats['block_sizes'] == \
+                    task.by_stats[by]['block_sizes']
+                assert bystats['on_levels'].equals(
+                    task.by_stats[by]['on_levels'])
+            assert stats['nb_triplets'] == sum(
+                [s['nb_triplets'] for s in task.by_stats.values()])
+    finally:
+        try:
+            os.remove('data.item')
+        except OSError:
+            pass
+
+
+# testing the batched processing of small on/across blocks gives the
+# same task file than processing the blocks one by one
+def test_batches():
+    items.generate_testitems(3, 4, name='data.item')
+    max_block_size = ABXpy.task.BATCH_MAX_BLOCK_SIZE
+    batch_size = ABXpy.task.BATCH_SIZE
+    try:
+        for output, block_size in (('data1.abx', -1), ('data2.abx', 1000)):
+            ABXpy.task.BATCH_MAX_BLOCK_SIZE = block_size
+            ABXpy.task.BATCH_SIZE = 50
+            task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2',
+                                   regressors=['c3_A'])
+            task.generate_triplets(output=output, threshold=2, seed=0)
+
+        f1 = h5py.File('data1.abx', 'r')
+        f2 = h5py.File('data2.abx', 'r')
+        for dset in ('triplets/data', 'triplets/on_across_block_index'):
+            assert np.array_equal(f1[dset][...], f2[dset][...]), dset
+        for by in f1['bys']:
+            assert np.array_equal(
+                f1['regressors'][by]['indexed_data'][...],
+                f2['regressors'][by]['indexed_data'][...])
+    finally:
+        ABXpy.task.BATCH_MAX_BLOCK_SIZE = max_block_size
+        ABXpy.task.BATCH_SIZE = batch_size
+        try:
+            os.remove('data1.abx')
+            os.remove('data2.abx')
+            os.remove('data.item')
+        except OSError:
+            pass
+
+
+# testing the regressors of the on/across blocks are stored once per
+# block and expanded to the values of the triplets
+def test_block_regressors():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        for filters in (None, ['[attr == 0 for attr in c3_A]']):
+            task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2',
+                                   filters=filters, regressors=['c3_X'])
+            task.generate_triplets(output='data.abx', threshold=2, seed=0)
+            by_dbs = {str(by): db for by, db in task.by_dbs.items()}
+            with h5py.File('data.abx', 'r') as f:
+                for n_by, by in enumerate(f['bys']):
+                    group = f['regressors'][by]
+                    assert set(group['run_length_datasets']) == {
+                        'c0_1', 'c1_1'}
+                    start, stop = f['triplets/by_index'][n_by]
+                    assert np.sum(group['run_lengths']) == stop - start
+                    assert group['run_length_data'].shape[0] < stop - start
+
+                    regressors = h5io.read_indexed(group)
+                    triplets = get_triplets(f, by)
+                    by_db = by_dbs[by]
+                    for name, column, role in (('c0_1', 'c0', 0),
+                                               ('c1_1', 'c1', 0),
+                                               ('c0_2', 'c0', 1),
+                                               ('c3_X', 'c3', 2)):
+                        i = list(group['non_fused_datasets']).index(name)
+                        col = int(group['indexed_cumudims'][i]) - 1
+                        values = group['indexes'][name][...][
+                            regressors[:, col]]
+                        expected = by_db[column].values[triplets[:, role]]
+                        assert np.array_equal(values, expected), name
+            os.remove('data.abx')
+    finally:
+        for name in ('data.abx', 'data.item'):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+
+# the estimated numbers of triplets and unique pairs and DTW cost of
+# a task are the ones of the generated task file
+def test_estimate():
+    try:
+        items.generate_db_and_feat(3, 3, 1, 'data.item', 2, 3,
+                                   'data.features')
+        # items of 1 to 3 frames
+        with open('data.item') as fin:
+            lines = fin.readlines()
+        with open('data.item', 'w') as fout:
+            fout.write(lines[0])
+            for line in lines[1:]:
+                cols = line.split(' ')
+                fout.write(' '.join(cols[:2] + ['1'] + cols[3:]))
+
+        for across, by in ((None, 'c2'), ('c1', 'c2'), (['c1', 'c2'], None)):
+            for symmetric in (False, True):
+                task = ABXpy.task.Task('data.item', 'c0', across, by)
+                estimate = task.estimate(
+                    'data.features', symmetric_pairs=symmetric)
+                task.generate_triplets(
+                    output='data.abx', symmetric_pairs=symmetric)
+                with h5py.File('data.abx', 'r') as f:
+                    assert estimate['nb_triplets'] == (
+                        f['triplets/data'].shape[0])
+                    assert estimate['nb_pairs'] == (
+                        f['unique_pairs/data'].shape[0])
+                    feat_dbs = {str(key): feat_db
+                                for key, feat_db in task.feat_dbs.items()}
+                    for name in f['bys']:
+                        base, start, stop = f['unique_pairs'].attrs[name]
+                        pairs = f['unique_pairs/data'][start:stop, 0]
+                        block = estimate['by_blocks'].loc[name]
+                        assert block['nb_pairs'] == len(pairs)
+                        frames = distances.frame_counts(
+                            'data.features', 'features', feat_dbs[name])
+                        assert block['dtw_cost'] == np.sum(
+                            frames[pairs % base] * frames[pairs // base])
+                os.remove('data.abx')
+    finally:
+        for name in ('data.abx', 'data.item', 'data.features'):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+
+# testing the counting sort of the regressors is the stable sort of
+# numpy, with keys of one or several digits
+def test_counting_sort():
+    rng = np.random.RandomState(0)
+    for n_keys in (1, 7, 300, 70000, 2 ** 40):
+        for dtype in (np.int64, np.uint64):
+            keys = rng.randint(0, min(n_keys, 2 ** 62), 1000).astype(dtype)
+            assert np.array_equal(
+                ABXpy.task.counting_sort(keys, n_keys),
+                np.argsort(keys, kind='mergesort'))
+
+
+# testing the generation of the triplets of the tasks without across
+# by 'on' levels gives the same task file than processing the blocks
+# one by one
+def test_no_across_levels():
+    items.generate_testitems(3, 4, name='data.item')
+    batchable = ABXpy.task.Task._batchable
+    batch_size = ABXpy.task.BATCH_SIZE
+    try:
+        for output, batch in (('data1.abx', False), ('data2.abx', True)):
+            ABXpy.task.Task._batchable = (
+                batchable if batch else lambda self: False)
+            ABXpy.task.BATCH_SIZE = 500
+            task = ABXpy.task.Task('data.item', 'c0', None, 'c2',
+                                   regressors=['c3_A', 'c1_X'])
+            task.generate_triplets(output=output, threshold=2, seed=0)
+
+        f1 = h5py.File('data1.abx', 'r')
+        f2 = h5py.File('data2.abx', 'r')
+        for dset in ('triplets/data', 'triplets/on_across_block_index'):
+            assert np.array_equal(f1[dset][...], f2[dset][...]), dset
+        for by in f1['bys']:
+            assert np.array_equal(
+                f1['regressors'][by]['indexed_data'][...],
+                f2['regressors'][by]['indexed_data'][...])
+    finally:
+        ABXpy.task.Task._batchable = batchable
+        ABXpy.task.BATCH_SIZE = batch_size
+        try:
+            os.remove('data1.abx')
+            os.remove('data2.abx')
+            os.remove('data.item')
+        except OSError:
+            pass
+
+
+# testing the sampling of the triplets of the large blocks before they
+# are built gives the same triplets than thresholding all the triplets
+# without ABX filters, and the same number of triplets with them
+def test_threshold_sampling():
+    items.generate_testitems(3, 5, repeats=1, name='data.item')
+    max_block_size = ABXpy.task.BATCH_MAX_BLOCK_SIZE
+    min_size = ABXpy.task.THRESHOLD_SAMPLING_MIN_SIZE
+    try:
+        for filters in (None, ['[a == x for a, x in zip(c4_A, c4_X)]']):
+            for output, size in (('data1.abx', 10 ** 12), ('data2.abx', 0)):
+                ABXpy.task.BATCH_MAX_BLOCK_SIZE = -1
+                ABXpy.task.THRESHOLD_SAMPLING_MIN_SIZE = size
+                task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2',
+                                       regressors=['c3_B', 'c4_X'],
+                                       filters=filters)
+                task.generate_triplets(output=output, threshold=3, seed=0)
+
+            with h5py.File('data1.abx', 'r') as f1, \
+                    h5py.File('data2.abx', 'r') as f2:
+                assert np.array_equal(f1['triplets/by_index'][...],
+                                      f2['triplets/by_index'][...])
+                if filters is None:
+                    for dset in ('triplets/data',
+                                 'triplets/on_across_block_index'):
+                        assert np.array_equal(f1[dset][...], f2[dset][...])
+                else:
+                    for by, by_db in task.by_dbs.items():
+                        c4 = by_db['c4'].values
+                        triplets = get_triplets(f2, str(by))
+                        assert np.all(
+                            c4[triplets[:, 0]] == c4[triplets[:, 2]])
+            os.remove('data1.abx')
+            os.remove('data2.abx')
+    finally:
+        ABXpy.task.BATCH_MAX_BLOCK_SIZE = max_block_size
+        ABXpy.task.THRESHOLD_SAMPLING_MIN_SIZE = min_size
+        for f in ('data1.abx', 'data2.abx', 'data.item'):
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+
+# testing the sampling of the triplets of the large blocks before they
+# are built with ABX filters rejecting most triplets: the cells are then
+# enumerated, their sizes are the exact numbers of triplets passing the
+# filters and at most threshold of these triplets are sampled
+def test_threshold_sampling_filtered():
+    items.generate_testitems(3, 5, repeats=1, name='data.item')
+    max_block_size = ABXpy.task.BATCH_MAX_BLOCK_SIZE
+    min_size = ABXpy.task.THRESHOLD_SAMPLING_MIN_SIZE
+    filters = ['[a == x for a, x in zip(c4_A, c4_X)]',
+               '[a == b for a, b in zip(c3_A, c3_B)]']
+    threshold = 50
+    try:
+        for output, size in (('data1.abx', 10 ** 12), ('data2.abx', 0)):
+            ABXpy.task.BATCH_MAX_BLOCK_SIZE = -1
+            ABXpy.task.THRESHOLD_SAMPLING_MIN_SIZE = size
+            task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2',
+                                   regressors=['c3_B', 'c4_X'],
+                                   filters=filters)
+            task.generate_triplets(
+                output=output, threshold=threshold, seed=0)
+
+        with h5py.File('data1.abx', 'r') as f1, \
+                h5py.File('data2.abx', 'r') as f2:
+            for dset in ('triplets/by_index',
+                         'triplets/on_across_block_index'):
+                assert np.array_equal(f1[dset][...], f2[dset][...])
+            # the index of each on/across block is 0 followed by the
+            # end of each of its cells, all of them above the threshold
+            n_cells = (len(f2['triplets/on_across_block_index'])
+                       - task.stats['nb_blocks'])
+            assert len(f2['triplets/data']) == threshold * n_cells
+
+            for by, by_db in task.by_dbs.items():
+                c3, c4 = by_db['c3'].values, by_db['c4'].values
+                triplets = get_triplets(f2, str(by))
+                assert np.all(c4[triplets[:, 0]] == c4[triplets[:, 2]])
+                assert np.all(c3[triplets[:, 0]] == c3[triplets[:, 1]])
+                assert len(np.unique(triplets, axis=0)) == len(triplets)
+    finally:
+        ABXpy.task.BATCH_MAX_BLOCK_SIZE = max_block_size
+        ABXpy.task.THRESHOLD_SAMPLING_MIN_SIZE = min_size
+        for f in ('data1.abx', 'data2.abx', 'data.item'):
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+
+# testing the allocation of a maximal number of triplets to the blocks
+def test_allocate_triplets():
+    allocate = ABXpy.task.allocate_triplets
+    assert list(allocate([10, 20, 70], 10)) == [1, 2, 7]
+    assert list(allocate([10, 20, 70], 10, 3)) == [3, 3, 4]
+    assert list(allocate([1, 20, 70], 10, 3)) == [1, 4, 5]
+    assert list(allocate([10, 20, 70], 1000)) == [10, 20, 70]
+    try:
+        allocate([10, 20, 70], 10, 4)
+        assert False, 'the budget is too small'
+    except ValueError:
+        pass
+
+
+# testing the task has the required number of triplets and that the
+# sampled blocks are the same when generated in parallel
+def test_max_triplets():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        for output, kwargs in (
+                ('data1.abx', {}),
+                ('data2.abx', {'n_cpu': 2}),
+                ('data3.abx', {'threshold': 2}),
+                ('data4.abx', {'min_block_triplets': 1})):
+            task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2',
+                                   regressors=['c3_B'])
+            task.generate_triplets(
+                output=output, seed=0, max_triplets=100, **kwargs)
+            with h5py.File(output, 'r') as f:
+                assert f['triplets/data'].shape[0] == 100
+                for by in f['bys']:
+                    triplets = get_triplets(f, by)
+                    assert len(np.unique(triplets, axis=0)) == len(triplets)
+
+        with h5py.File('data1.abx', 'r') as f1, \
+                h5py.File('data2.abx', 'r') as f2:
+            assert np.array_equal(f1['triplets/data'][...],
+                                  f2['triplets/data'][...])
+    finally:
+        for f in ('data1.abx', 'data2.abx', 'data3.abx', 'data4.abx',
+                  'data.item'):
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+
+# testing a maximal number of pairs reduces the number of unique pairs
+# while keeping all the regressor cells of the task
+def test_max_pairs():
+    items.generate_testitems(3, 5, repeats=1, name='data.item')
+
+    def cells(f, task):
+        res = set()
+        for by in f['bys']:
+            triplets = get_triplets(f, by)
+            db = task.by_dbs[int(by)]
+            res.update(zip(*([by] + [
+                db[col].values[triplets[:, i]]
+                for col, i in (('c0', 0), ('c1', 0), ('c3', 1), ('c4', 2))])))
+        return res
+
+    try:
+        for output, max_pairs in (('data1.abx', None), ('data2.abx', 2000)):
+            task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2',
+                                   regressors=['c3_B', 'c4_X'])
+            task.generate_triplets(
+                output=output, seed=0, max_pairs=max_pairs)
+        assert task.items_fraction < 1
+
+        with h5py.File('data1.abx', 'r') as f1, \
+                h5py.File('data2.abx', 'r') as f2:
+            assert f2['unique_pairs/data'].shape[0] <= 2000
+            assert (f2['unique_pairs/data'].shape[0] <
+                    f1['unique_pairs/data'].shape[0])
+            assert cells(f1, task) == cells(f2, task)
+    finally:
+        for f in ('data1.abx', 'data2.abx', 'data.item'):
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+
+# testing a factorized task file contains the same triplets and pairs
+# than the explicit one
+def test_factorized():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        for output, factorized in (('data1.abx', False), ('data2.abx', True)):
+            task = ABXpy.task.Task('data.item', 'c0', ['c1', 'c3'], 'c2')
+            task.generate_triplets(output=output, factorized=factorized)
+
+        f1 = h5py.File('data1.abx', 'r')
+        f2 = h5py.File('data2.abx', 'r')
+        assert not triplets_io.is_factorized(f1)
+        assert triplets_io.is_factorized(f2)
+        assert 'data' not in f2['triplets']
+        assert np.array_equal(f1['unique_pairs/data'][...],
+                              f2['unique_pairs/data'][...])
+        for n_by, by in enumerate(f1['bys']):
+            triplets1 = get_triplets(f1, by)
+            triplets2 = np.concatenate(
+                list(triplets_io.read_triplets(f2, n_by, chunk_size=10)))
+            assert tables_equivalent(triplets1, triplets2), error_triplets
+    finally:
+        try:
+            os.remove('data1.abx')
+            os.remove('data2.abx')
+            os.remove('data.item')
+        except OSError:
+            pass
+
+
+# updating a task file when items are appended to the database
+def test_update():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        # new items in the 'by' block c2 = 2
+        with open('data.item') as fin:
+            lines = fin.readlines()
+        with open('data2.item', 'w') as fout:
+            fout.writelines(lines + ['s81 n81 f81 i81 0 1 2 0\n',
+                                     's82 n82 f82 i82 1 2 2 1\n'])
+
+        for factorized in (False, True):
+            task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2')
+            task.generate_triplets(
+                output='data1.abx', seed=0, factorized=factorized)
+            task = ABXpy.task.Task('data2.item', 'c0', 'c1', 'c2')
+            task.generate_triplets(
+                output='data2.abx', seed=0, factorized=factorized,
+                update='data1.abx')
+            assert len(task._unchanged_bys('data1.abx')) == 2
+            task = ABXpy.task.Task('data2.item', 'c0', 'c1', 'c2')
+            task.generate_triplets(
+                output='data3.abx', seed=0, factorized=factorized)
+
+            f2 = h5py.File('data2.abx', 'r')
+            f3 = h5py.File('data3.abx', 'r')
+            dsets = ['bys', 'by_hashes', 'triplets/by_index',
+                     'triplets/by_block_index', 'unique_pairs/data']
+            dsets += (['triplets/items', 'triplets/blocks'] if factorized
+                      else ['triplets/data', 'triplets/on_across_block_index'])
+            for dset in dsets:
+                assert np.array_equal(f2[dset][...], f3[dset][...]), dset
+            assert f2.attrs['task_hash'] == f3.attrs['task_hash']
+            for by in f3['bys']:
+                assert np.array_equal(f2['unique_pairs'].attrs[by],
+                                      f3['unique_pairs'].attrs[by])
+                assert np.array_equal(
+                    f2['regressors'][by]['indexed_data'][...],
+                    f3['regressors'][by]['indexed_data'][...])
+            f2.close()
+            f3.close()
+            for name in ('data1.abx', 'data2.abx', 'data3.abx'):
+                os.remove(name)
+    finally:
+        for name in ('data1.abx', 'data2.abx', 'data3.abx',
+                     'data.item', 'data2.item'):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+
+# resuming an interrupted task generation
+def test_resume():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2')
+        task.generate_triplets(output='data1.abx', threshold=2, seed=0)
+
+        # interrupt the generation on the last 'by' block
+        task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2')
+        compute_triplets = task._compute_triplets
+
+        def _crash(by, *args, **kwargs):
+            if by == 2:
+                raise RuntimeError('interrupted')
+            return compute_triplets(by, *args, **kwargs)
+        task._compute_triplets = _crash
+        try:
+            task.generate_triplets(
+                output='data2.abx', threshold=2, seed=0, resume=True)
+            assert False, 'the generation was not interrupted'
+        except RuntimeError:
+            pass
+        assert not os.path.exists('data2.abx')
+        with h5py.File('data2.abx.checkpoint/manifest.h5', 'r') as fh:
+            assert sorted(fh['completed'].attrs) == ['0', '1']
+
+        task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2')
+        task.generate_triplets(
+            output='data2.abx', threshold=2, seed=0, resume=True)
+        assert not os.path.exists('data2.abx.checkpoint')
+
+        f1 = h5py.File('data1.abx', 'r')
+        f2 = h5py.File('data2.abx', 'r')
+        for dset in ('bys', 'by_hashes', 'triplets/data', 'triplets/by_index',
+                     'triplets/by_block_index',
+                     'triplets/on_across_block_index', 'unique_pairs/data'):
+            assert np.array_equal(f1[dset][...], f2[dset][...]), dset
+        for by in f1['bys']:
+            assert np.array_equal(f1['unique_pairs'].attrs[by],
+                                  f2['unique_pairs'].attrs[by])
+    finally:
+        for name in ('data1.abx', 'data2.abx', 'data.item'):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+        shutil.rmtree('data2.abx.checkpoint', ignore_errors=True)
+
+
+# resuming an interrupted parallel task generation, the output file left
+# by an interrupted merge being removed with a warning
+def test_resume_parallel():
+    items.generate_testitems(3, 4, name='data.item')
+    compute_triplets = ABXpy.task.Task._compute_triplets
+    try:
+        task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2')
+        task.generate_triplets(output='data1.abx', threshold=2, seed=0)
+
+        # interrupt the generation on the last 'by' block, in a worker
+        # running on a copy of the task
+        def _crash(self, by, *args, **kwargs):
+            if by == 2:
+                raise RuntimeError('interrupted')
+            return compute_triplets(self, by, *args, **kwargs)
+        ABXpy.task.Task._compute_triplets = _crash
+        task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2')
+        with pytest.raises(RuntimeError):
+            task.generate_triplets(output='data2.abx', threshold=2,
+                                   seed=0, resume=True, n_cpu=2)
+        ABXpy.task.Task._compute_triplets = compute_triplets
+        assert not os.path.exists('data2.abx')
+        with h5py.File('data2.abx.checkpoint/manifest.h5', 'r') as fh:
+            assert sorted(fh['completed'].attrs) == ['0', '1']
+
+        # interrupt the merge of the shards in the output file
+        task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2')
+        merge_shards = task._merge_shards
+
+        def _crash_merge(output, shards):
+            merge_shards(output, shards[:1])
+            raise RuntimeError('interrupted')
+        task._merge_shards = _crash_merge
+        with pytest.raises(RuntimeError):
+            task.generate_triplets(output='data2.abx', threshold=2,
+                                   seed=0, resume=True, n_cpu=2)
+        assert os.path.exists('data2.abx')
+
+        task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2')
+        with pytest.warns(UserWarning, match='incomplete'):
+            task.generate_triplets(output='data2.abx', threshold=2,
+                                   seed=0, resume=True, n_cpu=2)
+        assert not os.path.exists('data2.abx.checkpoint')
+
+        with h5py.File('data1.abx', 'r') as f1, \
+                h5py.File('data2.abx', 'r') as f2:
+            for dset in ('bys', 'by_hashes', 'triplets/data',
+                         'triplets/by_index', 'triplets/by_block_index',
+                         'triplets/on_across_block_index',
+                         'unique_pairs/data'):
+                assert np.array_equal(f1[dset][...], f2[dset][...]), dset
+
+        # an output file not written from the checkpoint is not removed
+        os.makedirs('data2.abx.checkpoint')
+        with pytest.raises(ValueError):
+            task.generate_triplets(output='data2.abx', threshold=2,
+                                   seed=0, resume=True, n_cpu=2)
+        assert os.path.exists('data2.abx')
+    finally:
+        ABXpy.task.Task._compute_triplets = compute_triplets
+        for name in ('data1.abx', 'data2.abx', 'data.item'):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+        shutil.rmtree('data2.abx.checkpoint', ignore_errors=True)
+
+
+# saving and loading a prepared task
+def test_save_load():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        task = ABXpy.task.Task(
+            'data.item', 'c0', ['c1', 'c3'], 'c2',
+            filters=['[attr == 0 for attr in c3_A]'], regressors=['c0_1'])
+        task.save('data.task')
+        loaded = ABXpy.task.Task.load('data.task')
+        assert loaded.stats == task.stats
+        assert list(loaded.by_dbs) == list(task.by_dbs)
+        for by in task.by_dbs:
+            assert loaded.by_stats[by]['block_sizes'] == (
+                task.by_stats[by]['block_sizes'])
+
+        # the cached task is loaded by the second instantiation
+        for _ in range(2):
+            cached = ABXpy.task.Task(
+                'data.item', 'c0', ['c1', 'c3'], 'c2',
+                filters=['[attr == 0 for attr in c3_A]'],
+                regressors=['c0_1'], cache='cache')
+        assert len(os.listdir('cache')) == 1
+
+        for output, t in (('data1.abx', task), ('data2.abx', loaded),
+                          ('data3.abx', cached)):
+            t.generate_triplets(output=output, threshold=2, seed=0)
+        f1 = h5py.File('data1.abx', 'r')
+        for output in ('data2.abx', 'data3.abx'):
+            f2 = h5py.File(output, 'r')
+            for dset in ('bys', 'triplets/data', 'triplets/by_index',
+                         'unique_pairs/data'):
+                assert np.array_equal(f1[dset][...], f2[dset][...]), dset
+            for by in f1['bys']:
+                assert np.array_equal(
+                    f1['regressors'][by]['indexed_data'][...],
+                    f2['regressors'][by]['indexed_data'][...])
+    finally:
+        for name in ('data1.abx', 'data2.abx', 'data3.abx', 'data.task',
+                     'data.item'):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+        shutil.rmtree('cache', ignore_errors=True)
+
+
+# the items, codes and statistics of the 'by' blocks stored in shared
+# arrays are the ones computed on each block alone
+def test_compact_blocks():
+    items.generate_testitems(3, 4, name='data.item')
+    try:
+        task = ABXpy.task.Task('data.item', 'c0', ['c1', 'c3'], 'c2')
+        db = task.db
+        for by in task.by_dbs:
+            frame = db[db['c2'] == by].reset_index(drop=True)
+            assert task.by_dbs[by].equals(frame)
+            codes = ABXpy.task.item_codes(
+                frame.index.values, frame.groupby('c0').ngroup().values,
+                frame.groupby(['c1', 'c3']).ngroup().values)
+            for name in ABXpy.task.CODES:
+                assert np.array_equal(task.codes[by][name], codes[name])
+
+            index = np.column_stack(
+                [frame[col].factorize()[0] for col in ('c1', 'c3')])
+            for i in range(len(frame)):
+                anti = ABXpy.task.antiacross_items(
+                    task.antiacross_index[by], i, codes['index'])
+                assert np.array_equal(anti, np.flatnonzero(
+                    (index != index[i]).all(axis=1)))
+
+            stats = task.by_stats[by]
+            assert stats['nb_items'] == len(frame)
+            assert stats['on_levels'].equals(frame.groupby('c0').size())
+            assert sum(stats['block_sizes'].values()) == stats['nb_triplets']
+    finally:
+        os.remove('data.item')
+
+
+# the items, feature indexes and codes of the 'by' blocks of a task with
+# 'by' and generic filters are the ones computed on each block alone
+def test_compact_filtered_blocks():
+    items.generate_testitems(3, 5, name='data.item')
+    try:
+        task = ABXpy.task.Task(
+            'data.item', 'c0', ['c1', 'c3'], 'c2',
+            filters=['[by != 1 for by in c2]', '[attr != 0 for attr in c4]'])
+        db, _, feat_db = database.load(
+            'data.item', features_info=True)
+        assert sorted(task.by_dbs) == [0, 2]
+        for by in task.by_dbs:
+            frame = db[db['c2'] == by].reset_index(drop=True)
+            feat_frame = feat_db[db['c2'] == by].reset_index(drop=True)
+            assert task.feat_dbs[by].equals(feat_frame)
+
+            frame = frame[frame['c4'] != 0]
+            assert task.by_dbs[by].equals(frame)
+            codes = ABXpy.task.item_codes(
+                frame.index.values, frame.groupby('c0').ngroup().values,
+                frame.groupby(['c1', 'c3']).ngroup().values)
+            for name in ABXpy.task.CODES:
+                assert np.array_equal(task.codes[by][name], codes[name])
+
+            index = np.column_stack(
+                [frame[col].factorize()[0] for col in ('c1', 'c3')])
+            for i in range(len(frame)):
+                anti = ABXpy.task.antiacross_items(
+                    task.antiacross_index[by], i, codes['index'])
+                assert np.array_equal(anti, frame.index.values[
+                    (index != index[i]).all(axis=1)])
+    finally:
+        os.remove('data.item')
+
+
+# the unique pairs sorted on disk when the memory is small are the ones
+# made unique in memory
+def test_external_unique_pairs():
+    items.generate_testitems(3, 4, name='data.item')
+    sort_pairs = ABXpy.task.sort_pairs
+    sorted_bys = []
+
+    def counted_sort_pairs(abx_file, by, **kwargs):
+        sorted_bys.append(by)
+        sort_pairs(abx_file, by, **kwargs)
+
+    ABXpy.task.sort_pairs = counted_sort_pairs
+    try:
+        for symmetric in (False, True):
+            for memory, output in ((1000, 'data1.abx'), (0.001, 'data2.abx')):
+                del sorted_bys[:]
+                task = ABXpy.task.Task('data.item', 'c0', 'c1', 'c2')
+                task.generate_triplets(output=output, memory=memory,
+                                       symmetric_pairs=symmetric)
+                assert len(sorted_bys) == (0 if memory == 1000 else 3)
+
+            with h5py.File('data1.abx', 'r') as f1, \
+                    h5py.File('data2.abx', 'r') as f2:
+                assert np.array_equal(f1['unique_pairs/data'][...],
+                                      f2['unique_pairs/data'][...])
+                for by in f1['bys']:
+                    assert np.array_equal(f1['unique_pairs'].attrs[by],
+                                          f2['unique_pairs'].attrs[by])
+            os.remove('data1.abx')
+            os.remove('data2.abx')
+    finally:
+        ABXpy.task.sort_pairs = sort_pairs
+        for name in ('data.item', 'data1.abx', 'data2.abx'):
+            try:
+                os.remove(name)
+            except OSError:
+                pass